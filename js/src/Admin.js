@@ -18,6 +18,7 @@ import { KiteLoadingIndicator } from 'stork-js/src/react.js';
 import Navbar from './Navbar';
 
 import { UserDialog } from './Users';
+import { fetchPersonas } from './Personas';
 
 import '../static/icons/admin.svg';
 
@@ -137,9 +138,8 @@ class Users extends React.Component {
     }
 
     componentDidMount() {
-        fetch('kite+app://admin.flywithkite.com/personas',
-              { method: 'GET', cache: 'no-store' })
-            .then((r) => r.json())
+        fetchPersonas('kite+app://admin.flywithkite.com/personas',
+                      { method: 'GET', cache: 'no-store' })
             .then((users) => { this.setState({users}) })
             .catch((error) => { console.error("Error fetching personas", error); this.setState({error}) })
     }
@@ -13,6 +13,8 @@ import ReactDom from 'react-dom';
 
 import queryString from 'query-string';
 
+import { fetchPersonas } from './Personas';
+
 const E = React.createElement;
 
 class Logins extends React.Component {
@@ -22,25 +24,16 @@ class Logins extends React.Component {
     }
 
     componentDidMount() {
-        fetch('/admin/personas')
+        fetchPersonas('/admin/personas')
             .then((r) => {
-                if ( r.status == 200 ) {
-                    return r.json()
-                        .then((r) => {
-                            if ( r instanceof Array ) {
-                                r = r.filter((u) => u.persona.superuser)
-                                if ( r.length > 0 ) {
-                                    this.setState({ personas: r })
-                                } else {
-                                    this.setState({ needsSetup: true })
-                                }
-                            } else
-                                this.setState({error: "Could not fetch personas array"})
-                        })
+                r = r.filter((u) => u.persona.superuser)
+                if ( r.length > 0 ) {
+                    this.setState({ personas: r })
                 } else {
-                    this.setState({error: `Error fetching personas (Status: ${r.status})`})
+                    this.setState({ needsSetup: true })
                 }
             })
+            .catch((error) => { this.setState({error: error.message}) })
     }
 
     render() {
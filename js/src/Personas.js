@@ -0,0 +1,48 @@
+// /personas returns a page of personas at a time, with a Link header
+// pointing to the next page. The link is relative to the admin app, so
+// only its query is kept, and added to the URL the first page came from.
+
+const PAGE_SIZE = 500
+
+function nextPageQuery(link) {
+    if ( link === null )
+        return null
+
+    var match = /<([^>]*)>\s*;\s*rel="next"/.exec(link)
+    if ( match === null )
+        return null
+
+    var url = match[1]
+    var queryStart = url.indexOf('?')
+    if ( queryStart < 0 )
+        return null
+    return url.substring(queryStart)
+}
+
+export function fetchPersonas(baseUrl, options) {
+    var personas = []
+
+    var fetchPage = (query) =>
+        fetch(baseUrl + query, options)
+            .then((r) => {
+                if ( r.status != 200 ) {
+                    var error = new Error(`Error fetching personas (Status: ${r.status})`)
+                    error.status = r.status
+                    throw error
+                }
+
+                var next = nextPageQuery(r.headers.get('Link'))
+                return r.json().then((page) => {
+                    if ( !(page instanceof Array) )
+                        throw new Error("Could not fetch personas array")
+
+                    personas.push(...page)
+                    if ( next === null )
+                        return personas
+                    else
+                        return fetchPage(next)
+                })
+            })
+
+    return fetchPage(`?limit=${PAGE_SIZE}`)
+}
@@ -0,0 +1,472 @@
+from socket import socket, AF_UNIX, SOCK_SEQPACKET, SOL_SOCKET, SCM_RIGHTS, \
+    MSG_PEEK, MSG_TRUNC
+from collections import deque
+import asyncio
+import inspect
+import array
+import struct
+import time
+import os
+
+from . import metrics
+from .cache import container_info_cache, shared_persona_info, MISSING
+from .api import KiteLocalProtocol, KiteLocalReply, KiteNoPermError, \
+    KLM_IS_LAST, _header
+
+class _PendingReply(object):
+    '''A request that has been sent, and the future its reply will
+    complete. Streaming requests collect packets until the last one.
+    '''
+
+    __slots__ = ( 'future', 'streaming', 'packets', 'opcode', 'started' )
+
+    def __init__(self, future, opcode, streaming=False):
+        self.future = future
+        self.streaming = streaming
+        self.packets = []
+
+        self.opcode = opcode
+        self.started = time.monotonic()
+
+class AsyncKiteLocalApi(KiteLocalProtocol):
+    '''An asyncio client for applianced.
+
+    Requests on one connection may be issued concurrently from any
+    number of tasks. Since applianced answers in order, replies are
+    matched to requests by a queue of pending futures, which a single
+    reader task completes.
+
+    Use as
+
+        async with AsyncKiteLocalApi() as api:
+            info = await api.get_container_info(address)
+    '''
+
+    PROGRESS_DRAIN_TIMEOUT = 1
+
+    def __init__(self, sockpath=None):
+        super(AsyncKiteLocalApi, self).__init__(sockpath)
+
+        self.socket = None
+        self._pending = deque()
+        self._send_lock = None
+        self._reader = None
+        self._error = None
+
+    async def connect(self):
+        if self.socket is not None:
+            self.close()
+
+        loop = asyncio.get_running_loop()
+
+        self.socket = socket(AF_UNIX, SOCK_SEQPACKET, 0)
+        self.socket.setblocking(False)
+        try:
+            await loop.sock_connect(self.socket, self.sockpath)
+        except FileNotFoundError:
+            self.socket.close()
+            self.socket = None
+            raise KiteNoPermError()
+
+        self._pending = deque()
+        self._send_lock = asyncio.Lock()
+        self._error = None
+        self._reader = loop.create_task(self._read_replies())
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
+
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+        self._fail_pending(ConnectionError("connection to applianced closed"))
+
+    def _fail_pending(self, error):
+        self._error = error
+        while len(self._pending) > 0:
+            pending = self._pending.popleft()
+            metrics.applianced_errors.inc(pending.opcode)
+            if not pending.future.done():
+                pending.future.set_exception(error)
+
+    async def _wait_ready(self, add, remove):
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        fd = self.socket.fileno()
+
+        add(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            remove(fd)
+
+    async def _send(self, req, fds=[], streaming=False):
+        '''Send a request, and return the future for its reply'''
+        if self.socket is None:
+            raise ConnectionError("not connected to applianced")
+
+        loop = asyncio.get_running_loop()
+        iov = req if isinstance(req, list) else [ req ]
+        (req_ty, _) = _header.unpack_from(iov[0], 0)
+        pending = _PendingReply(loop.create_future(), metrics.opcode_label(req_ty),
+                                streaming=streaming)
+
+        ancillary = []
+        if len(fds) > 0:
+            ancillary = [(SOL_SOCKET, SCM_RIGHTS, array.array('i', fds))]
+
+        # Replies come back in the order requests were sent, so queueing
+        # the future and sending must not interleave with another task
+        async with self._send_lock:
+            if self._error is not None:
+                raise self._error
+
+            while True:
+                try:
+                    self.socket.sendmsg(iov, ancillary)
+                    break
+                except (BlockingIOError, InterruptedError):
+                    await self._wait_ready(loop.add_writer, loop.remove_writer)
+
+            self._pending.append(pending)
+
+        metrics.applianced_requests.inc(pending.opcode)
+        metrics.applianced_bytes_sent.inc(pending.opcode, amount=sum(len(buf) for buf in iov))
+        return pending.future
+
+    def _receive_nowait(self):
+        '''Receive one packet, if there is one, into a buffer of its own'''
+        size = self.socket.recv_into(bytearray(4), 4, MSG_PEEK | MSG_TRUNC)
+        if size == 0:
+            raise ConnectionError("applianced closed the connection")
+
+        pkt = bytearray(size)
+        size = self.socket.recv_into(pkt, size)
+        return memoryview(pkt)[:size]
+
+    async def _read_replies(self):
+        loop = asyncio.get_running_loop()
+
+        try:
+            while True:
+                try:
+                    pkt = self._receive_nowait()
+                except (BlockingIOError, InterruptedError):
+                    await self._wait_ready(loop.add_reader, loop.remove_reader)
+                    continue
+
+                if len(self._pending) == 0:
+                    raise ConnectionError("unexpected reply from applianced")
+
+                pending = self._pending[0]
+                metrics.applianced_bytes_received.inc(pending.opcode, amount=len(pkt))
+                try:
+                    reply = KiteLocalReply(pkt)
+                except struct.error as e:
+                    reply = e
+
+                if pending.streaming and not isinstance(reply, Exception):
+                    pending.packets.append(reply)
+                    if ( reply.flags & KLM_IS_LAST ) == 0:
+                        continue
+                    reply = pending.packets
+
+                self._pending.popleft()
+                metrics.applianced_latency.observe(time.monotonic() - pending.started,
+                                                   pending.opcode)
+                if pending.future.done():
+                    continue
+                elif isinstance(reply, Exception):
+                    pending.future.set_exception(reply)
+                else:
+                    pending.future.set_result(reply)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._fail_pending(e)
+
+    async def _run_blocking(self, fn, *args):
+        '''Call fn in the default executor, for work that would block the
+        event loop, such as a Redis round-trip'''
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+    async def _request(self, req, fds=[]):
+        reply = await (await self._send(req, fds=fds))
+        return (reply.ty, reply)
+
+    async def get_system_type(self):
+        return self._parse_system_type(*await self._request(self._system_info_request()))
+
+    async def create_user(self, displayname=None, password=None, superuser=False):
+        req = self._create_user_request(displayname=displayname, password=password,
+                                        superuser=superuser)
+        reply = await self._request(req)
+        await self._run_blocking(self._personas_changed)
+        return self._parse_create_user(*reply)
+
+    async def list_personas(self):
+        packets = await (await self._send(self._list_personas_request(), streaming=True))
+
+        ret = []
+        for reply in packets:
+            persona_id = self._parse_persona_list_entry(reply.flags, reply)
+            if persona_id is not None:
+                ret.append(persona_id)
+
+        return ret
+
+    async def _personas_generation(self):
+        generation = shared_persona_info.cached_generation()
+        if generation is MISSING:
+            generation = await self._run_blocking(shared_persona_info.generation)
+        return generation
+
+    async def get_persona_info(self, persona_id):
+        generation = await self._personas_generation()
+        info = self._cached_persona_info(persona_id, generation)
+        if info is MISSING:
+            info = self._parse_persona_info(*await self._request(self._persona_info_request(persona_id)))
+            self._cache_persona_info(persona_id, info, generation)
+        return info
+
+    async def get_persona_infos(self, persona_ids):
+        '''Look up several personas concurrently.
+
+        Returns a list of results, in the same order as persona_ids
+        '''
+        return await asyncio.gather(*[ self.get_persona_info(persona_id) for persona_id in persona_ids ])
+
+    async def get_application_info(self, app_url):
+        return self._parse_application_info(*await self._request(self._application_info_request(app_url)))
+
+    async def get_application_infos(self, app_urls):
+        '''Look up several applications concurrently.
+
+        Returns a list of results, in the same order as app_urls
+        '''
+        return await asyncio.gather(*[ self.get_application_info(app_url) for app_url in app_urls ])
+
+    async def get_application_status(self, appid):
+        return self._application_status(await self.get_application_info(appid))
+
+    async def get_container_info(self, address):
+        info = self._cached_container_info(address)
+        if info is MISSING:
+            generation = self._tokens_generation()
+            info = self._parse_container_info(*await self._request(self._container_info_request(address)))
+            self._cache_container_info(address, info, generation)
+        return info
+
+    async def get_container_infos(self, addresses):
+        '''Look up several containers concurrently.
+
+        Returns a list of results, in the same order as addresses
+        '''
+        return await asyncio.gather(*[ self.get_container_info(address) for address in addresses ])
+
+    async def update_container(self, address, credential=None):
+        container_info_cache.invalidate(address)
+
+        req = self._update_container_request(address, credential=credential)
+        return self._parse_update_container(*await self._request(req))
+
+    async def _dedicated(self):
+        '''A new connection, for an exchange that holds its reply back
+        until something long-running completes'''
+        api = AsyncKiteLocalApi(self.sockpath)
+        if hasattr(self, 'appliance_dir'):
+            api.appliance_dir = self.appliance_dir
+        await api.connect()
+        return api
+
+    async def run_in_app(self, ip_or_app_name, cmd, persona=None, stdin=None, stdout=None, stderr=None):
+        '''Like KiteLocalApi.run_in_app, but the PIPE ends are returned as
+        asyncio streams, and the process is an AsyncContainerProcess.
+
+        The process runs over its own connection, so this one stays free
+        for other requests until it exits.
+        '''
+        (req, fds, close_fds, (stdin, stdout, stderr)) = \
+            self._run_in_app_request(ip_or_app_name, cmd, persona=persona,
+                                     stdin=stdin, stdout=stdout, stderr=stderr)
+
+        try:
+            api = await self._dedicated()
+            try:
+                complete = await api._send(req, fds=fds)
+            except:
+                api.close()
+                raise
+        except:
+            for fd in close_fds:
+                os.close(fd)
+            raise
+
+        for fd in close_fds:
+            if fd not in (stdin, stdout, stderr):
+                os.close(fd)
+
+        return await AsyncContainerProcess.start(api, complete, stdin=stdin, stdout=stdout, stderr=stderr,
+                                                 app=self._process_label(ip_or_app_name))
+
+    async def register_application(self, manifest_path, progress=None, signature_path=None):
+        '''Install an application.
+
+        progress, if given, is called as progress(msg, complete, total)
+        for each progress line. It may be a coroutine function.
+        '''
+        req = self._register_application_request(manifest_path, with_progress=progress is not None,
+                                                 signature_path=signature_path)
+
+        api = await self._dedicated()
+        try:
+            if progress is None:
+                (pktTy, attrs) = await api._request(req)
+                await self._run_blocking(self._applications_changed)
+                self._parse_register_application(pktTy, attrs)
+                return
+
+            rfd, wfd = os.pipe()
+            try:
+                complete = await api._send(req, fds=[ wfd ])
+            finally:
+                os.close(wfd)
+
+            output = await _open_reader(rfd)
+
+            state = { 'buf': '', 'error': None }
+            async def follow_progress():
+                while True:
+                    next_chunk = await output.read(1000)
+                    if len(next_chunk) == 0:
+                        break
+
+                    state['buf'] += next_chunk.decode('ascii')
+                    reports = []
+                    (state['buf'], error) = \
+                        self._handle_progress(state['buf'],
+                                              lambda *args: reports.append(args))
+                    if error is not None:
+                        state['error'] = error
+
+                    for report in reports:
+                        res = progress(*report)
+                        if inspect.isawaitable(res):
+                            await res
+
+            follower = asyncio.ensure_future(follow_progress())
+            try:
+                await asyncio.wait([ follower, complete ], return_when=asyncio.FIRST_COMPLETED)
+                if follower.done():
+                    follower.result()
+                reply = await complete
+
+                # Pick up the last lines of progress, which may still be
+                # in the pipe when the reply arrives
+                await asyncio.wait([ follower ], timeout=self.PROGRESS_DRAIN_TIMEOUT)
+                if follower.done():
+                    follower.result()
+            finally:
+                follower.cancel()
+
+            await self._run_blocking(self._applications_changed)
+            self._parse_register_application(reply.ty, reply, error=state['error'])
+        finally:
+            api.close()
+
+async def _open_reader(fd):
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),
+                                 os.fdopen(fd, 'rb', 0))
+    return reader
+
+async def _open_writer(fd):
+    loop = asyncio.get_running_loop()
+    (transport, protocol) = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin,
+                                                          os.fdopen(fd, 'wb', 0))
+    return asyncio.StreamWriter(transport, protocol, None, loop)
+
+class AsyncContainerProcess(object):
+    '''A process started by AsyncKiteLocalApi.run_in_app.
+
+    stdin is an asyncio.StreamWriter, and stdout and stderr are
+    asyncio.StreamReaders, when they were requested as PIPE.
+    '''
+
+    def __init__(self, api, complete, stdin=None, stdout=None, stderr=None, app='container'):
+        self.api = api
+        self._complete = complete
+
+        self.app = app
+        self._started = time.monotonic()
+
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+
+        self.status = 'running'
+        self.returncode = None
+        self.pid = None
+
+    @classmethod
+    async def start(cls, api, complete, stdin=None, stdout=None, stderr=None, app='container'):
+        if stdin is not None:
+            stdin = await _open_writer(stdin)
+        if stdout is not None:
+            stdout = await _open_reader(stdout)
+        if stderr is not None:
+            stderr = await _open_reader(stderr)
+
+        return cls(api, complete, stdin=stdin, stdout=stdout, stderr=stderr, app=app)
+
+    async def wait(self):
+        if self.status == 'running':
+            try:
+                reply = await self._complete
+                self.status, self.returncode = \
+                    self.api._parse_run_in_app_complete(reply.ty, reply)
+            except ConnectionError:
+                self.status, self.returncode = 'internal-error', -1
+            finally:
+                self.api.close()
+
+            metrics.container_process_duration.observe(time.monotonic() - self._started, self.app)
+
+        return self.returncode
+
+    async def communicate(self, input=None):
+        if isinstance(input, str):
+            input = input.encode()
+
+        async def feed():
+            if self.stdin is None:
+                return
+            try:
+                if input is not None:
+                    self.stdin.write(input)
+                    await self.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            finally:
+                self.stdin.close()
+
+        async def drain(stream):
+            if stream is None:
+                return b""
+            return await stream.read()
+
+        (_, out_buf, err_buf, _) = \
+            await asyncio.gather(feed(), drain(self.stdout), drain(self.stderr), self.wait())
+
+        return ( out_buf, err_buf )
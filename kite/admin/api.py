@@ -1,27 +1,48 @@
-from socket import socket, AF_UNIX, SOCK_SEQPACKET, SOL_SOCKET, SCM_RIGHTS
+from socket import socket, AF_UNIX, SOCK_SEQPACKET, SOL_SOCKET, SCM_RIGHTS, \
+    MSG_PEEK, MSG_TRUNC
 from contextlib import contextmanager
 from OpenSSL import crypto
-from flask import request, session
+from flask import request, session, g, has_request_context
 from urllib.parse import urlparse
 from collections.abc import Sequence, Callable
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
 import signal
 import fcntl
 import array
 import struct
 import os
+import sys
 import ipaddress
 import binascii
 import json
 import datetime
 import select
+import threading
+import weakref
+import functools
+import logging
+import time
+import copy
 
 from .app import app
+from . import metrics
+from .cache import container_info_cache, persona_info_cache, manifest_cache, \
+    PERSONA_NOT_FOUND_TTL, MISSING, shared_persona_info, shared_application_info
+from .catalog import application_catalog
 from .errors import KiteNotLoggedInError, KiteAppFetchError, KiteAppInstallationError
 
 AttrFactory = {}
 
 KLM_IS_LAST = 0x0002
 
+_header = struct.Struct("!HH")
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (ValueError, OSError):
+    IOV_MAX = 1024
+
 def make_manifest_path(appid):
     return "https://{}/manifest.json".format(appid)
 
@@ -29,8 +50,122 @@ def make_signature_path(appid):
     return "https://{}/manifest.json.sign".format(appid)
 
 def set_nonblocking(fd):
-    flag = fcntl.fcntl(fd, fcntl.F_GETFD)
-    fcntl.fcntl(fd, fcntl.F_SETFD, flag | os.O_NONBLOCK)
+    flag = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flag | os.O_NONBLOCK)
+
+class _StructCodec(object):
+    def __init__(self, names, fmt):
+        self.names = names
+        self.struct = struct.Struct("!" + fmt)
+
+    def size(self, attr):
+        return self.struct.size
+
+    def pack_into(self, attr, buf, offset):
+        self.struct.pack_into(buf, offset, *[getattr(attr, name) for name in self.names])
+
+    def decode_into(self, attr, data):
+        for name, value in zip(self.names, self.struct.unpack(data)):
+            setattr(attr, name, value)
+
+class _AsciiCodec(object):
+    def __init__(self, name):
+        self.name = name
+        self.names = [ name ]
+
+    def size(self, attr):
+        return len(getattr(attr, self.name))
+
+    def pack_into(self, attr, buf, offset):
+        data = getattr(attr, self.name).encode('ascii')
+        buf[offset:offset + len(data)] = data
+
+    def decode_into(self, attr, data):
+        setattr(attr, self.name, str(data, 'ascii'))
+
+class _IdCodec(object):
+    ID_LENGTH = 32
+
+    def __init__(self, name):
+        self.name = name
+        self.names = [ name ]
+
+    def size(self, attr):
+        return self.ID_LENGTH
+
+    def pack_into(self, attr, buf, offset):
+        buf[offset:offset + self.ID_LENGTH] = getattr(attr, self.name)[:self.ID_LENGTH]
+
+    def decode_into(self, attr, data):
+        if len(data) != self.ID_LENGTH:
+            raise OverflowError("Expected {} of length {}, got {}".format(self.name.replace('_', ' '),
+                                                                          self.ID_LENGTH, len(data)))
+        setattr(attr, self.name, bytes(data))
+
+class _AddressCodec(object):
+    def __init__(self, name):
+        self.name = name
+        self.names = [ name ]
+
+    def size(self, attr):
+        return 16 if ':' in getattr(attr, self.name) else 4
+
+    def pack_into(self, attr, buf, offset):
+        data = ipaddress.ip_address(getattr(attr, self.name)).packed
+        buf[offset:offset + len(data)] = data
+
+    def decode_into(self, attr, data):
+        setattr(attr, self.name, ipaddress.ip_address(bytes(data)).exploded)
+
+class _FlagCodec(object):
+    names = []
+
+    def size(self, attr):
+        return 0
+
+    def pack_into(self, attr, buf, offset):
+        pass
+
+    def decode_into(self, attr, data):
+        pass
+
+_struct_formats = { 'uint8': 'B',
+                    'uint16': 'H',
+                    'int32': 'l' }
+
+def _compile_schema(schema):
+    '''Build the codec for an attribute's payload from its attr_schema.
+
+    The schema is a sequence of (field, kind) pairs. Any number of
+    'uint8', 'uint16' and 'int32' fields are packed with one
+    precompiled struct. 'ascii' (a string), 'id32' (32 raw bytes) and
+    'address' (an IPv4 or IPv6 address) must be the only field. An
+    empty schema describes a flag attribute with no payload.
+    '''
+    if len(schema) == 0:
+        return _FlagCodec()
+
+    if all(kind in _struct_formats for (_, kind) in schema):
+        return _StructCodec([ name for (name, _) in schema ],
+                            ''.join(_struct_formats[kind] for (_, kind) in schema))
+
+    if len(schema) == 1:
+        (name, kind) = schema[0]
+        if kind == 'ascii':
+            return _AsciiCodec(name)
+        elif kind == 'id32':
+            return _IdCodec(name)
+        elif kind == 'address':
+            return _AddressCodec(name)
+
+    raise TypeError("Unsupported attribute schema: {}".format(schema))
+
+def _make_decoder(cls, codec):
+    def _from_buffer(attrTy, data):
+        attr = cls.__new__(cls)
+        codec.decode_into(attr, data)
+        return attr
+    return _from_buffer
 
 class KiteLocalAttrClass(type):
     def __new__(cls, name, parents, dct):
@@ -38,50 +173,82 @@ class KiteLocalAttrClass(type):
 
     def __init__(cls, name, bases, nmspc):
         ret = super(KiteLocalAttrClass, cls).__init__(name, bases, nmspc)
+        if 'attr_schema' in nmspc:
+            cls._codec = _compile_schema(nmspc['attr_schema'])
+            if '_from_buffer' not in nmspc:
+                cls._from_buffer = staticmethod(_make_decoder(cls, cls._codec))
         if hasattr(cls, 'attr_ty'):
             AttrFactory[cls.attr_ty] = cls
         return ret
 
+_encoded_attrs = {}
+MAX_ENCODED_ATTRS = 1024
+
 class KiteLocalAttr(object, metaclass = KiteLocalAttrClass):
+    '''Base class for the attributes sent to and received from applianced.
+
+    Subclasses set attr_ty and attr_schema, from which the metaclass
+    generates the payload codec and the _from_buffer decoder. Subclasses
+    whose values recur across requests (application URLs, persona ids)
+    set cache_encoding, so that encoded() reuses their encodings. Those
+    whose values differ from call to call, like run_in_app arguments,
+    must not, or they would crowd the recurring ones out of the cache.
+    '''
+
+    cache_encoding = False
 
     def __init__(self):
         pass
 
-    def pack(self):
-        d = self._pack()
-        aligned_len = 4 * ((len(d) + 3) // 4)
+    def packed_len(self):
+        return 4 * ((self._codec.size(self) + 7) // 4)
 
-        return struct.pack("!HH", self.attr_ty, len(d) + 4) + d + (b' ' * (aligned_len - len(d)))
+    def pack_into(self, buf, offset):
+        '''Encode this attribute into buf at offset. buf is expected to be
+        zero-filled, so padding is not written. Returns the offset after
+        the padded attribute.
+        '''
+        size = self._codec.size(self)
+        _header.pack_into(buf, offset, self.attr_ty, size + 4)
+        self._codec.pack_into(self, buf, offset + 4)
+        return offset + 4 * ((size + 7) // 4)
+
+    def pack(self):
+        buf = bytearray(self.packed_len())
+        self.pack_into(buf, 0)
+        return bytes(buf)
+
+    def encoded(self):
+        '''Like pack(), but shared between equal attributes of classes that
+        set cache_encoding'''
+        if not self.cache_encoding:
+            return self.pack()
+
+        key = (self.attr_ty,) + tuple(getattr(self, name) for name in self._codec.names)
+        encoded = _encoded_attrs.get(key)
+        if encoded is None:
+            encoded = self.pack()
+            if len(_encoded_attrs) >= MAX_ENCODED_ATTRS:
+                _encoded_attrs.clear()
+            _encoded_attrs[key] = encoded
+        return encoded
 
 class KiteLocalAttrAddress(KiteLocalAttr):
     attr_ty = 0x10
+    attr_schema = ( ('address', 'address'), )
 
     def __init__(self, addr):
         super(KiteLocalAttrAddress, self).__init__()
         self.address = addr
 
-    def _pack(self):
-        return ipaddress.ip_address(self.address).packed
-
-    @staticmethod
-    def _from_buffer(attrTy, data):
-        addr = ipaddress.ip_address(data).exploded
-        return KiteLocalAttrAddress(addr)
-
 class KiteLocalAttrResponseCode(KiteLocalAttr):
     attr_ty = 0x0000
+    attr_schema = ( ('code', 'uint16'), )
+
     def __init__(self, code):
         super(KiteLocalAttrResponseCode, self).__init__()
         self.code = code & 0xFFFF
 
-    def _pack(self):
-        return struct.pack("!H", self.code)
-
-    @staticmethod
-    def _from_buffer(attrTy, data):
-        (code,) = struct.unpack("!H", data)
-        return KiteLocalAttrResponseCode(code)
-
     @property
     def success(self):
         return self.code == 0
@@ -100,19 +267,12 @@ class KiteLocalAttrResponseCode(KiteLocalAttr):
 
 class KiteLocalAttrContainerType(KiteLocalAttr):
     attr_ty = 0x0011
+    attr_schema = ( ('ty', 'uint16'), )
 
     def __init__(self, ty):
         super(KiteLocalAttrContainerType, self).__init__()
         self.ty = ty & 0xFFFF
 
-    def _pack(self):
-        return struct.pack("!H", self.ty)
-
-    @staticmethod
-    def _from_buffer(attrTy, data):
-        (code,) = struct.unpack("!H", data)
-        return KiteLocalAttrContainerType(code)
-
     @property
     def is_persona(self):
         return self.ty == 1
@@ -123,122 +283,73 @@ class KiteLocalAttrContainerType(KiteLocalAttr):
 
 class KiteLocalAttrAppUrl(KiteLocalAttr):
     attr_ty = 0x0002
+    attr_schema = ( ('url', 'ascii'), )
+    cache_encoding = True
 
     def __init__(self, url):
         super(KiteLocalAttrAppUrl, self).__init__()
         self.url = url
 
-    def _pack(self):
-        return self.url.encode('ascii')
-
-    @staticmethod
-    def _from_buffer(attrTy, data):
-        return KiteLocalAttrAppUrl(data.decode('ascii'))
-
 class KiteLocalAttrPersonaDisplayName(KiteLocalAttr):
     attr_ty = 0x000D
+    attr_schema = ( ('name', 'ascii'), )
 
     def __init__(self, name):
         super(KiteLocalAttrPersonaDisplayName, self).__init__()
         self.name = name
 
-    def _pack(self):
-        return self.name.encode('ascii')
-
-    @staticmethod
-    def _from_buffer(attrTy, data):
-        return KiteLocalAttrPersonaDisplayName(data.decode('ascii'))
-
 class KiteLocalAttrStdout(KiteLocalAttr):
     attr_ty = 0x0018
+    attr_schema = ( ('ix', 'uint8'), )
 
     def __init__(self, ix):
         super(KiteLocalAttrStdout, self).__init__()
         self.ix = ix
 
-    def _pack(self):
-        return struct.pack("!B", self.ix)
-
-    @staticmethod
-    def _from_buffer(attrTy, data):
-        (ix,) = struct.unpack("!B", data)
-        return KiteLocalAttrStdout(ix)
-
 class KiteLocalAttrStderr(KiteLocalAttr):
     attr_ty = 0x0019
+    attr_schema = ( ('ix', 'uint8'), )
 
     def __init__(self, ix):
         super(KiteLocalAttrStderr, self).__init__()
         self.ix = ix
 
-    def _pack(self):
-        return struct.pack("!B", self.ix)
-
-    @staticmethod
-    def _from_buffer(attrTy, data):
-        (ix,) = struct.unpack("!B", data)
-        return KiteLocalAttrStderr(ix)
-
 class KiteLocalAttrStdin(KiteLocalAttr):
     attr_ty = 0x001A
+    attr_schema = ( ('ix', 'uint8'), )
 
     def __init__(self, ix):
         super(KiteLocalAttrStdin, self).__init__()
         self.ix = ix
 
-    def _pack(self):
-        return struct.pack("!B", self.ix)
-
-    @staticmethod
-    def _from_buffer(attrTy, data):
-        (ix,) = struct.unpack("!B", data)
-        return KiteLocalAttrStdin(ix)
-
 class KiteLocalAttrExitCode(KiteLocalAttr):
     attr_ty = 0x001C
+    attr_schema = ( ('exit_code', 'int32'), )
 
     def __init__(self, ec):
         super(KiteLocalAttrExitCode, self).__init__()
         self.exit_code = ec
 
-    def _pack(self):
-        return struct.pack("!i", self.exit_code)
-
-    @staticmethod
-    def _from_buffer(attrTy, data):
-        (exit_code,) = struct.unpack("!i", data)
-        return KiteLocalAttrExitCode(exit_code)
-
 class KiteLocalAttrArg(KiteLocalAttr):
     attr_ty = 0x0017
+    attr_schema = ( ('arg', 'ascii'), )
 
     def __init__(self, arg):
         super(KiteLocalAttrArg, self).__init__()
         self.arg = arg
 
-    def _pack(self):
-        return self.arg.encode('ascii')
-
-    @staticmethod
-    def _from_buffer(attrTy, data):
-        return KiteLocalAttrArg(data.decode('ascii'))
-
 class KiteLocalAttrPersonaPassword(KiteLocalAttr):
     attr_ty = 0x000E
+    attr_schema = ( ('password', 'ascii'), )
 
     def __init__(self, pw):
         super(KiteLocalAttrPersonaPassword, self).__init__()
         self.password = pw
 
-    def _pack(self):
-        return self.password.encode('ascii')
-
-    @staticmethod
-    def _from_buffer(attrTy, data):
-        return KiteLocalAttrPersonaPassword(data.decode('ascii'))
-
 class KiteLocalAttrPersonaFlags(KiteLocalAttr):
     attr_ty = 0x001D
+    attr_schema = ( ('set_flags', 'int32'),
+                    ('unset_flags', 'int32') )
 
     def __init__(self, is_superuser=False, set_flags=0, unset_flags=0):
         self.set_flags = set_flags
@@ -255,17 +366,9 @@ class KiteLocalAttrPersonaFlags(KiteLocalAttr):
     def is_superuser(self):
         return (self.final_flags & 0x1) != 0
 
-    def _pack(self):
-        return struct.pack("!ll", self.set_flags, self.unset_flags)
-
-    @staticmethod
-    def _from_buffer(attrTy, data):
-        (set_flags, unset_flags,) = struct.unpack("!ll", data)
-        return KiteLocalAttrPersonaFlags(set_flags = set_flags,
-                                         unset_flags = unset_flags)
-
 class KiteLocalAttrSiteId(KiteLocalAttr):
     attr_ty = 0x0013
+    attr_schema = ( ('canonical', 'ascii'), )
 
     def __init__(self, hash_type, hash_data):
         self.hash_type = hash_type
@@ -275,12 +378,9 @@ class KiteLocalAttrSiteId(KiteLocalAttr):
     def canonical(self):
         return '{}:{}'.format(self.hash_type, self.hash_data)
 
-    def _pack(self):
-        return self.canonical.encode('ascii')
-
     @staticmethod
     def _from_buffer(attrTy, data):
-        data = data.decode('ascii').split(':')
+        data = str(data, 'ascii').split(':')
         if len(data) != 2:
             raise ValueError("Expected site id in <hash-type>:<hash-octet> form")
 
@@ -296,6 +396,7 @@ class KiteLocalAttrSiteId(KiteLocalAttr):
 
 class KiteLocalAttrTokenId(KiteLocalAttr):
     attr_ty = 0x0016
+    attr_schema = ( ('token_id', 'id32'), )
 
     def __init__(self, token_id):
         super(KiteLocalAttrTokenId, self).__init__()
@@ -309,37 +410,23 @@ class KiteLocalAttrTokenId(KiteLocalAttr):
         if len(self.token_id) != 32:
             raise TypeError("token id needs to be 32 bytes long")
 
-    def _pack(self):
-        return self.token_id[:32]
-
-    @staticmethod
-    def _from_buffer(attrTy, data):
-        if len(data) == 32:
-            return KiteLocalAttrTokenId(data)
-        else:
-            raise OverflowError("Expected token id of length 32, got %d" % len(data))
-
     @property
     def hex_str(self):
         return binascii.hexlify(self.token_id).decode('ascii')
 
 class KiteLocalAttrCredential(KiteLocalAttr):
     attr_ty = 0x0020
+    attr_schema = ( ('cred', 'ascii'), )
 
     def __init__(self, cred):
         super(KiteLocalAttrCredential, self).__init__()
 
         self.cred = cred
 
-    def _pack(self):
-        return self.cred.encode('ascii')
-
-    @staticmethod
-    def _from_buffer(attrTy, data):
-        return KiteLocalAttrCredential(data.decode('ascii'))
-
 class KiteLocalAttrPersonaId(KiteLocalAttr):
     attr_ty = 0x0001
+    attr_schema = ( ('persona_id', 'id32'), )
+    cache_encoding = True
 
     def __init__(self, persona_id):
         super(KiteLocalAttrPersonaId, self).__init__()
@@ -353,102 +440,56 @@ class KiteLocalAttrPersonaId(KiteLocalAttr):
         if len(self.persona_id) != 32:
             raise TypeError("persona id needs to be 32 bytes long")
 
-    def _pack(self):
-        return self.persona_id[:32]
-
-    @staticmethod
-    def _from_buffer(attrTy, data):
-        if len(data) == 32:
-            return KiteLocalAttrPersonaId(data)
-        else:
-            raise OverflowError("Expected persona id of length 32, got %d" % len(data))
-
     @property
     def hex_str(self):
         return binascii.hexlify(self.persona_id).decode('ascii')
 
 class KiteLocalAttrSigned(KiteLocalAttr):
     attr_ty = 0x0015
+    attr_schema = ()
 
     def __init__(self):
         super(KiteLocalAttrSigned, self).__init__()
 
-    def _pack(self):
-        return b''
-
-    @staticmethod
-    def _from_buffer(attrTy, data):
-        return KiteLocalAttrSigned()
-
 class KiteLocalAttrGuest(KiteLocalAttr):
     attr_ty = 0x0021
+    attr_schema = ()
 
     def __init__(self):
-        super(KiteLocalAttrSigned, self).__init__()
-
-    def _pack(self):
-        return b''
-
-    @staticmethod
-    def _from_buffer(attrTy, data):
-        return KiteLocalAttrSigned()
+        super(KiteLocalAttrGuest, self).__init__()
 
 class KiteLocalAttrManifestUrl(KiteLocalAttr):
     attr_ty = 0x0003
+    attr_schema = ( ('manifest_url', 'ascii'), )
 
     def __init__(self, mf_url):
         super(KiteLocalAttrManifestUrl, self).__init__()
         self.manifest_url = mf_url
 
-    def _pack(self):
-        return self.manifest_url.encode('ascii')
-
-    @staticmethod
-    def _from_buffer(attrTy, data):
-        return KiteLocalAttrManifestUrl(data.decode('ascii'))
-
 class KiteLocalAttrSignatureUrl(KiteLocalAttr):
     attr_ty = 0x001F
+    attr_schema = ( ('signature_url', 'ascii'), )
 
     def __init__(self, mf_url):
         super(KiteLocalAttrSignatureUrl, self).__init__()
         self.signature_url = mf_url
 
-    def _pack(self):
-        return self.signature_url.encode('ascii')
-
-    @staticmethod
-    def _from_buffer(attrTy, data):
-        return KiteLocalAttrSignatureUrl(data.decode('ascii'))
-
 class KiteLocalAttrManifest(KiteLocalAttr):
     attr_ty = 0x0014
+    attr_schema = ( ('manifest', 'ascii'), )
 
     def __init__(self, mf_name):
         super(KiteLocalAttrManifest, self).__init__()
         self.manifest = mf_name
 
-    def _pack(self):
-        return self.manifest.encode('ascii')
-
-    @staticmethod
-    def _from_buffer(attrTy, data):
-        return KiteLocalAttrManifest(data.decode('ascii'))
-
 class KiteLocalAttrSystemType(KiteLocalAttr):
     attr_ty = 0x001E
+    attr_schema = ( ('system_type', 'ascii'), )
 
     def __init__(self, ty):
         super(KiteLocalAttrSystemType, self).__init__()
         self.system_type = ty
 
-    def _pack(self):
-        return self.system_type.encode('ascii')
-
-    @staticmethod
-    def _from_buffer(attrTy, data):
-        return KiteLocalAttrSystemType(data.decode('ascii'))
-
 class UnknownAttr(object):
     def __init__(self, ty, data):
         self.ty = ty
@@ -459,36 +500,156 @@ class UnknownAttr(object):
 
     @staticmethod
     def _from_buffer(ty, data):
-        return UnknownAttr(ty, data)
+        return UnknownAttr(ty, bytes(data))
+
+class KiteLocalReply(object):
+    '''A reply packet from applianced.
+
+    Attributes are indexed by type when the reply is received, but each
+    one is only decoded the first time it is accessed. Iterating over
+    the reply yields every attribute, in order, like the attribute lists
+    the API used to return.
+    '''
+
+    __slots__ = ( 'ty', 'flags', '_data', '_spans', '_index', '_decoded',
+                  '__weakref__' )
+
+    def __init__(self, pkt):
+        (self.ty, self.flags) = _header.unpack_from(pkt, 0)
+
+        self._data = pkt
+        self._spans = []
+        self._index = {}
+
+        offset = 4
+        while offset < len(pkt):
+            (attr_ty, attr_len) = _header.unpack_from(pkt, offset)
+            if attr_len < 4:
+                raise struct.error("attribute length {} is too short".format(attr_len))
+
+            self._index.setdefault(attr_ty, []).append(len(self._spans))
+            self._spans.append((attr_ty, offset + 4, offset + attr_len))
+
+            offset += 4 * ((attr_len + 3)//4)
+
+        self._decoded = [ None ] * len(self._spans)
+
+    def _detach(self):
+        '''Copy the packet out of the buffer it was received into'''
+        if not isinstance(self._data, bytes):
+            self._data = bytes(self._data)
+
+    def _decode(self, i):
+        attr = self._decoded[i]
+        if attr is None:
+            (attr_ty, start, end) = self._spans[i]
+            attr = AttrFactory.get(attr_ty, UnknownAttr)._from_buffer(attr_ty, self._data[start:end])
+            self._decoded[i] = attr
+        return attr
+
+    def has(self, ty):
+        return ty.attr_ty in self._index
+
+    def find(self, ty):
+        ixs = self._index.get(ty.attr_ty)
+        if ixs is None:
+            return None
+        return self._decode(ixs[0])
+
+    def find_all(self, ty):
+        return [ self._decode(i) for i in self._index.get(ty.attr_ty, []) ]
+
+    def __len__(self):
+        return len(self._spans)
+
+    def __iter__(self):
+        return (self._decode(i) for i in range(len(self._spans)))
 
 def find_attr(attrs, ty):
+    if isinstance(attrs, KiteLocalReply) and hasattr(ty, 'attr_ty'):
+        return attrs.find(ty)
+
     for attr in attrs:
         if isinstance(attr, ty):
             return attr
     return None
 
+def _intern(value):
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+def _parse_version(version):
+    v = version.split('.')
+    if len(v) != 3:
+        return None
+
+    try:
+        return (int(v[0]), int(v[1]), int(v[2]),)
+    except ValueError:
+        return None
+
 class AppManifest(object):
-    __slots__ = ( 'name', 'domain', 'nix_closures',
-                  'run_as_admin', 'singleton', 'app_url',
-                  'icon', 'version' )
-    def __init__(self, json_data):
-        self.name = json_data['name']
-        self.domain = json_data['domain']
-        self.nix_closures = json_data['nix-closure']
+    '''An application manifest. Strings are interned, since the same
+    domains and URLs recur across manifests and lookups.
+
+    A compact manifest, as kept in memory for the catalog and the caches,
+    only keeps the nix closure of the appliance's system type. If the
+    system type is not known yet when the manifest is read, the closures
+    are kept until nix_closure is first used. A compact manifest's
+    nix_closures, and so to_dict(web_response=False), only hold that one
+    closure, so manifests that are handed back to applianced must not be
+    compact.
+    '''
+
+    __slots__ = ( 'name', 'domain', 'run_as_admin', 'singleton', 'app_url',
+                  'icon', 'version', 'version_info',
+                  '_compact', '_closures', '_system_type', '_closure', '_web_dict' )
+    def __init__(self, json_data, compact=False):
+        self.name = _intern(json_data['name'])
+        self.domain = _intern(json_data['domain'])
         self.run_as_admin = json_data.get('run-as-admin', False)
         self.singleton = json_data.get('singleton', False)
-        self.app_url = json_data.get('app-url')
+        self.app_url = _intern(json_data.get('app-url'))
+        self.icon = _intern(json_data.get('icon'))
+
         self.version = json_data.get('version', '0.0.0')
+        self.version_info = _parse_version(self.version)
         if self.version_info is None:
             self.version = "0.0.0"
-        self.icon = json_data.get('icon')
+            self.version_info = (0, 0, 0)
+        self.version = _intern(self.version)
+
+        self._compact = compact
+        self._closures = json_data['nix-closure']
+        self._system_type = None
+        self._closure = None
+        self._web_dict = None
+        if compact:
+            self._resolve_closure()
+
+    def _resolve_closure(self):
+        system_type = app.config.get('KITE_SYSTEM_TYPE')
+        if system_type is not None:
+            self._system_type = system_type
+            self._closure = _intern(self._closures.get(system_type))
+            if self._compact:
+                self._closures = None
+
+    @property
+    def web_dict(self):
+        '''What the web API returns for this manifest. Shared, so it must not
+        be modified'''
+        if self._web_dict is None:
+            self._web_dict = { 'name': self.name,
+                               'domain': self.domain,
+                               'app-url': self.app_url,
+                               'version': self.version,
+                               'icon': self.icon } # TODO return meta information
+        return self._web_dict
 
     def to_dict(self, web_response=True):
-        ret = { 'name': self.name,
-                'domain': self.domain,
-                'app-url': self.app_url,
-                'version': self.version,
-                'icon': self.icon } # TODO return meta information
+        ret = dict(self.web_dict)
         if not web_response:
             ret['nix-closure'] = self.nix_closures
             ret['run-as-admin'] = self.run_as_admin
@@ -496,19 +657,42 @@ class AppManifest(object):
         return ret
 
     @property
-    def version_info(self):
-        v = self.version.split('.')
-        if len(v) != 3:
-            return None
-
-        try:
-            return (int(v[0]), int(v[1]), int(v[2]),)
-        except ValueError:
-            return None
+    def nix_closures(self):
+        if self._closures is not None:
+            return dict(self._closures)
+        elif self._closure is None:
+            return {}
+        else:
+            return { self._system_type: self._closure }
 
     @property
     def nix_closure(self):
-        return self.nix_closures.get(app.config['KITE_SYSTEM_TYPE'])
+        if self._system_type is None:
+            self._resolve_closure()
+        return self._closure
+
+def read_manifest(appliance_dir, mf_name):
+    '''The AppManifest stored under mf_name in appliance_dir, or None'''
+    manifest = manifest_cache.get(mf_name)
+    if manifest is not MISSING:
+        return manifest
+
+    mf_path = os.path.join(appliance_dir, 'manifests', mf_name)
+    try:
+        with open(mf_path, 'rt') as mf:
+            manifest = AppManifest(json.load(mf), compact=True)
+    except FileNotFoundError:
+        return None
+
+    manifest_cache.put(mf_name, manifest)
+    return manifest
+
+def get_application_catalog(appliance_dir=None):
+    '''The catalog of the applications installed on the appliance. Needs
+    no connection to applianced'''
+    if appliance_dir is None:
+        appliance_dir = os.environ['KITE_APPLIANCE_DIR']
+    return application_catalog(appliance_dir, functools.partial(read_manifest, appliance_dir))
 
 class KiteNoPermError(Exception):
     status_code = 401
@@ -517,7 +701,22 @@ class KiteNoPermError(Exception):
         Exception.__init__(self)
         self.payload = "The admin application has been run without admin privileges"
 
-class KiteLocalApi(object):
+class KiteLocalProtocolError(OSError):
+    '''applianced sent a reply that could not be parsed. The connection
+    it came on is closed, since what follows on it cannot be trusted'''
+    pass
+
+class KiteLocalProtocol(object):
+    '''Everything about talking to applianced that does not depend on how
+    the socket is driven: building requests, interpreting replies and
+    reading the appliance directory. KiteLocalApi drives a blocking
+    socket, and AsyncKiteLocalApi (in .aio) an asyncio one.
+    '''
+
+    PIPE='pipe'
+    STDOUT='stdout'
+    INFER_SIGN = 'infer'
+
     def __init__(self, sockpath=None):
         if sockpath is None:
             if 'KITE_APPLIANCE_DIR' in os.environ:
@@ -526,45 +725,31 @@ class KiteLocalApi(object):
             else:
                 raise TypeError("expected 'sockpath' argument or 'KITE_APPLIANCE_DIR' environment variable")
 
-        self.socket = socket(AF_UNIX, SOCK_SEQPACKET, 0)
-        try:
-            self.socket.connect(sockpath)
-        except FileNotFoundError:
-            raise KiteNoPermError()
+        self.sockpath = sockpath
 
     def _write_request(self, req_type, flags, attrs):
-        hdr = struct.pack("!HH", req_type, flags)
+        req = bytearray(4 + sum(attr.packed_len() for attr in attrs))
+        _header.pack_into(req, 0, req_type, flags)
 
-        return hdr + b''.join([attr.pack() for attr in attrs])
+        offset = 4
+        for attr in attrs:
+            offset = attr.pack_into(req, offset)
 
-    def _receive_packet_with_flags(self):
-        pkt = self.socket.recv(0x1000)
+        return req
 
-        try:
-            (rspTy, rspFlags) = struct.unpack("!HH", pkt[:4])
-        except struct.error as e:
-            print(e)
-            return None
+    def _write_request_iov(self, req_type, flags, attrs):
+        '''Like _write_request, but returns the header and each attribute
+        as separate buffers, for sendmsg to gather without copying them
+        into one request first. Used for requests carrying many
+        attributes, such as run-in-app.
+        '''
+        iov = [ _header.pack(req_type, flags) ]
+        iov.extend(attr.encoded() for attr in attrs)
 
-        attrs_data = pkt[4:]
-        attrs = []
-        while len(attrs_data) > 0:
-            try:
-                (attr_ty, attr_len) = struct.unpack("!HH", attrs_data[:4])
-            except struct.error as e:
-                return None
-
-            attrs.append(AttrFactory.get(attr_ty, UnknownAttr)._from_buffer(attr_ty, attrs_data[4:attr_len]))
+        if len(iov) > IOV_MAX:
+            iov[IOV_MAX - 1:] = [ b''.join(iov[IOV_MAX - 1:]) ]
 
-            aligned_attr_len = 4 * ((attr_len + 3)//4)
-            attrs_data = attrs_data[aligned_attr_len:]
-
-        return (rspTy, rspFlags, attrs)
-
-    def _receive_packet(self):
-        (rspTy, _, attrs) = self._receive_packet_with_flags()
-
-        return (rspTy, attrs)
+        return iov
 
     def _get_response_code(self, attrs):
         response_attr = find_attr(attrs, KiteLocalAttrResponseCode)
@@ -573,30 +758,17 @@ class KiteLocalApi(object):
         return response_attr
 
     def _read_manifest(self, mf_name):
-        mf_path = os.path.join(self.appliance_dir, 'manifests', mf_name)
-        try:
-            with open(mf_path, 'rt') as mf:
-                return AppManifest(json.load(mf))
-        except FileNotFoundError:
-            return None
-
-    def _get_system_info(self):
-        req = self._write_request(0x0500, 0, [])
-
-        self.socket.send(req)
+        return read_manifest(self.appliance_dir, mf_name)
 
-        (pktTy, attrs) = self._receive_packet()
+    def _system_info_request(self):
+        return self._write_request(0x0500, 0, [])
 
+    def _parse_system_type(self, pktTy, attrs):
         response_attr = self._get_response_code(attrs)
         if response_attr.not_found:
-            return None
+            attrs = None
         elif not response_attr.success:
             raise ValueError("error getting system information: {}".format(response_attr.code))
-        else:
-            return attrs
-
-    def get_system_type(self):
-        attrs = self._get_system_info()
 
         host = find_attr(attrs, KiteLocalAttrSystemType)
         if host is None:
@@ -604,52 +776,83 @@ class KiteLocalApi(object):
 
         return host.system_type
 
-    def create_user(self, displayname=None, password=None, superuser=False):
-        req = self._write_request(0x0101, 0, [
+    def _create_user_request(self, displayname=None, password=None, superuser=False):
+        return self._write_request(0x0101, 0, [
             KiteLocalAttrPersonaDisplayName(displayname),
             KiteLocalAttrPersonaPassword(password)
         ] + ([ KiteLocalAttrPersonaFlags(is_superuser=True) ]
              if superuser else []))
 
-        self.socket.send(req)
-
-        (pktTy, attrs) = self._receive_packet()
-
+    def _parse_create_user(self, pktTy, attrs):
         persona_id = find_attr(attrs, KiteLocalAttrPersonaId)
         if persona_id is None:
             raise ValueError("No persona id in response")
 
         return persona_id.hex_str
 
-    def list_personas(self):
-        req = self._write_request(0x0100, 0, [ ])
-
-        self.socket.send(req)
-
-        ret = []
-
-        while True:
-            (pktTy, flags, attrs) = self._receive_packet_with_flags()
-
-            persona_id = find_attr(attrs, KiteLocalAttrPersonaId)
-            if persona_id is None:
-                if ( flags & KLM_IS_LAST ) > 0:
-                    break
-                raise ValueError("No persona id in response")
+    # These bump shared caches in Redis, so they block
+
+    def _personas_changed(self):
+        '''Call after any request that may have added, removed or modified
+        personas'''
+        persona_info_cache.clear()
+        shared_persona_info.bump()
+
+    def _applications_changed(self):
+        '''Call after any request that may have installed, updated or
+        removed applications'''
+        shared_application_info.bump()
+
+    def _persona_cache_key(self, persona_id):
+        if isinstance(persona_id, bytes):
+            return binascii.hexlify(persona_id[:32]).decode('ascii')
+        return persona_id.lower()
+
+    def _personas_generation(self):
+        '''Changes whenever any process changes the personas. Blocks to
+        ask Redis, at most every SharedCache.GENERATION_CHECK_INTERVAL'''
+        return shared_persona_info.generation()
+
+    def _cached_persona_info(self, persona_id, generation):
+        '''Returns the cached info for persona_id, which is None if the
+        persona was not found, or MISSING. Entries cached before the
+        personas last changed are not used.
+        '''
+        cached = persona_info_cache.get(self._persona_cache_key(persona_id),
+                                        valid=lambda entry: entry[0] == generation)
+        if cached is MISSING:
+            return MISSING
+
+        (_, info) = cached
+        return info
+
+    def _cache_persona_info(self, persona_id, info, generation):
+        if info is None:
+            (key, default) = PERSONA_NOT_FOUND_TTL
+            ttl = app.config.get(key, default)
+        else:
+            ttl = None
+        persona_info_cache.put(self._persona_cache_key(persona_id), (generation, info), ttl=ttl)
+        return info
 
-            ret.append(persona_id.hex_str)
+    def _list_personas_request(self):
+        return self._write_request(0x0100, 0, [ ])
 
+    def _parse_persona_list_entry(self, flags, attrs):
+        '''Returns the persona id in one packet of a persona list, or None
+        if the list ended without one'''
+        persona_id = find_attr(attrs, KiteLocalAttrPersonaId)
+        if persona_id is None:
             if ( flags & KLM_IS_LAST ) > 0:
-                break
-
-        return ret
+                return None
+            raise ValueError("No persona id in response")
 
-    def get_persona_info(self, persona_id):
-        req = self._write_request(0x0100, 0, [ KiteLocalAttrPersonaId(persona_id) ])
-        self.socket.send(req)
+        return persona_id.hex_str
 
-        (pktTy, attrs) = self._receive_packet()
+    def _persona_info_request(self, persona_id):
+        return self._write_request(0x0100, 0, [ KiteLocalAttrPersonaId(persona_id) ])
 
+    def _parse_persona_info(self, pktTy, attrs):
         if (pktTy & 0x8000) == 0:
             raise ValueError("Invalid reply received")
         else:
@@ -662,20 +865,20 @@ class KiteLocalApi(object):
             elif not response_attr.success:
                 raise ValueError("error looking up container: %d" % response_attr.code)
 
-            for attr in attrs:
-                if isinstance(attr, KiteLocalAttrPersonaDisplayName):
-                    persona["display_name"] = attr.name
-                elif isinstance(attr, KiteLocalAttrPersonaFlags):
-                    if attr.is_superuser:
-                        persona["superuser"] = True
+            display_name_attr = find_attr(attrs, KiteLocalAttrPersonaDisplayName)
+            if display_name_attr is not None:
+                persona["display_name"] = display_name_attr.name
+
+            flags_attr = find_attr(attrs, KiteLocalAttrPersonaFlags)
+            if flags_attr is not None and flags_attr.is_superuser:
+                persona["superuser"] = True
 
             return persona
 
-    def get_application_info(self, app_url):
-        req = self._write_request(0x0200, 0, [ KiteLocalAttrAppUrl(app_url) ])
-        self.socket.send(req)
-        (pktTy, attrs) = self._receive_packet()
+    def _application_info_request(self, app_url):
+        return self._write_request(0x0200, 0, [ KiteLocalAttrAppUrl(app_url) ])
 
+    def _parse_application_info(self, pktTy, attrs):
         if (pktTy & 0x8000) == 0:
             raise ValueError("Invalid reply received")
         else:
@@ -685,19 +888,21 @@ class KiteLocalApi(object):
             elif not response_attr.success:
                 raise ValueError("error looking up application: %d" % response_attr.code)
 
-            is_signed = find_attr(attrs, KiteLocalAttrSigned) is not None
+            is_signed = attrs.has(KiteLocalAttrSigned)
 
             manifest_name = find_attr(attrs, KiteLocalAttrManifest)
-            manifest = self._read_manifest(manifest_name.manifest)
-            if manifest is None:
-                return None
+            return self._application_info(manifest_name.manifest, is_signed)
 
-            return { 'is_signed': is_signed,
-                     'manifest_name': manifest_name,
-                     'manifest': manifest }
+    def _application_info(self, manifest_name, is_signed):
+        manifest = self._read_manifest(manifest_name)
+        if manifest is None:
+            return None
 
-    def get_application_status(self, appid):
-        state = self.get_application_info(appid)
+        return { 'is_signed': is_signed,
+                 'manifest_name': KiteLocalAttrManifest(manifest_name),
+                 'manifest': manifest }
+
+    def _application_status(self, state):
         if state is not None:
             ret = state['manifest'].to_dict()
             ret['is_signed'] = state['is_signed']
@@ -706,11 +911,10 @@ class KiteLocalApi(object):
         else:
             return None
 
-    def get_container_info(self, address):
-        req = self._write_request(0x0400, 0, [ KiteLocalAttrAddress(address) ])
-        self.socket.send(req)
-        (pktTy, attrs) = self._receive_packet()
+    def _container_info_request(self, address):
+        return self._write_request(0x0400, 0, [ KiteLocalAttrAddress(address) ])
 
+    def _parse_container_info(self, pktTy, attrs):
         if (pktTy & 0x8000) == 0:
             raise ValueError("Invalid reply received")
         else:
@@ -740,17 +944,10 @@ class KiteLocalApi(object):
                 if site_id_attr is not None:
                     ret['site_id'] = site_id_attr.canonical
 
-                logged_in_attr = find_attr(attrs, KiteLocalAttrSigned)
-                ret['logged_in'] = logged_in_attr is not None
-
-                guest_attr = find_attr(attrs, KiteLocalAttrGuest)
-                ret['is_guest'] = guest_attr is not None
-
-                tokens = ret['tokens'] = []
+                ret['logged_in'] = attrs.has(KiteLocalAttrSigned)
+                ret['is_guest'] = attrs.has(KiteLocalAttrGuest)
 
-                for attr in attrs:
-                    if isinstance(attr, KiteLocalAttrTokenId):
-                        tokens.append(attr.hex_str)
+                ret['tokens'] = [ attr.hex_str for attr in attrs.find_all(KiteLocalAttrTokenId) ]
 
                 return ret
             elif ty_attr.is_app_instance:
@@ -770,16 +967,42 @@ class KiteLocalApi(object):
 
             return None
 
-    def update_container(self, address, credential=None):
+    def _tokens_generation(self):
+        '''Changes whenever a token is saved, by any process'''
+        try:
+            return os.stat(os.path.join(self.appliance_dir, 'tokens')).st_mtime_ns
+        except (AttributeError, FileNotFoundError):
+            return None
+
+    def _cached_container_info(self, address):
+        '''Returns the cached info for the container at address, or
+        MISSING. Entries cached before the token list last changed are
+        not used.
+        '''
+        generation = self._tokens_generation()
+        cached = container_info_cache.get(address, valid=lambda entry: entry[0] == generation)
+        if cached is MISSING:
+            return MISSING
+
+        (_, info) = cached
+        return info
+
+    def _cache_container_info(self, address, info, generation):
+        # Logging in changes a container's info, and the login may be
+        # handled by another worker process, which could not invalidate
+        # this one's cache. Containers are only cached once logged in
+        if info is None or not info.get('logged_in', True):
+            return
+        container_info_cache.put(address, (generation, info))
+
+    def _update_container_request(self, address, credential=None):
         attrs = [ KiteLocalAttrAddress(address) ]
         if credential is not None:
             attrs.append(KiteLocalAttrCredential(credential))
 
-        req = self._write_request(0x0403, 0, attrs)
-        self.socket.send(req)
-
-        (pktTy, attrs) = self._receive_packet()
+        return self._write_request(0x0403, 0, attrs)
 
+    def _parse_update_container(self, pktTy, attrs):
         if ( pktTy & 0x8000 ) == 0:
             raise ValueError("Invalid reply received")
         else:
@@ -787,54 +1010,13 @@ class KiteLocalApi(object):
 
             return success_attr
 
-    def close(self):
-        self.socket.close()
+    def _run_in_app_request(self, ip_or_app_name, cmd, persona=None, stdin=None, stdout=None, stderr=None):
+        '''Build a run-in-app request.
 
-    def send_fds(self, req, fds=[]):
-        if len(fds) == 0:
-            self.socket.send(req)
-        else:
-            self.socket.sendmsg([req], [(SOL_SOCKET,
-                                         SCM_RIGHTS,
-                                         array.array('i', fds))])
-
-    @property
-    def tokens_dir(self):
-        tokens_dir = os.path.join(self.appliance_dir, 'tokens')
-        try:
-            os.makedirs(tokens_dir)
-        except FileExistsError:
-            pass
-        return tokens_dir
-
-    @property
-    def private_key_path(self):
-        return os.path.join(self.appliance_dir, 'key.pem')
-
-    @property
-    def private_key(self):
-        if hasattr(self, '_private_key'):
-            return self._private_key
-        else:
-            with open(self.private_key_path, 'rt') as private_key:
-                self._private_key = crypto.load_privatekey(crypto.FILETYPE_PEM,
-                                                           private_key.read())
-                return self._private_key
-
-    def get_applications(self):
-        with open(os.path.join(self.appliance_dir, 'apps'), 'rt') as apps_file:
-            for line in apps_file:
-                d = line.split()
-                if len(d) > 1:
-                    app_id = d[0]
-                    manifest_version = d[1]
-                    yield self._read_manifest(manifest_version)
-                else:
-                    continue
-
-    PIPE='pipe'
-    STDOUT='stdout'
-    def run_in_app(self, ip_or_app_name, cmd, persona=None, wait=False, stdin=None, stdout=None, stderr=None):
+        Returns the request, the file descriptors to send with it, and
+        the file descriptors of the local ends of any pipes requested
+        for stdin, stdout and stderr.
+        '''
         attrs = []
         fds = []
 
@@ -887,7 +1069,8 @@ class KiteLocalApi(object):
             try:
                 rfd_out, wfd_out = os.pipe()
             except:
-                map(os.close, close_fds)
+                for fd in close_fds:
+                    os.close(fd)
                 raise
 
             stdout = rfd_out
@@ -900,7 +1083,7 @@ class KiteLocalApi(object):
         elif hasattr(stdout, 'fileno') and isinstance(stdout.fileno, Callable):
             attrs.append(KiteLocalAttrStdout(len(fds)))
             stdout_fileno = len(fds)
-            fds.append(stdout_fileno)
+            fds.append(stdout.fileno())
             stdout = None
         elif stdout is not None:
             raise ValueError("Expected file-like object or PIPE for stdout")
@@ -909,7 +1092,8 @@ class KiteLocalApi(object):
             try:
                 rfd_err, wfd_err = os.pipe()
             except:
-                map(os.close, close_fds)
+                for fd in close_fds:
+                    os.close(fd)
                 raise
 
             stderr = rfd_err
@@ -929,21 +1113,24 @@ class KiteLocalApi(object):
 
             stderr = None
 
-            attrs.append(KiteLocalAttrStderr(stdout_filenO))
+            attrs.append(KiteLocalAttrStderr(stdout_fileno))
 
-        req = self._write_request(0x0405, 0, attrs)
+        req = self._write_request_iov(0x0405, 0, attrs)
 
-        self.send_fds(req, fds=fds)
+        return req, fds, close_fds, (stdin, stdout, stderr)
 
-        for fd in close_fds:
-            if fd not in (stdin, stdout, stderr):
-                os.close(fd)
-
-        return ContainerProcess(self, stdin=stdin, stdout=stdout, stderr=stderr)
-
-    def _run_in_app_complete(self):
-        (pktTy, attrs) = self._receive_packet()
+    def _process_label(self, ip_or_app_name):
+        '''The application a run-in-app request runs in, for metrics'''
+        try:
+            ipaddress.ip_address(ip_or_app_name)
+            return 'container'
+        except ValueError:
+            res = urlparse(ip_or_app_name)
+            if res.scheme == 'kite+app':
+                return res.hostname
+            return ip_or_app_name
 
+    def _parse_run_in_app_complete(self, pktTy, attrs):
         response_attr = find_attr(attrs, KiteLocalAttrResponseCode)
         if response_attr is None:
             return 'internal-error', -1
@@ -958,35 +1145,399 @@ class KiteLocalApi(object):
         else:
             return 'server-error', -1
 
-    INFER_SIGN = 'infer'
-    def register_application(self, manifest_path, progress=None, signature_path=None):
+    def _register_application_request(self, manifest_path, with_progress=False, signature_path=None):
         progress_attr = []
         sign_attr = []
-        progress_fds = []
 
-        if progress is not None:
-            rfd, wfd = os.pipe()
+        if with_progress:
             progress_attr = [ KiteLocalAttrStdout(0) ]
-            progress_fds = [ wfd ]
 
         if signature_path is not None and signature_path != self.INFER_SIGN:
             sign_attr = [ KiteLocalAttrSignatureUrl(signature_path) ]
         elif signature_path is None:
             sign_attr = [ KiteLocalAttrSignatureUrl("") ]
 
-        req = self._write_request(0x0201, 0,
-                                  [ KiteLocalAttrManifestUrl(manifest_path) ] +
-                                  sign_attr +
-                                  progress_attr)
+        return self._write_request_iov(0x0201, 0,
+                                       [ KiteLocalAttrManifestUrl(manifest_path) ] +
+                                       sign_attr +
+                                       progress_attr)
 
-        self.send_fds(req, fds=progress_fds)
+    def _handle_progress(self, buf, progress):
+        '''Report every complete line of installation progress in buf.
 
+        Returns what is left of buf, and the error message if the
+        installer reported one.
+        '''
         error = None
-        buf = ''
+        while '\n' in buf:
+            (line, _, buf) = buf.partition('\n')
+            if line.startswith('error'):
+                (_, _, msg) = line.partition(' ')
+                error = msg
+                break
+            else:
+                (complete, _, rest) = line.partition(' ')
+                (total, _, msg) = rest.partition(' ')
+                if complete == 'error':
+                    raise KiteAppInstallationError(rest)
+                progress(msg, int(complete), int(total))
+        return buf, error
+
+    def _parse_register_application(self, pktTy, attrs, error=None):
+        if error is not None:
+            raise KiteAppFetchError(error)
+
+        response_attr = self._get_response_code(attrs)
+        if not response_attr.success:
+            raise ValueError("error getting app info: {}".format(response_attr.code))
+
+    @property
+    def tokens_dir(self):
+        tokens_dir = os.path.join(self.appliance_dir, 'tokens')
+        try:
+            os.makedirs(tokens_dir)
+        except FileExistsError:
+            pass
+        return tokens_dir
+
+    @property
+    def private_key_path(self):
+        return os.path.join(self.appliance_dir, 'key.pem')
+
+    @property
+    def private_key(self):
+        if hasattr(self, '_private_key'):
+            return self._private_key
+        else:
+            with open(self.private_key_path, 'rt') as private_key:
+                self._private_key = crypto.load_privatekey(crypto.FILETYPE_PEM,
+                                                           private_key.read())
+                return self._private_key
+
+    @property
+    def application_catalog(self):
+        return get_application_catalog(self.appliance_dir)
+
+    def get_applications(self):
+        return iter(self.application_catalog.manifests)
+
+    def open_token(self, name):
+        try:
+            with open(os.path.join(self.appliance_dir, 'tokens', name), 'rt') as token_file:
+                return json.load(token_file)
+        except FileNotFoundError:
+            return None
+
+class KiteLocalApi(KiteLocalProtocol):
+    RECEIVE_BUFFER_SIZE = 0x1000
+
+    def __init__(self, sockpath=None):
+        super(KiteLocalApi, self).__init__(sockpath)
+
+        self.socket = None
+        self._outstanding = 0
+        self._in_flight = deque()
+        self._memo = None
+
+        self._rx_buffer = bytearray(self.RECEIVE_BUFFER_SIZE)
+        self._rx_view = memoryview(self._rx_buffer)
+        self._last_reply = None
+
+        self.connect()
+
+    def connect(self):
+        if self.socket is not None:
+            self.socket.close()
+        self._abandon_in_flight()
+
+        self.socket = socket(AF_UNIX, SOCK_SEQPACKET, 0)
+        self._outstanding = 0
+        try:
+            self.socket.connect(self.sockpath)
+        except FileNotFoundError:
+            self.socket.close()
+            raise KiteNoPermError()
+
+    @property
+    def is_healthy(self):
+        '''Whether this connection can be handed out again.
+
+        Anything readable on an idle connection means it cannot be
+        reused: either an earlier exchange was abandoned half-way, or
+        applianced hung up (for example, because it restarted).
+        '''
+        if self.socket is None or self.socket.fileno() < 0 or \
+           self._outstanding != 0:
+            return False
+
+        try:
+            (r, _, x) = select.select([self.socket], [], [self.socket], 0)
+        except (OSError, ValueError):
+            return False
+
+        return len(r) == 0 and len(x) == 0
+
+    def _send(self, req, fds=[]):
+        '''Send a request, built by _write_request or _write_request_iov'''
+        iov = req if isinstance(req, list) else [ req ]
+
+        if len(fds) == 0 and len(iov) == 1:
+            self.socket.send(iov[0])
+        elif len(fds) == 0:
+            self.socket.sendmsg(iov)
+        else:
+            self.socket.sendmsg(iov, [(SOL_SOCKET,
+                                       SCM_RIGHTS,
+                                       array.array('i', fds))])
+        self._outstanding += 1
+
+        (req_ty, _) = _header.unpack_from(iov[0], 0)
+        opcode = metrics.opcode_label(req_ty)
+        metrics.applianced_requests.inc(opcode)
+        metrics.applianced_bytes_sent.inc(opcode, amount=sum(len(buf) for buf in iov))
+        self._in_flight.append((opcode, time.monotonic()))
+
+    def _abandon_in_flight(self):
+        while len(self._in_flight) > 0:
+            (opcode, _) = self._in_flight.popleft()
+            metrics.applianced_errors.inc(opcode)
+
+    def _receive_into_buffer(self):
+        '''Receive the next packet into this connection's receive buffer.
+
+        Returns a memoryview of the packet, which is only valid until
+        the next packet is received.
+        '''
+        # Replies decode lazily out of this buffer. If the last one is
+        # still in use, give it its own copy before overwriting it
+        last_reply = self._last_reply() if self._last_reply is not None else None
+        if last_reply is not None:
+            last_reply._detach()
+        self._last_reply = None
+
+        # Peek first, so that we learn the full size of packets that do
+        # not fit and can grow the buffer instead of truncating them
+        pkt_len = self.socket.recv_into(self._rx_view, len(self._rx_buffer),
+                                        MSG_PEEK | MSG_TRUNC)
+        if pkt_len > len(self._rx_buffer):
+            self._rx_buffer = bytearray(pkt_len)
+            self._rx_view = memoryview(self._rx_buffer)
+
+        pkt_len = self.socket.recv_into(self._rx_view, len(self._rx_buffer))
+        return self._rx_view[:pkt_len]
+
+    def _malformed_reply(self, pkt):
+        logging.exception("Malformed reply from applianced (%d bytes)", len(pkt))
+        self.close()
+        return KiteLocalProtocolError("Malformed reply from applianced")
+
+    def _receive_packet_with_flags(self, streaming=False):
+        pkt = self._receive_into_buffer()
+
+        try:
+            (rspTy, rspFlags) = _header.unpack_from(pkt, 0)
+        except struct.error:
+            raise self._malformed_reply(pkt)
+
+        if len(self._in_flight) > 0:
+            (opcode, started) = self._in_flight[0]
+            metrics.applianced_bytes_received.inc(opcode, amount=len(pkt))
+
+        if not streaming or (rspFlags & KLM_IS_LAST) > 0:
+            self._outstanding -= 1
+
+            if len(self._in_flight) > 0:
+                self._in_flight.popleft()
+                metrics.applianced_latency.observe(time.monotonic() - started, opcode)
+
+        try:
+            reply = KiteLocalReply(pkt)
+        except struct.error:
+            raise self._malformed_reply(pkt)
 
-        set_nonblocking(rfd)
+        self._last_reply = weakref.ref(reply)
+
+        return (rspTy, rspFlags, reply)
+
+    def _receive_packet(self):
+        (rspTy, _, attrs) = self._receive_packet_with_flags()
+
+        return (rspTy, attrs)
+
+    def get_system_type(self):
+        self._send(self._system_info_request())
+        return self._parse_system_type(*self._receive_packet())
+
+    def create_user(self, displayname=None, password=None, superuser=False):
+        self._forget('persona')
+        self._send(self._create_user_request(displayname=displayname, password=password,
+                                             superuser=superuser))
+        reply = self._receive_packet()
+        self._personas_changed()
+        return self._parse_create_user(*reply)
+
+    def iter_personas(self):
+        '''Yield persona ids as applianced streams them.
+
+        The generator may be closed early. Rather than reading the rest
+        of the list, which may be long, off the connection, the
+        connection is then replaced by a new one. Do not send other
+        requests while it is open.
+        '''
+        self._send(self._list_personas_request())
+
+        done = False
+        try:
+            while not done:
+                (pktTy, flags, attrs) = self._receive_packet_with_flags(streaming=True)
+                done = ( flags & KLM_IS_LAST ) > 0
+
+                persona_id = self._parse_persona_list_entry(flags, attrs)
+                if persona_id is not None:
+                    yield persona_id
+        finally:
+            # Unless the connection was closed on a malformed reply
+            if not done and self.socket is not None:
+                self._in_flight.clear()
+                self.connect()
+
+    def list_personas(self):
+        return list(self.iter_personas())
+
+    def pipeline(self, depth=None):
+        return KiteLocalPipeline(self, depth=depth)
+
+    # Lookups go through a pipeline even when there is only one, since
+    # that is where the request memo and the caches are consulted
+
+    def get_persona_info(self, persona_id):
+        pipeline = self.pipeline()
+        pipeline.get_persona_info(persona_id)
+        return pipeline.execute()[0]
+
+    def get_persona_infos(self, persona_ids):
+        '''Look up several personas in one pipelined batch. Only the
+        personas that are not memoized or cached are sent to applianced.
+
+        Returns a list of results, in the same order as persona_ids
+        '''
+        pipeline = self.pipeline()
+        for persona_id in persona_ids:
+            pipeline.get_persona_info(persona_id)
+        return pipeline.execute()
+
+    def get_application_info(self, app_url):
+        pipeline = self.pipeline()
+        pipeline.get_application_info(app_url)
+        return pipeline.execute()[0]
+
+    def get_application_infos(self, app_urls):
+        '''Look up several applications in one pipelined batch.
+
+        Returns a list of results, in the same order as app_urls
+        '''
+        pipeline = self.pipeline()
+        for app_url in app_urls:
+            pipeline.get_application_info(app_url)
+        return pipeline.execute()
+
+    def get_application_status(self, appid):
+        return self._application_status(self.get_application_info(appid))
+
+    def get_container_info(self, address):
+        pipeline = self.pipeline()
+        pipeline.get_container_info(address)
+        return pipeline.execute()[0]
+
+    def get_container_infos(self, addresses):
+        '''Look up several containers in one pipelined batch.
+
+        Returns a list of results, in the same order as addresses
+        '''
+        pipeline = self.pipeline()
+        for address in addresses:
+            pipeline.get_container_info(address)
+        return pipeline.execute()
+
+    def update_container(self, address, credential=None):
+        container_info_cache.invalidate(address)
+        self._forget('container', address)
+
+        self._send(self._update_container_request(address, credential=credential))
+        return self._parse_update_container(*self._receive_packet())
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        self._abandon_in_flight()
+
+    # While the connection is borrowed during a Flask request, _memo is
+    # shared by every connection that request borrows. It holds the
+    # answers to lookups made so far, which are not asked again
+
+    def _recall(self, kind, key):
+        if self._memo is None:
+            return MISSING
+
+        value = self._memo.get((kind, key), MISSING)
+        if value is MISSING:
+            return MISSING
+        return copy.copy(value)
+
+    def _memoize(self, kind, key, value):
+        if self._memo is not None:
+            self._memo[(kind, key)] = copy.copy(value)
+        return value
+
+    def _forget(self, kind, key=MISSING):
+        if self._memo is not None:
+            for memo_key in list(self._memo):
+                if memo_key[0] == kind and (key is MISSING or memo_key[1] == key):
+                    del self._memo[memo_key]
+
+    def send_fds(self, req, fds=[]):
+        self._send(req, fds=fds)
+
+    def run_in_app(self, ip_or_app_name, cmd, persona=None, wait=False, stdin=None, stdout=None, stderr=None):
+        (req, fds, close_fds, (stdin, stdout, stderr)) = \
+            self._run_in_app_request(ip_or_app_name, cmd, persona=persona,
+                                     stdin=stdin, stdout=stdout, stderr=stderr)
+
+        self.send_fds(req, fds=fds)
+
+        for fd in close_fds:
+            if fd not in (stdin, stdout, stderr):
+                os.close(fd)
+
+        return ContainerProcess(self, stdin=stdin, stdout=stdout, stderr=stderr,
+                                app=self._process_label(ip_or_app_name))
+
+    def _run_in_app_complete(self):
+        return self._parse_run_in_app_complete(*self._receive_packet())
+
+    def register_application(self, manifest_path, progress=None, signature_path=None):
+        progress_fds = []
+
+        if progress is not None:
+            rfd, wfd = os.pipe()
+            progress_fds = [ wfd ]
+
+        req = self._register_application_request(manifest_path, with_progress=progress is not None,
+                                                 signature_path=signature_path)
+
+        try:
+            self.send_fds(req, fds=progress_fds)
+        finally:
+            for fd in progress_fds:
+                os.close(fd)
+
+        error = None
+        buf = ''
 
         if progress is not None:
+            set_nonblocking(rfd)
+
             # Read in the entirety of the output
             try:
                 while True:
@@ -1002,44 +1553,329 @@ class KiteLocalApi(object):
                         if len(next_chunk) == 0:
                             break
                         buf += next_chunk
-                        while '\n' in buf:
-                            (line, _, buf) = buf.partition('\n')
-                            if line.startswith('error'):
-                                (_, _, msg) = line.partition(' ')
-                                error = msg
-                                break
-                            else:
-                                (complete, _, rest) = line.partition(' ')
-                                (total, _, msg) = rest.partition(' ')
-                                if complete == 'error':
-                                    raise KiteAppInstallationError(rest)
-                                progress(msg, int(complete), int(total))
+                        (buf, chunk_error) = self._handle_progress(buf, progress)
+                        if chunk_error is not None:
+                            error = chunk_error
             finally:
                 os.close(rfd)
 
-        (pktTy, attrs) = self._receive_packet()
+        self._forget('application')
+        reply = self._receive_packet()
+        self._applications_changed()
+        self._parse_register_application(*reply, error=error)
+
+class KiteLocalPipeline(object):
+    '''Sends several requests to applianced without waiting for each reply.
+
+    applianced answers requests on a connection in the order they were
+    sent (the protocol has no request ids), so replies are matched to
+    requests by position. At most depth requests are in flight at
+    once, so that neither side can fill the socket buffers and stall.
+
+    Only requests with exactly one reply packet can be pipelined.
+    '''
+
+    DEFAULT_DEPTH = 16
+
+    def __init__(self, api, depth=None):
+        self.api = api
+        self.depth = depth if depth is not None else self.DEFAULT_DEPTH
+        self._queued = []
+        self._shares = {}
+
+    def __len__(self):
+        return len(self._queued)
+
+    def _queue(self, req, parse, shared=None):
+        '''Queue a request. parse turns its reply into the result.
+
+        shared, if given, is a (SharedCache, key, resolve) tuple. The
+        request is then only sent if the shared cache has nothing for
+        key, and otherwise resolve turns the shared value into the
+        result.
+        '''
+        self._queued.append((req, parse, None, shared))
+        return len(self._queued) - 1
+
+    def _known(self, value):
+        '''Queue a result that is already known, without a request'''
+        self._queued.append((None, None, value, None))
+        return len(self._queued) - 1
+
+    def _share(self, cache, key, value, ttl=None):
+        '''Store a fresh answer in a shared cache, once all replies are in'''
+        self._shares.setdefault(cache, []).append((key, value, ttl))
+
+    def get_persona_info(self, persona_id):
+        api = self.api
+        key = api._persona_cache_key(persona_id)
+
+        info = api._recall('persona', key)
+        generation = None
+        if info is MISSING:
+            generation = api._personas_generation()
+            info = api._cached_persona_info(persona_id, generation)
+            if info is not MISSING:
+                api._memoize('persona', key, info)
+        if info is not MISSING:
+            return self._known(info)
+
+        def resolve(info):
+            api._cache_persona_info(persona_id, info, generation)
+            return api._memoize('persona', key, info)
+
+        def parse(pktTy, attrs):
+            info = api._parse_persona_info(pktTy, attrs)
+            self._share(shared_persona_info, key, info,
+                        ttl=PERSONA_NOT_FOUND_TTL if info is None else None)
+            return resolve(info)
+
+        return self._queue(api._persona_info_request(persona_id), parse,
+                           shared=(shared_persona_info, key, resolve))
+
+    def get_application_info(self, app_url):
+        api = self.api
+
+        info = api._recall('application', app_url)
+        if info is not MISSING:
+            return self._known(info)
+
+        def resolve(shared):
+            (manifest_name, is_signed) = shared
+            return api._memoize('application', app_url,
+                                api._application_info(manifest_name, is_signed))
+
+        def parse(pktTy, attrs):
+            info = api._parse_application_info(pktTy, attrs)
+            if info is not None:
+                self._share(shared_application_info, app_url,
+                            [ info['manifest_name'].manifest, info['is_signed'] ])
+            return api._memoize('application', app_url, info)
+
+        return self._queue(api._application_info_request(app_url), parse,
+                           shared=(shared_application_info, app_url, resolve))
+
+    def get_container_info(self, address):
+        api = self.api
+
+        info = api._recall('container', address)
+        if info is MISSING:
+            info = api._cached_container_info(address)
+            if info is not MISSING:
+                api._memoize('container', address, info)
+        if info is not MISSING:
+            return self._known(info)
+
+        generation = api._tokens_generation()
+        def parse(pktTy, attrs):
+            info = api._parse_container_info(pktTy, attrs)
+            api._cache_container_info(address, info, generation)
+            return api._memoize('container', address, info)
+        return self._queue(api._container_info_request(address), parse)
+
+    def _resolve_shared(self, queued, results):
+        '''Resolve the queued requests the shared caches can answer, in
+        one round trip per cache. Returns the indices of the rest.'''
+        by_cache = {}
+        for ix, (req, _, _, shared) in enumerate(queued):
+            if req is not None and shared is not None:
+                by_cache.setdefault(shared[0], []).append(ix)
+
+        resolved = set()
+        for cache, ixs in by_cache.items():
+            values = cache.get_many([ queued[ix][3][1] for ix in ixs ])
+            for ix, value in zip(ixs, values):
+                if value is not MISSING:
+                    results[ix] = queued[ix][3][2](value)
+                    resolved.add(ix)
+
+        return [ ix for ix, (req, _, _, _) in enumerate(queued)
+                 if req is not None and ix not in resolved ]
+
+    def execute(self):
+        '''Send all queued requests and return their results, in order.
+
+        If any reply cannot be parsed, the remaining replies are still
+        read, so the connection can be reused, before the first error
+        is raised.
+        '''
+        queued, self._queued = self._queued, []
+        self._shares = {}
+
+        results = [ value for (_, _, value, _) in queued ]
+        requests = self._resolve_shared(queued, results)
+
+        error = None
+        sent = 0
+        received = 0
+
+        while received < len(requests):
+            while sent < len(requests) and sent - received < self.depth:
+                self.api._send(queued[requests[sent]][0])
+                sent += 1
+
+            ix = requests[received]
+            received += 1
+            try:
+                results[ix] = queued[ix][1](*self.api._receive_packet())
+            except ValueError as e:
+                if error is None:
+                    error = e
+
+        for cache, items in self._shares.items():
+            cache.put_many(items)
 
         if error is not None:
-            raise KiteAppFetchError(error)
+            raise error
+
+        return results
+
+class KiteLocalApiPool(object):
+    '''Per-process pool of applianced connections.
+
+    At most max_size idle connections are kept. Connections are health
+    checked when they are borrowed, so connections dropped by an
+    applianced restart are replaced transparently. When more
+    connections are borrowed at once than the pool holds, extra ones
+    are opened and closed again on release, rather than blocking (a
+    request may borrow more than one connection, e.g. through nested
+    local_api() calls).
+
+    Connections are never shared across fork(). A pool used in a
+    forked child (e.g. a uwsgi worker forked after the app was
+    imported) drops everything it inherited from its parent.
+    '''
+
+    DEFAULT_SIZE = 4
+
+    def __init__(self, max_size=None, factory=KiteLocalApi):
+        self._max_size = max_size
+        self._factory = factory
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            # The parent still owns these sockets. Closing our copies
+            # does not affect it
+            inherited = self._idle
+            self._reset()
+            for api in inherited:
+                api.close()
 
-        response_attr = self._get_response_code(attrs)
-        if not response_attr.success:
-            raise ValueError("error getting app info: {}".format(response_attr.code))
+    @property
+    def max_size(self):
+        if self._max_size is None:
+            return app.config.get('KITE_LOCAL_API_POOL_SIZE', self.DEFAULT_SIZE)
+        return self._max_size
 
-    def open_token(self, name):
-        try:
-            with open(os.path.join(self.appliance_dir, 'tokens', name), 'rt') as token_file:
-                return json.load(token_file)
-        except FileNotFoundError:
-            return None
+    def acquire(self):
+        self._check_fork()
+
+        while True:
+            with self._lock:
+                if len(self._idle) == 0:
+                    break
+                api = self._idle.pop()
+
+            if api.is_healthy:
+                return api
+            else:
+                api.close()
+
+        return self._factory()
+
+    def release(self, api, discard=False):
+        self._check_fork()
+
+        if discard or api.socket is None or api._outstanding != 0:
+            api.close()
+            return
+
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append(api)
+                return
+
+        api.close()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for api in idle:
+            api.close()
+
+api_pool = KiteLocalApiPool()
 
 @contextmanager
 def local_api():
-    r = KiteLocalApi()
+    r = api_pool.acquire()
+    if has_request_context():
+        r._memo = g.setdefault('kite_local_api_memo', {})
+
     try:
         yield r
-    finally:
-        r.close()
+    except OSError:
+        r._memo = None
+        api_pool.release(r, discard=True)
+        raise
+    except:
+        r._memo = None
+        api_pool.release(r)
+        raise
+    else:
+        r._memo = None
+        api_pool.release(r)
+
+_fan_out_lock = threading.Lock()
+_fan_out_executor = None
+_fan_out_pid = None
+
+def _get_fan_out_executor():
+    global _fan_out_executor, _fan_out_pid
+    with _fan_out_lock:
+        # Threads do not survive fork(), so children start their own
+        if _fan_out_executor is None or _fan_out_pid != os.getpid():
+            _fan_out_executor = ThreadPoolExecutor(
+                max_workers=app.config.get('KITE_FAN_OUT_WORKERS', 8),
+                thread_name_prefix='kite-fan-out')
+            _fan_out_pid = os.getpid()
+        return _fan_out_executor
+
+def fan_out(fn, items, api=None):
+    '''Call fn(api, item) for each of items concurrently, on a bounded
+    thread pool, each call with its own connection from local_api().
+    Returns the results in the order of items. If calls raise, the
+    exception of the first of them in that order is raised, once every
+    call is done.
+
+    With a single item, fn is called right away, with api if given.
+    Otherwise the connections share the request memo of api, since the
+    worker threads have no request context of their own.
+    '''
+    items = list(items)
+    if len(items) == 1 and api is not None:
+        return [ fn(api, items[0]) ]
+
+    memo = api._memo if api is not None else None
+
+    def run(item):
+        with local_api() as item_api:
+            if memo is not None:
+                item_api._memo = memo
+            return fn(item_api, item)
+
+    if len(items) <= 1:
+        return [ run(item) for item in items ]
+
+    executor = _get_fan_out_executor()
+    futures = [ executor.submit(run, item) for item in items ]
+    wait_futures(futures)
+    return [ future.result() for future in futures ]
 
 def request_source():
     return request.headers.get('X-Kite-Admin-Source', 'kite-proxy')
@@ -1143,7 +1979,7 @@ def require_superuser(*args, **kwargs):
         return _wrapped
 
 class ContainerProcess(object):
-    def __init__(self, api, stdin=None, stdout=None, stderr=None):
+    def __init__(self, api, stdin=None, stdout=None, stderr=None, app='container'):
         self.api = api
         self.stdin = stdin
         self.stdout = stdout
@@ -1153,13 +1989,20 @@ class ContainerProcess(object):
         self.returncode = None
         self.pid = None
 
+        self.app = app
+        self._started = time.monotonic()
+
+    def _complete(self):
+        self.status, self.returncode = self.api._run_in_app_complete()
+        metrics.container_process_duration.observe(time.monotonic() - self._started, self.app)
+
     def _poll(self, timeout=None):
         args = [ [self.api.socket], [], [] ]
         if timeout is not None:
             args.append(timeout)
         (r, _, x) = select.select(*args)
         if self.api.socket in r:
-            self.status, self.returncode = self._run_in_app_complete()
+            self._complete()
 
         if self.api.socket in x:
             r.status = 'internal-error'
@@ -1229,7 +2072,7 @@ class ContainerProcess(object):
                     self.stderr = None
 
             if self.api.socket in r:
-                self.status, self.returncode = self.api._run_in_app_complete()
+                self._complete()
                 complete = True
                 self.stdin = None
 
@@ -0,0 +1,408 @@
+'''Caches for answers from applianced and for appliance files.
+
+Every worker process has its own TTLCaches. Unless they hold immutable
+values, cached values are copied on the way in and out, since callers
+are free to modify what they get. SharedCaches are shared by all
+processes through Redis.
+'''
+
+from collections import OrderedDict
+from redis.exceptions import RedisError
+import threading
+import logging
+import json
+import copy
+import time
+
+from .app import app, redis_connection
+from . import metrics
+
+MISSING = object()
+
+def _config_ttl(ttl):
+    '''ttl is either seconds, or the app.config key to read them from and
+    their default, as a (key, default) tuple'''
+    if isinstance(ttl, tuple):
+        (key, default) = ttl
+        return app.config.get(key, default)
+    return ttl
+
+class TTLCache(object):
+    '''A thread-safe cache whose entries expire ttl seconds after they
+    are stored.
+
+    :param name Name of the cache in metrics
+    :param ttl Seconds entries live, or the app.config key to read them
+               from and their default, as a (key, default) tuple
+    :param max_size Number of entries kept before the least recently
+                    used is evicted
+    :param copy_values Whether values are copied. Only turn this off for
+                       values nobody modifies
+    '''
+
+    def __init__(self, name, ttl, max_size=1024, copy_values=True, clock=time.monotonic):
+        self.name = name
+        self._ttl = ttl
+        self.max_size = max_size
+        self.copy_values = copy_values
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    @property
+    def ttl(self):
+        return _config_ttl(self._ttl)
+
+    def _count(self, result):
+        metrics.cache_requests.inc(self.name, result)
+
+    def get(self, key, valid=None):
+        '''Returns the value cached for key, or MISSING. If given, valid is
+        called with the cached value, and the entry is dropped unless it
+        returns True.
+        '''
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                (expires, value) = entry
+                if expires > now and (valid is None or valid(value)):
+                    self._entries.move_to_end(key)
+                else:
+                    del self._entries[key]
+                    entry = None
+
+        if entry is None:
+            self._count('miss')
+            return MISSING
+
+        self._count('hit')
+        return copy.deepcopy(value) if self.copy_values else value
+
+    def put(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else _config_ttl(ttl)
+        if ttl <= 0:
+            return
+
+        if self.copy_values:
+            value = copy.deepcopy(value)
+        with self._lock:
+            self._entries[key] = (self.clock() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._count('eviction')
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+        self._count('invalidation')
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        self._count('invalidation')
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    @property
+    def stats(self):
+        return { result: metrics.cache_requests.get(self.name, result)
+                 for result in ('hit', 'miss', 'eviction', 'invalidation') }
+
+container_info_cache = TTLCache('container_info', ('KITE_CONTAINER_INFO_TTL', 2))
+
+# Manifests are named by the sha256 of their contents, so they never
+# change, and AppManifests are not modified once read
+manifest_cache = TTLCache('manifest', float('inf'), max_size=256, copy_values=False)
+
+# Compiled permissions.json of application closures, which never change
+permission_index_cache = TTLCache('permission_index', float('inf'), max_size=256,
+                                  copy_values=False)
+
+# PermSecurity by (application, manifest name, permission, persona).
+# Static permissions are stored with no persona, and are kept as long
+# as there is room, since a new manifest means new keys. Dynamic ones
+# are kept for as long as the application's helper says, or
+# DYNAMIC_PERM_SECURITY_TTL
+perm_security_cache = TTLCache('perm_security', float('inf'), max_size=4096)
+DYNAMIC_PERM_SECURITY_TTL = ('KITE_DYNAMIC_PERM_SECURITY_TTL', 0)
+
+# Persona ids that were not found are cached too, for a shorter time.
+# Entries are kept with the generation of shared_persona_info they were
+# fetched in, and are not used once another process bumps it
+persona_info_cache = TTLCache('persona_info', ('KITE_PERSONA_INFO_TTL', 60))
+PERSONA_NOT_FOUND_TTL = ('KITE_PERSONA_NOT_FOUND_TTL', 5)
+
+class RevalidatingCache(object):
+    '''Keeps the last value fetched for each key, to serve while a new
+    one is fetched in the background (stale-while-revalidate).
+
+    get() returns values fetched less than fresh_ttl seconds ago as they
+    are. Older values, up to max_stale seconds old, are returned at once
+    but marked stale, and fetched again in a background thread. Keys with
+    no value, or one older than that, are fetched in the caller's thread.
+
+    :param fetch Called with a key, from any thread, to get its value
+    :param fresh_ttl Seconds values are fresh, as for TTLCache
+    :param max_stale Seconds after which values are not served at all
+    '''
+
+    def __init__(self, name, fetch, fresh_ttl, max_stale=('KITE_STALE_MAX_AGE', 300),
+                 max_size=1024, clock=time.monotonic):
+        self.name = name
+        self.fetch = fetch
+        self._fresh_ttl = fresh_ttl
+        self._max_stale = max_stale
+        self.max_size = max_size
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._revalidating = set()
+
+    def _count(self, result):
+        metrics.cache_requests.inc(self.name, result)
+
+    def get(self, key):
+        '''Returns the value of key, and whether it is stale'''
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        if entry is not None:
+            (fetched_at, value) = entry
+            age = now - fetched_at
+            if age < _config_ttl(self._fresh_ttl):
+                self._count('hit')
+                return (copy.deepcopy(value), False)
+            elif age < _config_ttl(self._max_stale):
+                self._count('stale')
+                self._revalidate(key)
+                return (copy.deepcopy(value), True)
+
+        self._count('miss')
+        return (self._fetch(key), False)
+
+    def _fetch(self, key):
+        value = self.fetch(key)
+        with self._lock:
+            self._entries[key] = (self.clock(), copy.deepcopy(value))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._count('eviction')
+        return value
+
+    def _revalidate(self, key):
+        with self._lock:
+            if key in self._revalidating:
+                return
+            self._revalidating.add(key)
+
+        thread = threading.Thread(target=self._revalidate_in_background, args=(key,),
+                                  name='revalidate-{}'.format(self.name), daemon=True)
+        thread.start()
+
+    def _revalidate_in_background(self, key):
+        try:
+            self._fetch(key)
+        except Exception:
+            logging.exception("Could not revalidate %s %r", self.name, key)
+        finally:
+            with self._lock:
+                self._revalidating.discard(key)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+        self._count('invalidation')
+
+class SharedCache(object):
+    '''A cache shared by every worker process, and the Celery worker,
+    through Redis.
+
+    Entries are stored under the namespace's current generation.
+    bump() starts a new generation, so that every process stops using
+    the entries stored before it. Processes check for a new generation
+    at most every GENERATION_CHECK_INTERVAL seconds.
+
+    Values are stored as compact JSON, after going through encode, and
+    come back through decode. If Redis cannot be reached, the cache acts
+    empty for UNAVAILABLE_BACKOFF seconds before trying again. Set
+    KITE_SHARED_CACHE to False to turn it off.
+
+    :param namespace Prefix of this cache's keys
+    :param ttl Seconds entries live, as for TTLCache
+    '''
+
+    PREFIX = 'kite-admin'
+    GENERATION_CHECK_INTERVAL = 1
+    UNAVAILABLE_BACKOFF = 30
+
+    _unavailable_until = 0
+
+    def __init__(self, namespace, ttl, encode=None, decode=None,
+                 connection=redis_connection, clock=time.monotonic):
+        self.namespace = namespace
+        self._ttl = ttl
+        self.encode = encode or (lambda value: value)
+        self.decode = decode or (lambda data: data)
+        self.connection = connection
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._generation = None
+        self._generation_checked = 0
+
+    @property
+    def enabled(self):
+        return app.config.get('KITE_SHARED_CACHE', True) and \
+            SharedCache._unavailable_until <= self.clock()
+
+    def _unavailable(self, e):
+        logging.warning("Shared cache unavailable: %s", e)
+        SharedCache._unavailable_until = self.clock() + self.UNAVAILABLE_BACKOFF
+
+    def _count(self, result, amount=1):
+        metrics.cache_requests.inc('shared_' + self.namespace, result, amount=amount)
+
+    @property
+    def _generation_key(self):
+        return '{}:{}:generation'.format(self.PREFIX, self.namespace)
+
+    def _key(self, generation, key):
+        return '{}:{}:{}:{}'.format(self.PREFIX, self.namespace, generation, key)
+
+    def _current_generation(self, conn):
+        now = self.clock()
+        with self._lock:
+            if self._generation is not None and \
+               now - self._generation_checked < self.GENERATION_CHECK_INTERVAL:
+                return self._generation
+
+        generation = int(conn.get(self._generation_key) or 0)
+        with self._lock:
+            self._generation = generation
+            self._generation_checked = now
+        return generation
+
+    def cached_generation(self):
+        '''The current generation, as last checked, or MISSING if it is
+        time to check again. Needs no round trip to Redis. None if the
+        cache is off or unavailable'''
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            if self._generation is not None and \
+               self.clock() - self._generation_checked < self.GENERATION_CHECK_INTERVAL:
+                return self._generation
+        return MISSING
+
+    def generation(self):
+        '''The current generation, which process caches can keep their
+        entries under, so that they stop using them once another process
+        calls bump(). None if the cache is off or unavailable'''
+        generation = self.cached_generation()
+        if generation is not MISSING:
+            return generation
+
+        try:
+            with self.connection() as conn:
+                return self._current_generation(conn)
+        except RedisError as e:
+            self._unavailable(e)
+            return None
+
+    def get_many(self, keys):
+        '''Returns the values stored for keys, in order, with MISSING for
+        those that are not'''
+        if len(keys) == 0 or not self.enabled:
+            return [ MISSING ] * len(keys)
+
+        try:
+            with self.connection() as conn:
+                generation = self._current_generation(conn)
+                datas = conn.mget([ self._key(generation, key) for key in keys ])
+        except RedisError as e:
+            self._unavailable(e)
+            return [ MISSING ] * len(keys)
+
+        values = []
+        for data in datas:
+            if data is None:
+                values.append(MISSING)
+            else:
+                values.append(self.decode(json.loads(data)))
+
+        hits = sum(1 for value in values if value is not MISSING)
+        self._count('hit', hits)
+        self._count('miss', len(values) - hits)
+        return values
+
+    def get(self, key):
+        return self.get_many([ key ])[0]
+
+    def put_many(self, items):
+        '''Store several values, given as (key, value, ttl) tuples. A ttl
+        of None is the cache's own.'''
+        if len(items) == 0 or not self.enabled:
+            return
+
+        try:
+            with self.connection() as conn:
+                generation = self._current_generation(conn)
+                pipe = conn.pipeline(transaction=False)
+                for (key, value, ttl) in items:
+                    ttl = _config_ttl(self._ttl if ttl is None else ttl)
+                    if ttl > 0:
+                        data = json.dumps(self.encode(value), separators=(',', ':'))
+                        pipe.set(self._key(generation, key), data, ex=ttl)
+                pipe.execute()
+        except RedisError as e:
+            self._unavailable(e)
+
+    def put(self, key, value, ttl=None):
+        self.put_many([ (key, value, ttl) ])
+
+    def bump(self):
+        '''Start a new generation. Entries of the old one are left to
+        expire.'''
+        if not self.enabled:
+            return
+
+        try:
+            with self.connection() as conn:
+                generation = conn.incr(self._generation_key)
+        except RedisError as e:
+            self._unavailable(e)
+            return
+
+        with self._lock:
+            self._generation = generation
+            self._generation_checked = self.clock()
+        self._count('invalidation')
+
+def _encode_persona_info(info):
+    if info is None:
+        return None
+    return [ info['display_name'], info['superuser'] ]
+
+def _decode_persona_info(data):
+    if data is None:
+        return None
+    return { 'display_name': data[0], 'superuser': data[1] }
+
+shared_persona_info = SharedCache('persona', ('KITE_PERSONA_INFO_TTL', 60),
+                                  encode=_encode_persona_info, decode=_decode_persona_info)
+
+# Application info is stored as (manifest name, is signed), and the
+# manifest is read again from the appliance directory. The API turns
+# these back into application info
+shared_application_info = SharedCache('application', ('KITE_APPLICATION_INFO_TTL', 300))
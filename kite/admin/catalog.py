@@ -0,0 +1,167 @@
+'''Index of the applications installed on the appliance, as listed in
+the appliance directory's apps file.
+
+The file is only read again when it is replaced or modified, and
+applications whose manifest did not change keep their entries, so
+listing the catalog costs a stat() rather than reading every manifest.
+'''
+
+from collections import OrderedDict
+import threading
+import os
+
+class CatalogEntry(object):
+    __slots__ = ( 'app_id', 'manifest_name', 'manifest', 'payload' )
+
+    def __init__(self, app_id, manifest_name, manifest):
+        self.app_id = app_id
+        self.manifest_name = manifest_name
+        self.manifest = manifest
+
+        # What /me/applications returns for this application. Shared by
+        # every request, so it must not be modified
+        self.payload = manifest.web_dict
+
+class ApplicationCatalog(object):
+    '''
+    :param path Path of the apps file
+    :param read_manifest Function returning the AppManifest of a
+                         manifest name, or None
+    '''
+
+    def __init__(self, path, read_manifest):
+        self.path = path
+        self.read_manifest = read_manifest
+
+        self._lock = threading.Lock()
+
+        # Held by the background reload, apart from _lock, which the
+        # reload holds while it reads manifests
+        self._reload_lock = threading.Lock()
+        self._reloading = False
+        self._reload_thread = None
+
+        # The identity of the apps file the catalog reflects, the
+        # entries by app id, and their payloads, replaced together
+        self._state = (None, OrderedDict(), [])
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _load(self, file_id):
+        (_, old_entries, _) = self._state
+
+        entries = OrderedDict()
+        try:
+            with open(self.path, 'rt') as apps_file:
+                for line in apps_file:
+                    d = line.split()
+                    if len(d) < 2:
+                        continue
+
+                    (app_id, manifest_name) = d[:2]
+
+                    entry = old_entries.get(app_id)
+                    if entry is None or entry.manifest_name != manifest_name:
+                        manifest = self.read_manifest(manifest_name)
+                        if manifest is None:
+                            continue
+                        entry = CatalogEntry(app_id, manifest_name, manifest)
+
+                    entries[app_id] = entry
+        except FileNotFoundError:
+            pass
+
+        self._state = (file_id, entries,
+                       [ entry.payload for entry in entries.values() ])
+
+    def refresh(self):
+        '''Reload the catalog if the apps file changed. Returns an identifier
+        of the version of the file the catalog now reflects.'''
+        file_id = self._stat()
+        with self._lock:
+            if file_id is None or file_id != self._state[0]:
+                self._load(file_id)
+            return self._state[0]
+
+    def _refresh_in_background(self):
+        def reload():
+            try:
+                self.refresh()
+            finally:
+                with self._reload_lock:
+                    self._reloading = False
+
+        with self._reload_lock:
+            if self._reloading:
+                return
+            self._reloading = True
+            self._reload_thread = threading.Thread(target=reload, name='catalog-reload', daemon=True)
+            self._reload_thread.start()
+
+    def wait_for_reload(self, timeout=None):
+        '''Wait for the background reload in progress, if any, to finish'''
+        with self._reload_lock:
+            thread = self._reload_thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def snapshot(self, allow_stale=False):
+        '''Returns the version of the catalog, its payloads, and whether
+        they are stale.
+
+        With allow_stale, a catalog that was loaded before is returned as
+        it is, even if the apps file has changed since. It is then
+        reloaded in the background.
+        '''
+        (file_id, _, payloads) = self._state
+        if allow_stale and file_id is not None:
+            if self._stat() == file_id:
+                return (file_id, payloads, False)
+
+            self._refresh_in_background()
+            return (file_id, payloads, True)
+
+        self.refresh()
+        (file_id, _, payloads) = self._state
+        return (file_id, payloads, False)
+
+    @property
+    def version(self):
+        return self.refresh()
+
+    def get(self, app_id):
+        '''The CatalogEntry of app_id, or None if it is not installed'''
+        self.refresh()
+        return self._state[1].get(app_id)
+
+    @property
+    def entries(self):
+        self.refresh()
+        return list(self._state[1].values())
+
+    @property
+    def manifests(self):
+        return [ entry.manifest for entry in self.entries ]
+
+    @property
+    def payloads(self):
+        '''The web_dict of every application, in catalog order'''
+        return self.snapshot()[1]
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+def application_catalog(appliance_dir, read_manifest):
+    '''The catalog of the appliance at appliance_dir, shared by the whole
+    process'''
+    path = os.path.join(appliance_dir, 'apps')
+    with _catalogs_lock:
+        catalog = _catalogs.get(path)
+        if catalog is None:
+            catalog = _catalogs[path] = ApplicationCatalog(path, read_manifest)
+        return catalog
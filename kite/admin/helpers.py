@@ -0,0 +1,371 @@
+'''Long-lived permission helpers.
+
+Normally every dynamic permission lookup, transfer check and
+description starts /app/perms in the application's container. With
+KITE_PERMS_HELPER_SERVE set, kite-admin instead keeps one
+`/app/perms --serve` running per application and persona, and sends it
+requests as newline-delimited JSON on its stdin:
+
+    { "id": 1, "op": "lookup", "permissions": [ "/album/x" ] }
+
+and reads one line of JSON back per request, on its stdout:
+
+    { "id": 1, "result": { "/album/x": { "needs_persona": true } } }
+
+or, if the request failed, { "id": 1, "error": "message" }.
+
+Ops mirror the one-shot invocations: 'lookup' answers like
+`--lookup --batch`, 'check' like `--check`, given the needed
+'permissions' and the 'current' ones, and 'describe' like
+`--describe`. Helpers that are idle for KITE_PERMS_HELPER_IDLE seconds
+are stopped by a background thread, which checks every half of that.
+At most KITE_PERMS_HELPER_CONCURRENCY requests are sent at once, and a
+helper that exits is started again on its next request.
+When a helper cannot be used, request() raises HelperUnavailable and
+callers fall back to running /app/perms once.
+'''
+
+import threading
+import select
+import logging
+import json
+import time
+import sys
+import os
+
+from .api import KiteLocalApi
+from .app import app
+
+class HelperUnavailable(Exception):
+    pass
+
+class HelperError(Exception):
+    '''The helper answered a request with an error'''
+    pass
+
+def serve_helpers():
+    return app.config.get('KITE_PERMS_HELPER_SERVE', False)
+
+class HelperProcess(object):
+    '''A running /app/perms --serve, with its own applianced connection,
+    since run_in_app keeps the connection until the process exits'''
+
+    def __init__(self, app_url, persona_id=None, clock=time.monotonic):
+        self.app_url = app_url
+        self.persona_id = persona_id
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._buffer = b''
+        self.last_used = clock()
+        self.answered = 0
+
+        cmd = "/app/perms --serve {persona_flag} --application {app}".format(
+            persona_flag = ("--persona {}".format(persona_id) if persona_id is not None else ""),
+            app=app_url)
+
+        self.api = KiteLocalApi()
+        try:
+            self.proc = self.api.run_in_app(app_url, cmd, persona=persona_id,
+                                            stdin=KiteLocalApi.PIPE, stdout=KiteLocalApi.PIPE,
+                                            stderr=sys.stdout)
+        except:
+            self.api.close()
+            raise
+
+    @property
+    def alive(self):
+        if self.proc is None:
+            return False
+
+        if not self._lock.acquire(blocking=False):
+            # Busy with a request, which finds out if the helper exits
+            return True
+        try:
+            if self.proc is None:
+                return False
+
+            # applianced replies on the connection once the process exits
+            (r, _, _) = select.select([ self.api.socket ], [], [], 0)
+            if len(r) > 0:
+                self._close()
+                return False
+            return True
+        finally:
+            self._lock.release()
+
+    @property
+    def busy(self):
+        return self._lock.locked()
+
+    def _write(self, data, deadline):
+        # run_in_app makes stdin non-blocking, so a request larger than
+        # what the pipe can hold is written as the helper reads it
+        data = memoryview(data)
+        while len(data) > 0:
+            try:
+                written = os.write(self.proc.stdin, data)
+            except BlockingIOError:
+                written = 0
+            data = data[written:]
+            if len(data) == 0:
+                break
+
+            remaining = deadline - self.clock()
+            if remaining <= 0:
+                raise HelperUnavailable("{} did not read its request in time".format(self.app_url))
+
+            (r, _, _) = select.select([ self.api.socket ], [ self.proc.stdin ], [], remaining)
+            if len(r) > 0:
+                raise HelperUnavailable("{} exited".format(self.app_url))
+
+    def _read_line(self, deadline):
+        while b'\n' not in self._buffer:
+            remaining = deadline - self.clock()
+            if remaining <= 0:
+                raise HelperUnavailable("{} did not answer in time".format(self.app_url))
+
+            (r, _, _) = select.select([ self.proc.stdout, self.api.socket ], [], [], remaining)
+            if len(r) == 0:
+                continue
+            elif self.proc.stdout not in r:
+                # applianced replies on the connection once the process
+                # exits, which can be before its stdout is closed
+                raise HelperUnavailable("{} exited".format(self.app_url))
+
+            chunk = os.read(self.proc.stdout, 4096)
+            if len(chunk) == 0:
+                raise HelperUnavailable("{} exited".format(self.app_url))
+            self._buffer += chunk
+
+        (line, self._buffer) = self._buffer.split(b'\n', 1)
+        return line
+
+    def request(self, op, timeout, **params):
+        with self._lock:
+            if self.proc is None:
+                raise HelperUnavailable("{} is stopped".format(self.app_url))
+
+            self._next_id += 1
+            params.update(id=self._next_id, op=op)
+
+            deadline = self.clock() + timeout
+            try:
+                self._write(json.dumps(params).encode('utf-8') + b'\n', deadline)
+                while True:
+                    response = json.loads(self._read_line(deadline).decode('utf-8'))
+                    if response.get('id') == self._next_id:
+                        break
+            except (OSError, ValueError, HelperUnavailable) as e:
+                self._close()
+                raise HelperUnavailable(str(e))
+            finally:
+                self.last_used = self.clock()
+            self.answered += 1
+
+        if 'error' in response:
+            raise HelperError(response['error'])
+        return response.get('result')
+
+    def close(self):
+        '''Stop the helper, once any request in progress is answered'''
+        with self._lock:
+            self._close()
+
+    def close_inherited(self):
+        '''Close this process's copies of a helper that belongs to the
+        parent process, without sending it anything. _lock is not taken,
+        since whichever thread held it did not survive the fork'''
+        proc, self.proc = self.proc, None
+        if proc is not None:
+            for fd in (proc.stdin, proc.stdout):
+                if fd is not None:
+                    try:
+                        os.close(fd)
+                    except OSError:
+                        pass
+        if self.api.socket is not None:
+            self.api.socket.close()
+            self.api.socket = None
+
+    def _close(self):
+        # Only with _lock held, so that the descriptors are not closed,
+        # and perhaps reused, under a request
+        proc, self.proc = self.proc, None
+        if proc is None:
+            return
+
+        # The helper exits once its stdin is closed
+        for fd in (proc.stdin, proc.stdout):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self.api.close()
+
+class HelperPool(object):
+    '''The helpers of this process, by application and persona'''
+
+    DEFAULT_IDLE = 300
+    DEFAULT_CONCURRENCY = 4
+    DEFAULT_TIMEOUT = 10
+
+    # Seconds before starting again a helper that failed right after it
+    # was started, e.g. because the application has no --serve
+    FAILED_BACKOFF = 60
+
+    def __init__(self, factory=HelperProcess, clock=time.monotonic):
+        self.factory = factory
+        self.clock = clock
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._helpers = {}
+        self._failed_until = {}
+        self._semaphore = None
+
+        # Held while the helper of a key is started, so that it is only
+        # started once. Dropped along with the helper
+        self._start_locks = {}
+
+        self._reaper = None
+        self._stop_reaper = threading.Event()
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            # The parent's helpers are its own. They exit once every copy
+            # of their stdin is closed, so close ours. The start locks and
+            # the reaper go with the rest
+            inherited = list(self._helpers.values())
+            self._reset()
+            for helper in inherited:
+                helper.close_inherited()
+
+    @property
+    def idle_timeout(self):
+        return app.config.get('KITE_PERMS_HELPER_IDLE', self.DEFAULT_IDLE)
+
+    @property
+    def timeout(self):
+        return app.config.get('KITE_PERMS_HELPER_TIMEOUT', self.DEFAULT_TIMEOUT)
+
+    @property
+    def semaphore(self):
+        with self._lock:
+            if self._semaphore is None:
+                self._semaphore = threading.BoundedSemaphore(
+                    app.config.get('KITE_PERMS_HELPER_CONCURRENCY', self.DEFAULT_CONCURRENCY))
+            return self._semaphore
+
+    def _forget_start_lock(self, key):
+        # With _lock held. A lock that is held is kept, since the helper
+        # it guards is being started
+        start_lock = self._start_locks.get(key)
+        if start_lock is not None and not start_lock.locked():
+            del self._start_locks[key]
+
+    def _evict_idle(self):
+        now = self.clock()
+        with self._lock:
+            idle = [ key for key, helper in self._helpers.items()
+                     if not helper.busy and now - helper.last_used > self.idle_timeout ]
+            evicted = [ self._helpers.pop(key) for key in idle ]
+            for key in idle:
+                self._forget_start_lock(key)
+
+            for key in [ key for key, until in self._failed_until.items() if until <= now ]:
+                del self._failed_until[key]
+
+        for helper in evicted:
+            helper.close()
+
+    def _start_reaper(self):
+        # With _lock held
+        if self._reaper is None:
+            self._reaper = threading.Thread(target=self._reap, args=(self._stop_reaper,),
+                                            name='perms-helper-reaper', daemon=True)
+            self._reaper.start()
+
+    def _reap(self, stop):
+        '''Stop idle helpers, even when no more requests come to notice
+        them. Returns once there are no helpers left'''
+        while not stop.wait(max(self.idle_timeout / 2, 0.01)):
+            self._evict_idle()
+            with self._lock:
+                if len(self._helpers) == 0 and self._stop_reaper is stop:
+                    self._reaper = None
+                    return
+
+    def _helper(self, app_url, persona_id):
+        key = (app_url, persona_id)
+        while True:
+            with self._lock:
+                if self._failed_until.get(key, 0) > self.clock():
+                    raise HelperUnavailable("{} failed recently".format(app_url))
+                start_lock = self._start_locks.setdefault(key, threading.Lock())
+
+            with start_lock:
+                with self._lock:
+                    if self._start_locks.get(key) is not start_lock:
+                        # Dropped before it was taken
+                        continue
+                    helper = self._helpers.get(key)
+                if helper is not None and helper.alive:
+                    return helper
+
+                try:
+                    helper = self.factory(app_url, persona_id, clock=self.clock)
+                except (OSError, ValueError) as e:
+                    raise HelperUnavailable(str(e))
+
+                # Any helper this replaces has exited, and is closed already
+                with self._lock:
+                    self._helpers[key] = helper
+                    self._start_reaper()
+                return helper
+
+    def request(self, app_url, persona_id, op, **params):
+        '''Send a request to the helper of app_url for persona_id. A helper
+        that exits after answering earlier requests is started again, once.
+        One that fails straight away is not tried again for FAILED_BACKOFF
+        seconds.'''
+        self._check_fork()
+        self._evict_idle()
+
+        with self.semaphore:
+            for attempt in range(2):
+                helper = self._helper(app_url, persona_id)
+                try:
+                    return helper.request(op, self.timeout, **params)
+                except HelperUnavailable as e:
+                    logging.warning("Permission helper for %s failed: %s", app_url, e)
+
+                # Only helpers that used to work are worth starting again
+                if helper.answered == 0:
+                    break
+
+            key = (app_url, persona_id)
+            with self._lock:
+                self._failed_until[key] = self.clock() + self.FAILED_BACKOFF
+                if self._helpers.get(key) is helper:
+                    del self._helpers[key]
+                self._forget_start_lock(key)
+            raise HelperUnavailable(app_url)
+
+    def close(self):
+        with self._lock:
+            helpers = list(self._helpers.values())
+            self._helpers = {}
+            self._start_locks = {}
+
+            self._stop_reaper.set()
+            self._stop_reaper = threading.Event()
+            self._reaper = None
+        for helper in helpers:
+            helper.close()
+
+helper_pool = HelperPool()
@@ -0,0 +1,305 @@
+'''Process-wide counters and histograms, rendered in the Prometheus text
+exposition format by the /metrics route.
+
+Each worker process keeps its own values, and publishes them to Redis
+as it serves requests, at most every PUBLISH_INTERVAL seconds. /metrics
+sums what every worker published, so that scrapes see the same totals
+whichever worker answers. A worker's values are dropped WORKER_TTL
+seconds after it last published, which looks like a counter reset.
+'''
+
+from redis.exceptions import RedisError
+import threading
+import logging
+import bisect
+import json
+import time
+import os
+
+from .app import app, redis_connection
+
+DEFAULT_BUCKETS = ( 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                    0.1, 0.25, 0.5, 1, 2.5, 5, 10 )
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if len(pairs) == 0:
+        return ''
+
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    return '{' + ','.join('{}="{}"'.format(name, escape(value)) for name, value in pairs) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    elif isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    else:
+        return repr(value)
+
+class Metric(object):
+    kind = 'untyped'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labels):
+            raise TypeError("{} expects labels {}".format(self.name, self.labels))
+        return tuple(labels)
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+
+    def snapshot(self):
+        '''This process's values, as JSON'''
+        with self._lock:
+            return [ [ list(key), self._copy_value(value) ]
+                     for key, value in self._values.items() ]
+
+    def merge(self, snapshots):
+        '''The sum of several snapshots, by labels'''
+        values = {}
+        for snapshot in snapshots:
+            for (key, value) in snapshot:
+                key = tuple(key)
+                if len(key) != len(self.labels):
+                    continue
+                values[key] = self._add_values(values.get(key), value)
+        return values
+
+    def render(self, values=None):
+        lines = [ '# HELP {} {}'.format(self.name, self.description),
+                  '# TYPE {} {}'.format(self.name, self.kind) ]
+        if values is None:
+            with self._lock:
+                values = dict(self._values)
+        for key, value in sorted(values.items()):
+            lines.extend(self._render_value(key, value))
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, *labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _copy_value(self, value):
+        return value
+
+    def _add_values(self, total, value):
+        return value if total is None else total + value
+
+    def _render_value(self, key, value):
+        return [ '{}{} {}'.format(self.name, _format_labels(self.labels, key),
+                                  _format_value(value)) ]
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, description, labels=labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        ix = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket, then +Inf, then the sum
+                counts = self._values[key] = [ 0 ] * (len(self.buckets) + 2)
+            counts[ix] += 1
+            counts[-1] += value
+
+    def get_count(self, *labels):
+        with self._lock:
+            counts = self._values.get(self._key(labels))
+            return 0 if counts is None else sum(counts[:-1])
+
+    def _copy_value(self, counts):
+        return list(counts)
+
+    def _add_values(self, total, counts):
+        if total is None:
+            return list(counts)
+        elif len(total) != len(counts):
+            # Published with other buckets, by an older version
+            return total
+        return [ a + b for a, b in zip(total, counts) ]
+
+    def _render_value(self, key, counts):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            total += count
+            labels = _format_labels(self.labels, key, [ ('le', _format_value(float(bound))) ])
+            lines.append('{}_bucket{} {}'.format(self.name, labels, total))
+
+        labels = _format_labels(self.labels, key)
+        lines.append('{}_sum{} {}'.format(self.name, labels, _format_value(counts[-1])))
+        lines.append('{}_count{} {}'.format(self.name, labels, total))
+        return lines
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
+
+    def snapshot(self):
+        return { metric.name: metric.snapshot() for metric in self.metrics }
+
+    def render(self, snapshots=None):
+        '''Render this process's values, or the sum of snapshots'''
+        lines = []
+        for metric in self.metrics:
+            if snapshots is None:
+                lines.extend(metric.render())
+            else:
+                lines.extend(metric.render(metric.merge(snapshot.get(metric.name, [])
+                                                        for snapshot in snapshots)))
+        return '\n'.join(lines) + '\n'
+
+class WorkerMetrics(object):
+    '''Publishes the registry of each worker process to Redis, and reads
+    back those of every worker.
+
+    :param registry The Registry to publish
+    :param connection Context manager giving a Redis connection
+    '''
+
+    PREFIX = 'kite-admin:metrics'
+    PUBLISH_INTERVAL = ('KITE_METRICS_PUBLISH_INTERVAL', 5)
+    WORKER_TTL = ('KITE_METRICS_WORKER_TTL', 24 * 3600)
+
+    def __init__(self, registry, connection=redis_connection, clock=time.monotonic,
+                 getpid=os.getpid):
+        self.registry = registry
+        self.connection = connection
+        self.clock = clock
+        self.getpid = getpid
+
+        self._lock = threading.Lock()
+        self._published = None
+
+    def _config(self, setting):
+        (key, default) = setting
+        return app.config.get(key, default)
+
+    @property
+    def _workers_key(self):
+        return '{}:workers'.format(self.PREFIX)
+
+    def _key(self, pid):
+        return '{}:{}'.format(self.PREFIX, pid)
+
+    def publish(self, force=False):
+        '''Publish this process's values, unless they were published less
+        than PUBLISH_INTERVAL seconds ago. Returns whether they were'''
+        now = self.clock()
+        with self._lock:
+            if not force and self._published is not None and \
+               now - self._published < self._config(self.PUBLISH_INTERVAL):
+                return False
+            self._published = now
+
+        pid = self.getpid()
+        data = json.dumps(self.registry.snapshot(), separators=(',', ':'))
+        try:
+            with self.connection() as conn:
+                pipe = conn.pipeline(transaction=False)
+                pipe.set(self._key(pid), data, ex=self._config(self.WORKER_TTL))
+                pipe.sadd(self._workers_key, pid)
+                pipe.execute()
+        except RedisError as e:
+            logging.warning("Could not publish metrics: %s", e)
+            return False
+        return True
+
+    def snapshots(self):
+        '''What every worker published, this one included, or None if
+        Redis cannot be reached'''
+        self.publish(force=True)
+        try:
+            with self.connection() as conn:
+                pids = sorted(conn.smembers(self._workers_key))
+                datas = []
+                if len(pids) > 0:
+                    datas = conn.mget([ self._key(pid.decode('ascii')) for pid in pids ])
+
+                expired = [ pid for pid, data in zip(pids, datas) if data is None ]
+                if len(expired) > 0:
+                    conn.srem(self._workers_key, *expired)
+        except RedisError as e:
+            logging.warning("Could not read metrics of other workers: %s", e)
+            return None
+
+        return [ json.loads(data) for data in datas if data is not None ]
+
+    def render(self):
+        '''The sum of every worker's values. Only this process's, if Redis
+        cannot be reached'''
+        snapshots = self.snapshots()
+        if snapshots is None:
+            return self.registry.render()
+        return self.registry.render(snapshots)
+
+registry = Registry()
+workers = WorkerMetrics(registry)
+
+applianced_requests = registry.counter(
+    'kite_admin_applianced_requests_total',
+    'Requests sent to applianced, by request type', labels=('opcode',))
+applianced_errors = registry.counter(
+    'kite_admin_applianced_errors_total',
+    'Requests to applianced whose reply never arrived, by request type', labels=('opcode',))
+applianced_bytes_sent = registry.counter(
+    'kite_admin_applianced_sent_bytes_total',
+    'Bytes of requests sent to applianced, by request type', labels=('opcode',))
+applianced_bytes_received = registry.counter(
+    'kite_admin_applianced_received_bytes_total',
+    'Bytes of replies received from applianced, by request type', labels=('opcode',))
+applianced_latency = registry.histogram(
+    'kite_admin_applianced_request_seconds',
+    'Time from sending a request to applianced to receiving its last reply packet',
+    labels=('opcode',))
+
+container_process_duration = registry.histogram(
+    'kite_admin_container_process_seconds',
+    'Time from spawning a process with run_in_app to its exit, by application',
+    labels=('app',))
+
+cache_requests = registry.counter(
+    'kite_admin_cache_total',
+    'Cache lookups by result (hit, miss), and entries evicted or invalidated',
+    labels=('cache', 'result'))
+
+def opcode_label(opcode):
+    return '0x{:04x}'.format(opcode)
@@ -6,12 +6,17 @@ from binascii import hexlify
 from collections import OrderedDict
 import os
 import operator
+import threading
+import weakref
 import json
 import re
 import sys
 
-from .api import local_api
+from .api import local_api, fan_out
+from .cache import permission_index_cache, perm_security_cache, \
+    DYNAMIC_PERM_SECURITY_TTL, MISSING
 from .util import Signature
+from .helpers import helper_pool, serve_helpers, HelperUnavailable, HelperError
 from .errors import KitePermissionsError, KiteNoSuchAppError, \
     KiteNoSuchAppsError, KiteNoSuchPermissionError
 
@@ -57,6 +62,20 @@ def get_builtin_perm(perm_name):
     else:
         return None
 
+def load_app_permissions(closure):
+    '''The permissions declared in the permissions.json of an application
+    closure, or None if it has none. Use load_permission_index() to keep
+    them for the life of the process.
+    '''
+    if closure is None:
+        return None
+
+    try:
+        with open(os.path.join(closure, "permissions.json")) as perms_file:
+            return json.load(perms_file)
+    except FileNotFoundError:
+        return None
+
 def find_perm(perms, perm_name):
     for i, p in enumerate(perms):
         if 'name' in p and p['name'] == perm_name:
@@ -65,6 +84,97 @@ def find_perm(perms, perm_name):
             return p, i
     return None, None
 
+class PermissionIndex(object):
+    '''The permissions declared in a permissions.json, compiled for
+    lookup. find() returns the same as find_perm() on the list: the first
+    entry whose name or regex matches.
+
+    Names go in a dict. Regexes are combined into one alternation, each
+    in a named group, tried in the order of the list. Regexes that would
+    mean something else once combined are tried one by one instead:
+    those with global inline flags, such as (?i), which apply to the
+    whole pattern before Python 3.11, and those that refer to groups by
+    number, since wrapping every entry in a group renumbers them. If the
+    rest cannot be combined either, all are tried one by one. An entry
+    with both matches by either, like in find_perm(), and the first entry
+    to match by either wins.
+    '''
+
+    __slots__ = ( 'perms', '_names', '_regex', '_regex_indices', '_separate',
+                  '_first_regex' )
+
+    # Global inline flags, numbered backreferences, and conditionals on
+    # numbered groups. Escaped backslashes may be taken for
+    # backreferences, which only costs a separate match
+    _UNCOMBINABLE = re.compile(r'\(\?[aiLmsux]+\)|\\[1-9]|\(\?\(\d+\)')
+
+    def __init__(self, perms):
+        self.perms = perms
+        self._names = {}
+
+        regexes = []
+        for i, p in enumerate(perms):
+            if 'name' in p:
+                self._names.setdefault(p['name'], i)
+            if 'regex' in p:
+                regexes.append((i, p['regex']))
+
+        self._first_regex = regexes[0][0] if regexes else None
+
+        combined = [ (i, regex) for (i, regex) in regexes
+                     if self._UNCOMBINABLE.search(regex) is None ]
+        self._regex_indices = { '_p{}'.format(i): i for (i, _) in combined }
+        try:
+            self._regex = re.compile('|'.join('(?P<_p{}>{})'.format(i, regex)
+                                              for (i, regex) in combined)) if combined else None
+        except re.error:
+            self._regex = None
+            combined = []
+
+        combined_indices = set(i for (i, _) in combined)
+        self._separate = [ i for (i, _) in regexes if i not in combined_indices ]
+
+    def _find_regex(self, perm_name, before):
+        if self._first_regex is None or self._first_regex >= before:
+            return None
+
+        found = None
+        if self._regex is not None:
+            m = self._regex.fullmatch(perm_name)
+            if m is not None:
+                found = self._regex_indices[m.lastgroup]
+                before = min(before, found)
+
+        # Only entries before the one found can still win
+        for i in self._separate:
+            if i >= before:
+                break
+            if re.fullmatch(self.perms[i]['regex'], perm_name):
+                return i
+        return found
+
+    def find(self, perm_name):
+        i = self._names.get(perm_name, len(self.perms))
+
+        regex_i = self._find_regex(perm_name, i)
+        if regex_i is not None and regex_i < i:
+            i = regex_i
+
+        if i == len(self.perms):
+            return None, None
+        return self.perms[i], i
+
+def load_permission_index(closure):
+    '''The PermissionIndex of an application closure, or None if it
+    declares no permissions. Kept for the life of the process.
+    '''
+    index = permission_index_cache.get(closure)
+    if index is MISSING:
+        perms = load_app_permissions(closure)
+        index = None if perms is None else PermissionIndex(perms)
+        permission_index_cache.put(closure, index)
+    return index
+
 class ApplicationUrl(object):
     def __init__(self, app_domain, app_name):
         self.domain = app_domain
@@ -139,37 +249,87 @@ class PermSecurity(object):
                             description=d.get('description', None),
                             index=index)
 
+def _parse_permission(url_or_perm, app_url=None, relative_to=None):
+    '''Returns the (app, permission) of a permission, given as for
+    Permission()'''
+    if app_url is not None:
+        return (app_url, url_or_perm)
+
+    try:
+        res = urlparse(url_or_perm)
+    except ValueError:
+        raise TypeError("%s is not a valid URL" % url_or_perm)
+
+    if res.scheme != 'kite+perm':
+        if relative_to is None:
+            raise TypeError("Expected kite+perm as permissions URL scheme")
+        else:
+            app = relative_to
+    else:
+        app = res.hostname
+
+    if len(res.path) == 0 or res.path[0] != '/':
+        raise ValueError("Invalid path name in permission")
+
+    path = os.path.normpath(res.path)
+    components = path.split('/')
+    if path.startswith('//'):
+        components = components[1:]
+
+    if len(components) < 2:
+        raise ValueError("Need at least one component in permission path")
+
+    return (app, '/'.join(components[1:]))
+
 class Permission(object):
-    def __init__(self, url_or_perm, app_url=None, relative_to=None):
-        if app_url is None:
-            try:
-                res = urlparse(url_or_perm)
-            except ValueError:
-                raise TypeError("%s is not a valid URL" % url)
+    '''A permission of an application.
 
-            if res.scheme != 'kite+perm':
-                if relative_to is None:
-                    raise TypeError("Expected kite+perm as permissions URL scheme")
-                else:
-                    self.app = relative_to
-            else:
-                self.app = res.hostname
+    Permissions are interned: constructing a permission that is already
+    in use returns the same, immutable, instance, with its canonical
+    form, hash, base permission and transferred permissions worked out
+    once.
+    '''
 
-            if len(res.path) == 0 or res.path[0] != '/':
-                raise ValueError("Invalid path name in permission")
+    __slots__ = ( 'app', 'permission', 'canonical', '_hash',
+                  '_base_permission', '_transferred', '__weakref__' )
 
-            path = os.path.normpath(res.path)
-            components = path.split('/')
-            if path.startswith('//'):
-                components = components[1:]
+    # Interned permissions by canonical form, and by the arguments they
+    # were last constructed from, so that parsing is skipped too
+    _by_canonical = weakref.WeakValueDictionary()
+    _by_args = weakref.WeakValueDictionary()
+    _intern_lock = threading.Lock()
 
-            if len(components) < 2:
-                raise ValueError("Need at least one component in permission path")
+    def __new__(cls, url_or_perm, app_url=None, relative_to=None):
+        args = (url_or_perm, app_url, relative_to)
+        self = cls._by_args.get(args)
+        if self is not None:
+            return self
 
-            self.permission = '/'.join(components[1:])
-        else:
-            self.app = app_url
-            self.permission = url_or_perm
+        (app, permission) = _parse_permission(url_or_perm, app_url=app_url, relative_to=relative_to)
+        canonical = sys.intern('kite+perm://{}/{}'.format(app, permission))
+
+        with cls._intern_lock:
+            self = cls._by_canonical.get(canonical)
+            if self is None:
+                self = super(Permission, cls).__new__(cls)
+                self.app = app
+                self.permission = permission
+                self.canonical = canonical
+                self._hash = hash(canonical)
+                self._base_permission = None
+                self._transferred = None
+                cls._by_canonical[canonical] = self
+            cls._by_args[args] = self
+        return self
+
+    def __reduce__(self):
+        return (Permission, (self.permission, self.app))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
 
     def __repr__(self):
         return 'Permission({})'.format(self.canonical)
@@ -177,89 +337,120 @@ class Permission(object):
     def __str__(self):
         return self.canonical
 
-    def __hash__(self):
-        return hash(self.canonical)
-
-    def __eq__(self, a):
-        return isinstance(a, Permission) and \
-            self.app == a.app and \
-            self.permission == a.permission
-
-    @property
-    def transferred(self):
+    def _strip_transfer_suffix(self):
         if self.permission.endswith(KITE_TRANSFER_SUFFIX):
-            transferred = Permission(self.permission[:-len(KITE_TRANSFER_SUFFIX)], app_url=self.app)
-            return set([transferred, self])
+            return Permission(self.permission[:-len(KITE_TRANSFER_SUFFIX)], app_url=self.app)
         elif self.permission.endswith(KITE_TRANSFER_ONCE_SUFFIX):
-            transferred = Permission(self.permission[:-len(KITE_TRANSFER_ONCE_SUFFIX)], app_url=self.app)
-            return set([transferred])
+            return Permission(self.permission[:-len(KITE_TRANSFER_ONCE_SUFFIX)], app_url=self.app)
         else:
-            return set()
+            return None
 
     @property
-    def base_permission(self):
-        if self.permission.endswith(KITE_TRANSFER_SUFFIX):
-            return Permission(self.permission[:-len(KITE_TRANSFER_SUFFIX)], app_url=self.app).base_permission
-        elif self.permission.endswith(KITE_TRANSFER_ONCE_SUFFIX):
-            return Permission(self.permission[:-len(KITE_TRANSFER_ONCE_SUFFIX)], app_url=self.app).base_permission
-        else:
-            return self
+    def transferred(self):
+        '''The permissions a token holding this one can give away. Shared,
+        so it must not be modified'''
+        if self._transferred is None:
+            stripped = self._strip_transfer_suffix()
+            if stripped is None:
+                transferred = frozenset()
+            elif self.permission.endswith(KITE_TRANSFER_SUFFIX):
+                transferred = frozenset([stripped, self])
+            else:
+                transferred = frozenset([stripped])
+            self._transferred = transferred
+        return self._transferred
 
     @property
-    def is_base(self):
-        return not self.permission.endswith(KITE_TRANSFER_SUFFIX) and \
-            not self.permission.endswith(KITE_TRANSFER_ONCE_SUFFIX)
+    def base_permission(self):
+        if self._base_permission is None:
+            stripped = self._strip_transfer_suffix()
+            self._base_permission = self if stripped is None else stripped.base_permission
+        return self._base_permission
 
     @property
-    def canonical(self):
-        return 'kite+perm://{}/{}'.format(self.app, self.permission)
+    def is_base(self):
+        return self.base_permission is self
 
     @property
     def application(self):
         return self.app
 
     def __hash__(self):
-        return hash(self.canonical)
+        return self._hash
 
     def __eq__(self, other):
-        if isinstance(other, Permission):
+        if self is other:
+            return True
+        elif isinstance(other, Permission):
             return self.canonical == other.canonical
         else:
             return False
 
-    def perm_security(self, api=None, persona_id=None):
-        if hasattr(self, '_perm_security'):
-            return self._perm_security
-        else:
-            self._perm_security = self.lookup_perm_security(api, persona_id)
-            return self._perm_security
-
-    def lookup_perm_security(self, api=None, persona_id=None):
+    def perm_security(self, api=None, persona_id=None, app_info=None):
+        '''Like lookup_perm_security, but remembered for the rest of the
+        request'''
+        key = (self.canonical, persona_id)
+        if api is not None:
+            security = api._recall('perm_security', key)
+            if security is not MISSING:
+                return security
+
+        security = self.lookup_perm_security(api, persona_id, app_info=app_info)
+        if api is not None:
+            api._memoize('perm_security', key, security)
+        return security
+
+    def lookup_perm_security(self, api=None, persona_id=None, app_info=None):
         '''Permission information is stored at <closure-path>/kite/perms.json
 
         Example:
         [ { name: "name", needs_site: true/false, needs_persona: true/false },
           { regex: "regex", dynamic: true/false } ]
+
+        app_info, if given, is the already looked up application info
+        for this permission's application.
         '''
 
         if not self.is_base:
-            return self.base_permission.lookup_perm_security(api=api, persona_id=persona_id)
+            return self.base_permission.lookup_perm_security(api=api, persona_id=persona_id,
+                                                             app_info=app_info)
+
+        (security, lookup) = self._resolve_perm_security(api, persona_id, app_info)
+        if security is None:
+            security = lookup.complete(_lookup_dynamic_perm(api, self, persona_id))
+        return security
+
+    def _resolve_perm_security(self, api, persona_id, app_info):
+        '''Returns the security of this base permission and None, or, if
+        it is dynamic and must be asked of the application, None and the
+        _DynamicPermLookup to complete with the answer'''
 
         # Find the application closure directory
-        app_info = api.get_application_info(self.application)
+        if app_info is None:
+            app_info = api.get_application_info(self.application)
         if app_info is None:
             raise KiteNoSuchAppError(self.application)
 
+        # Static answers only depend on the manifest, and dynamic ones
+        # on the persona too
+        manifest_name = app_info.get('manifest_name')
+        static_key, dynamic_key = None, None
+        if manifest_name is not None:
+            static_key = (self.application, manifest_name.manifest, self.permission, None)
+            dynamic_key = static_key[:-1] + (persona_id,)
+            for key in (static_key, dynamic_key):
+                security = perm_security_cache.get(key)
+                if security is not MISSING:
+                    return (security, None)
+
         manifest = app_info['manifest']
         closure = manifest.nix_closure
 
-        # Open the permissions file
-        try:
-            with open(os.path.join(closure, "permissions.json")) as perms:
-                perms_info = json.load(perms)
-                perm, i = find_perm(perms_info, self.permission)
-        except FileNotFoundError:
-            perm = None
+        perms_index = load_permission_index(closure)
+        if perms_index is not None:
+            perm, i = perms_index.find(self.permission)
+        else:
+            perm, i = None, None
 
         if perm is None and self.application == KITE_ADMIN_APP_URL:
             perm = get_builtin_perm(self.permission)
@@ -268,21 +459,160 @@ class Permission(object):
             raise KiteNoSuchPermissionError(self.canonical)
 
         if perm.get('dynamic', False):
-            cmd = "/app/perms --lookup /{permission} {persona_flag} --application {application}".format(
-                persona_flag = ("--persona {}".format(persona_id) if persona_id is not None else ""),
-                permission=self.permission, application=self.application)
+            return (None, _DynamicPermLookup(i, dynamic_key))
+        else:
+            security = PermSecurity.from_json(perm, i)
+            if static_key is not None:
+                perm_security_cache.put(static_key, security)
+            return (security, None)
 
-            proc = api.run_in_app(self.application, cmd, persona=persona_id, wait=True,
-                                  stdout=api.PIPE, stdin=None, stderr=sys.stdout)
+class _DynamicPermLookup(object):
+    '''A dynamic permission waiting for the application's answer'''
 
-            stdout, stderr = proc.communicate()
+    __slots__ = ( 'index', 'key' )
 
-            if proc.returncode == 0:
-                return PermSecurity.from_json(json.loads(stdout), i)
-            else:
-                raise KiteNoSuchPermissionError(self.permission)
+    def __init__(self, index, key):
+        self.index = index
+        self.key = key
+
+    def complete(self, d):
+        '''Returns the PermSecurity the application answered with d. The
+        application says how long its answer holds, in seconds, with
+        'cache_ttl'.'''
+        security = PermSecurity.from_json(d, self.index)
+
+        ttl = d.get('cache_ttl')
+        if not isinstance(ttl, (int, float)) or isinstance(ttl, bool):
+            ttl = DYNAMIC_PERM_SECURITY_TTL
+        if self.key is not None:
+            perm_security_cache.put(self.key, security, ttl=ttl)
+        return security
+
+def _ask_helper(app, persona_id, op, **params):
+    '''Send a request to the application's long-lived helper, if they are
+    turned on. Returns MISSING if the helper cannot be used, in which case
+    /app/perms is run once instead. Raises HelperError if the helper
+    answered with an error.'''
+    if not serve_helpers():
+        return MISSING
+
+    try:
+        return helper_pool.request(app, persona_id, op, **params)
+    except HelperUnavailable:
+        return MISSING
+
+def _lookup_dynamic_perm(api, permission, persona_id):
+    '''Ask the application for the security of one of its dynamic
+    permissions. Returns its JSON answer'''
+    name = "/" + permission.permission
+    try:
+        answers = _ask_helper(permission.application, persona_id, 'lookup', permissions=[ name ])
+    except HelperError:
+        raise KiteNoSuchPermissionError(permission.permission)
+    if answers is not MISSING:
+        if not isinstance(answers, dict) or answers.get(name) is None:
+            raise KiteNoSuchPermissionError(permission.permission)
+        return answers[name]
+
+    cmd = "/app/perms --lookup /{permission} {persona_flag} --application {application}".format(
+        persona_flag = ("--persona {}".format(persona_id) if persona_id is not None else ""),
+        permission=permission.permission, application=permission.application)
+
+    proc = api.run_in_app(permission.application, cmd, persona=persona_id, wait=True,
+                          stdout=api.PIPE, stdin=None, stderr=sys.stdout)
+
+    stdout, stderr = proc.communicate()
+
+    if proc.returncode == 0:
+        return json.loads(stdout)
+    else:
+        raise KiteNoSuchPermissionError(permission.permission)
+
+def _lookup_dynamic_perms(api, app, persona_id, permissions):
+    '''Ask the application for the security of several of its dynamic
+    permissions in one run, with /app/perms --lookup --batch.
+
+    The permissions are written on stdin, one per line, as they are
+    given to --lookup. The answer is a JSON object from each of them to
+    what --lookup would have answered. Permissions left out of it do not
+    exist. Returns None if the application does not support --batch
+    (exits with an error), so that they are looked up one by one.
+    '''
+    names = [ "/" + p.permission for p in permissions ]
+    try:
+        answers = _ask_helper(app, persona_id, 'lookup', permissions=names)
+    except HelperError:
+        answers = None
+    if answers is not MISSING:
+        return answers if isinstance(answers, dict) else None
+
+    cmd = "/app/perms --lookup --batch {persona_flag} --application {app}".format(
+        persona_flag = ("--persona {}".format(persona_id) if persona_id is not None else ""),
+        app=app)
+
+    proc = api.run_in_app(app, cmd, persona=persona_id, wait=True,
+                          stdout=api.PIPE, stdin=api.PIPE, stderr=sys.stdout)
+
+    stdout, _ = proc.communicate("\n".join(names))
+
+    if proc.returncode != 0:
+        return None
+
+    result = json.loads(stdout)
+    if not isinstance(result, dict):
+        return None
+    return result
+
+def lookup_perm_securities(api, permissions, persona_id=None, app_infos=None):
+    '''Like perm_security() for each of permissions, but asking each
+    application about all of its dynamic permissions at once. Returns
+    the securities in the order of permissions.
+
+    :param app_infos Already looked up application info, by application
+    '''
+    if app_infos is None:
+        app_infos = {}
+
+    securities = [ None ] * len(permissions)
+
+    # Dynamic base permissions by application, with their lookups and
+    # the positions of the permissions they answer for
+    pending = OrderedDict()
+
+    for ix, p in enumerate(permissions):
+        security = api._recall('perm_security', (p.canonical, persona_id))
+        if security is not MISSING:
+            securities[ix] = security
+            continue
+
+        base = p.base_permission
+        (security, lookup) = base._resolve_perm_security(api, persona_id,
+                                                         app_infos.get(base.application))
+        if security is not None:
+            securities[ix] = api._memoize('perm_security', (p.canonical, persona_id), security)
         else:
-            return PermSecurity.from_json(perm, i)
+            app_pending = pending.setdefault(base.application, OrderedDict())
+            app_pending.setdefault(base, (lookup, []))[1].append(ix)
+
+    for app, app_pending in pending.items():
+        answers = None
+        if len(app_pending) > 1:
+            answers = _lookup_dynamic_perms(api, app, persona_id, list(app_pending))
+
+        for base, (lookup, ixs) in app_pending.items():
+            if answers is None:
+                d = _lookup_dynamic_perm(api, base, persona_id)
+            else:
+                d = answers.get("/" + base.permission)
+                if d is None:
+                    raise KiteNoSuchPermissionError(base.permission)
+
+            security = lookup.complete(d)
+            for ix in ixs:
+                securities[ix] = api._memoize('perm_security', (permissions[ix].canonical, persona_id),
+                                              security)
+
+    return securities
 
 class TokenSet(object):
     def __init__(self, api, token_names):
@@ -323,18 +653,26 @@ class TokenRequest(object):
         return self.site is not None
 
     def tokenize(self, api, persona_id=None, site_id=None):
-        securities = []
         missing_apps = set()
 
+        # Look up all applications at once, rather than once per permission
+        apps = list(set(p.application for p in self.permissions))
+        app_infos = dict(zip(apps, api.get_application_infos(apps)))
+
         for p in self.permissions:
-            try:
-                securities.append(p.perm_security(api, persona_id))
-            except KiteNoSuchAppError as e:
-                missing_apps.add(e.app)
+            if app_infos[p.application] is None:
+                missing_apps.add(p.application)
 
         if len(missing_apps) > 0:
             raise KiteNoSuchAppsError(missing_apps)
 
+        # Dynamic permissions are looked up with one run per application
+        try:
+            securities = lookup_perm_securities(api, self.permissions, persona_id,
+                                                app_infos=app_infos)
+        except KiteNoSuchAppError as e:
+            raise KiteNoSuchAppsError(set([ e.app ]))
+
         if any(security is None for security in securities):
             return None
 
@@ -398,8 +736,10 @@ class Token(object):
         self.permissions = set(self._make_permission(p) for p in permissions)
 
     def grouped_permissions(self):
-        ret = {}
-        for p in self.permissions:
+        '''The permissions by application. Both are sorted, so that work
+        done per application is merged in the same order every time'''
+        ret = OrderedDict()
+        for p in sorted(self.permissions, key=lambda p: (p.app or '', p.canonical)):
             if p.app in ret:
                 ret[p.app].append(p)
             else:
@@ -424,18 +764,29 @@ class Token(object):
         if persona_id is not None:
             persona_flag = "--persona {}".format(persona_id)
 
-        needed_arg = " ".join(("/" + x.permission) for x in needed)
+        try:
+            result = _ask_helper(app, persona_id, 'check',
+                                 permissions=[ "/" + x.permission for x in needed ],
+                                 current=[ str(p) for p in cur_set ])
+        except HelperError:
+            return VerificationResult(accepted=set(), denied=set(needed))
 
-        cmd = "/app/perms --check {persona_flag} --application {app} {needed_arg}".format(**locals())
+        if result is MISSING:
+            needed_arg = " ".join(("/" + x.permission) for x in needed)
 
-        proc = api.run_in_app(app, cmd, persona=persona_id, wait=True,
-                              stdout=api.PIPE, stdin=api.PIPE, stderr=sys.stdout)
+            cmd = "/app/perms --check {persona_flag} --application {app} {needed_arg}".format(**locals())
 
-        stdout, _ = proc.communicate("\n".join(str(p) for p in cur_set))
+            proc = api.run_in_app(app, cmd, persona=persona_id, wait=True,
+                                  stdout=api.PIPE, stdin=api.PIPE, stderr=sys.stdout)
 
-        if proc.returncode == 0:
-            result = json.loads(stdout)
+            stdout, _ = proc.communicate("\n".join(str(p) for p in cur_set))
 
+            if proc.returncode == 0:
+                result = json.loads(stdout)
+            else:
+                result = None
+
+        if result is not None:
             accepted = set()
             denied = set()
 
@@ -462,7 +813,7 @@ class Token(object):
         else:
             return VerificationResult(accepted=set(), denied=set(needed))
 
-    def _verify_transfer(self, transferrable_perms, app, perms, api, persona_id=None):
+    def _verify_transfer(self, transferrable_perms, app, perms, api, persona_id=None, app_infos=None):
         '''Verify that we have the rights to transfer permissions
 
         We have the right to transfer permissions if we have the
@@ -477,6 +828,8 @@ class Token(object):
         transferrable permissions allows us to transfer this
         one. Otherwise, we assume the permission is transferrable.
 
+        app_infos, if given, holds the already looked up application
+        info, by application.
         '''
         denied = set()
         accepted = set()
@@ -488,7 +841,8 @@ class Token(object):
                 denied.add(p)
 
         # If any denied perm is dynamic, ask if this transfer is possible
-        denied_perms_security = reduce(operator.or_, (p.perm_security(api, persona_id) for p in denied), PermSecurity())
+        securities = lookup_perm_securities(api, list(denied), persona_id, app_infos=app_infos)
+        denied_perms_security = reduce(operator.or_, securities, PermSecurity())
         if denied_perms_security.dynamic:
             res = self._verify_dynamic_permissions(api, app, persona_id, transferrable_perms, denied)
             accepted |= res.accepted
@@ -518,8 +872,18 @@ class Token(object):
                 else:
                     accepted.append(p)
         else:
-            for app, perms in self.grouped_permissions().items():
-                res = self._verify_transfer(transferrable, app, perms, api, persona_id=persona_id)
+            # Each application is asked on its own connection, at once.
+            # Their info is looked up here, in one batch, rather than
+            # once per permission on every connection
+            grouped = self.grouped_permissions()
+            app_infos = dict(zip(grouped, api.get_application_infos(list(grouped))))
+
+            def verify(app_api, group):
+                (app, perms) = group
+                return self._verify_transfer(transferrable, app, perms, app_api, persona_id=persona_id,
+                                             app_infos=app_infos)
+
+            for res in fan_out(verify, grouped.items(), api=api):
                 accepted.extend(res.accepted)
                 denied.extend(res.denied)
 
@@ -589,35 +953,54 @@ class Token(object):
     def describe(self, api, persona_id):
         r = TokenDescription()
 
-        grouped = self.grouped_permissions()
-        for app, perms in grouped.items():
-            app_info = api.get_application_info(app)
+        grouped = list(self.grouped_permissions().items())
+        apps = [ app for (app, _) in grouped ]
+        app_infos = api.get_application_infos(apps)
+
+        # Applications describe their permissions concurrently, each on
+        # its own connection. Sections keep the order of the token
+        def describe_app(app_api, group):
+            (app, perms) = group
+            return self._describe_app_permissions(app_api, app, perms, persona_id)
+
+        all_entries = fan_out(describe_app, grouped, api=api)
+
+        for app_info, entries in zip(app_infos, all_entries):
             section = r.get_section(app_info['manifest'])
+            for e in entries:
+                section.add_entry(e)
 
-            if app == KITE_ADMIN_APP_URL:
-                entries = _describe_admin_perms(perms)
-            else:
+        return r
+
+    @staticmethod
+    def _describe_app_permissions(api, app, perms, persona_id):
+        if app == KITE_ADMIN_APP_URL:
+            return _describe_admin_perms(perms)
 
-                # Ask for a dynamic description
-                cmd = "/app/perms --describe {persona_flag} --application {application}".format(
-                    persona_flag = '' if persona_id is None else "--persona {}".format(persona_id),
-                    application = app)
+        # Ask for a dynamic description
+        try:
+            entries = _ask_helper(app, persona_id, 'describe',
+                                  permissions=[ p.canonical for p in perms ])
+        except HelperError as e:
+            raise ValueError("Could not describe permissions for {}: {}".format(app, e))
 
-                proc = api.run_in_app(app, cmd, persona=persona_id, wait=True,
-                                      stdout=api.PIPE, stdin=api.PIPE, stderr=sys.stdout)
+        if entries is MISSING:
+            cmd = "/app/perms --describe {persona_flag} --application {application}".format(
+                persona_flag = '' if persona_id is None else "--persona {}".format(persona_id),
+                application = app)
 
-                stdout, _ = proc.communicate("\n".join(p.canonical for p in perms))
+            proc = api.run_in_app(app, cmd, persona=persona_id, wait=True,
+                                  stdout=api.PIPE, stdin=api.PIPE, stderr=sys.stdout)
 
-                if proc.returncode == 0:
-                    entries = json.loads(stdout)
+            stdout, _ = proc.communicate("\n".join(p.canonical for p in perms))
 
-                else:
-                    raise ValueError("Could not describe permissions for {}: process exited with {}".format(app, proc.returncode))
+            if proc.returncode == 0:
+                entries = json.loads(stdout)
 
-            for e in entries:
-                section.add_entry(e)
+            else:
+                raise ValueError("Could not describe permissions for {}: process exited with {}".format(app, proc.returncode))
 
-        return r
+        return entries
 
 class TokenDescriptionEntry(object):
     __slots__ = ( 'short',
@@ -667,8 +1050,8 @@ class TokenDescriptionSection(object):
     @property
     def all_permissions(self):
         if self._all_permissions is None:
-            with open(os.path.join(self.app_manifest.nix_closure, "permissions.json")) as perms:
-                self._all_permissions = json.loads(perms)
+            index = load_permission_index(self.app_manifest.nix_closure)
+            self._all_permissions = [] if index is None else index.perms
         return self._all_permissions
 
     def add_entry(self, short_or_desc):
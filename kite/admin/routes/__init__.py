@@ -3,5 +3,6 @@ from . import app
 from . import storage
 from . import personas
 from . import global_routes
+from . import metrics
 
 from . import local_network
@@ -2,42 +2,82 @@ from flask import request, jsonify, abort, url_for, redirect
 from uuid import uuid4
 from celery.result import AsyncResult
 
-from ..api import local_api, require_logged_in, make_manifest_path
+from ..api import local_api, require_logged_in, make_manifest_path, get_application_catalog
 from ..permission import TokenSet, has_install_permission
 from ..app import app, redis_connection, celery
-from ..util import no_cache
+from ..util import no_cache, no_store, serve_stale, mark_stale
+from ..cache import RevalidatingCache
 
 from ..tasks.app import install_app
 
 def _update_app_task_key(appid):
     return "update-{}".format(appid)
 
+# ETags are worked out from the catalog of installed applications, so
+# that clients holding a current response are answered without asking
+# applianced. Manifest names are hashes of the manifests' contents
+
+def _applications_etag():
+    (version, _, _) = get_application_catalog().snapshot(allow_stale=serve_stale())
+    if version is None:
+        return None
+    return 'apps-{:x}-{:x}-{:x}'.format(*version)
+
+def _manifest_etag(appid=None):
+    entry = get_application_catalog().get(appid)
+    if entry is None:
+        return None
+    return entry.manifest_name
+
+def _application_etag(appid=None):
+    # The status also holds whether the manifest is signed, which is
+    # not part of the manifest, so this changes with the apps file too
+    manifest_etag = _manifest_etag(appid)
+    if manifest_etag is None:
+        return None
+    applications_etag = _applications_etag()
+    if applications_etag is None:
+        return None
+    return '{}-{}'.format(manifest_etag, applications_etag)
+
 @app.route('/me/applications')
+@no_cache(etag=_applications_etag)
 def my_applications():
     '''Returns a JSON list of all applications accessible to this user
     (currently, all installed apps).
     '''
-    with local_api() as api:
-        return jsonify([application.to_dict() for application in api.get_applications()])
+    (_, payloads, stale) = get_application_catalog().snapshot(allow_stale=serve_stale())
+    if stale:
+        mark_stale()
+    return jsonify(payloads)
 
 @app.route('/me/applications/<appid>/status',
            methods=['GET'])
-@no_cache
+@no_store
 def get_application_status(appid):
-    r = jsonify(_get_application_status(appid))
-    r.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    r.headers["Pragma"] = "no-cache"
-    r.headers["Expires"] = "0"
-    r.headers['Cache-Control'] = 'public, max-age=0'
-    return r
+    return jsonify(_get_application_status(appid, allow_stale=serve_stale()))
 
-def _get_application_status(appid, task_id=None):
-    with local_api() as api, redis_connection() as redis:
-        app_info = api.get_application_status(appid)
+def _fetch_application_status(appid):
+    with local_api() as api:
+        return api.get_application_status(appid)
+
+# The last status applianced gave for each application, served while
+# applianced is asked again when stale-while-revalidate is on
+application_statuses = RevalidatingCache('application_status', _fetch_application_status,
+                                         fresh_ttl=('KITE_APPLICATION_STATUS_TTL', 1))
+
+def _get_application_status(appid, task_id=None, allow_stale=False):
+    if allow_stale:
+        (app_info, stale) = application_statuses.get(appid)
+        if stale:
+            mark_stale()
+    else:
+        app_info = _fetch_application_status(appid)
 
     if task_id is None:
         # Look up task ids for installation or update
-        task_id = redis.get(_update_app_task_key(appid))
+        with redis_connection() as redis:
+            task_id = redis.get(_update_app_task_key(appid))
 
     if app_info is None:
         if task_id is None:
@@ -90,7 +130,7 @@ def _get_application_status(appid, task_id=None):
     return app_info
 
 @app.route('/me/applications/<appid>/version', methods=['GET'])
-@no_cache
+@no_cache(etag=_manifest_etag)
 def application_version(appid=None):
     '''Returns the major, minor, and revision number of an application'''
     with local_api() as api:
@@ -98,18 +138,14 @@ def application_version(appid=None):
         if info is None:
             abort(404)
 
-        mf = info['manifest']
-
-        if mf.version_info is None:
-            return jsonify({'major': 0, 'minor': 0, 'revision': 0})
-        else:
-            major, minor, revision = mf.version_info
-            return jsonify({ 'major': major,
-                             'minor': minor,
-                             'revision': revision })
+        # Unparseable versions are read as 0.0.0
+        major, minor, revision = info['manifest'].version_info
+        return jsonify({ 'major': major,
+                         'minor': minor,
+                         'revision': revision })
 
 @app.route('/me/applications/<appid>/manifest/current', methods=['GET'])
-@no_cache
+@no_cache(etag=_manifest_etag)
 def application_manifset(appid=None):
     with local_api() as api:
         info = api.get_application_info(appid)
@@ -117,7 +153,7 @@ def application_manifset(appid=None):
             abort(404)
 
         mf = info['manifest']
-        return jsonify(mf.to_dict())
+        return jsonify(mf.web_dict)
 
 @app.route('/me/applications/<appid>/manifest/latest', methods=['GET'])
 @no_cache
@@ -134,7 +170,7 @@ def application_latest_manifest(appid=None):
 
 @app.route('/me/applications/<appid>',
            methods=['GET', 'PUT'])
-@no_cache
+@no_cache(etag=_application_etag)
 def application(appid=None):
     '''Returns information about the given application, or requests that a
     new installation be started
@@ -181,6 +217,7 @@ def application(appid=None):
 
                     if cur_task is None:
                         task_id = str(uuid4())
+                        application_statuses.invalidate(appid)
 
                         redis.set(_update_app_task_key(appid), task_id)
                         install_app_task = install_app.apply_async(args=[appid], task_id=task_id)
@@ -0,0 +1,26 @@
+from flask import abort
+
+from ..api import is_local_network, require_superuser
+from ..app import app
+from ..metrics import workers
+
+@app.after_request
+def publish_metrics(rsp):
+    # Every PUBLISH_INTERVAL at most, so that /metrics in any worker
+    # can sum this one's values
+    workers.publish()
+    return rsp
+
+@app.route('/metrics', methods=[ 'GET' ])
+@require_superuser(allow_guest=True)
+def metrics(user=None, api=None, container=None):
+    # The source of a request is only a header, so a logged-in
+    # superuser's session is needed too. Sessions do not say whether
+    # they are guests, hence allow_guest; containers are refused below
+    if not is_local_network():
+        abort(403)
+
+    rsp = app.make_response(workers.render())
+    rsp.headers['Content-type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    rsp.headers['Cache-control'] = 'no-store'
+    return rsp
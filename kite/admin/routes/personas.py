@@ -5,23 +5,67 @@ from ..app import app
 from ..errors import KiteWrongType, KiteMissingKey
 from ..util import no_cache
 
+PERSONAS_PAGE_SIZE = 50
+PERSONAS_MAX_PAGE_SIZE = 500
+
 @app.route('/personas', methods=[ 'GET', 'POST' ])
 @require_superuser(allow_local_network=True, require_password=True)
 @no_cache
 def personas(user=None, api=None, container=None):
     if request.method == 'GET':
-        user_info = []
+        # Clients follow the Link header to the next page
+        try:
+            limit = int(request.args.get('limit', PERSONAS_PAGE_SIZE))
+            offset = int(request.args.get('offset', 0))
+        except ValueError:
+            abort(400)
+
+        if limit <= 0 or offset < 0:
+            abort(400)
+        limit = min(limit, PERSONAS_MAX_PAGE_SIZE)
+
+        cursor = request.args.get('cursor')
+
+        # Only the ids of the page, plus one to tell whether there is a
+        # next page, are kept. Only the page's personas are looked up.
+        # applianced cannot start the list at the cursor, so it is read
+        # from the start up to the page, but no further. Later pages
+        # therefore cost more to read than earlier ones
+        users = []
+        personas = api.iter_personas()
+        try:
+            for persona_id in personas:
+                if cursor is not None:
+                    if persona_id == cursor:
+                        cursor = None
+                    continue
+
+                if offset > 0:
+                    offset -= 1
+                    continue
+
+                users.append(persona_id)
+                if len(users) > limit:
+                    break
+        finally:
+            personas.close()
+
+        if cursor is not None:
+            # Not a persona, or one that has since been deleted
+            abort(400)
 
-        users = api.list_personas()
-        if 'offset' in request.args:
-            users = users[ int(request.args['offset']): ]
-        if 'limit' in request.args:
-            users = users[ :int(request.args['limit']) ]
+        next_cursor = None
+        if len(users) > limit:
+            users = users[:limit]
+            next_cursor = users[-1]
 
-        for user in users:
-            user_info.append({ 'persona_id': user, 'persona': api.get_persona_info(user) })
+        user_info = [ { 'persona_id': user, 'persona': persona }
+                      for user, persona in zip(users, api.get_persona_infos(users)) ]
 
-        return jsonify(user_info)
+        rsp = jsonify(user_info)
+        if next_cursor is not None:
+            rsp.headers['Link'] = '<{}>; rel="next"'.format(url_for('personas', cursor=next_cursor, limit=limit))
+        return rsp
 
     elif request.method == 'POST':
         if 'display_name' not in request.json:
@@ -47,11 +91,10 @@ def personas(user=None, api=None, container=None):
 @require_superuser(allow_local_network=True, require_password=True)
 def persona(persona_id, user=None, api=None, container=None):
     try:
-        api.get_persona_info(persona_id)
+        pi = api.get_persona_info(persona_id)
     except TypeError:
         abort(404)
 
-    pi = api.get_persona_info(persona_id)
     if pi is None:
         abort(404)
 
@@ -1,4 +1,4 @@
-from flask import request
+from flask import request, g
 from .app import app
 
 from OpenSSL.crypto import sign
@@ -24,13 +24,60 @@ class Signature(object):
     def hex_signature(self):
         return hexlify(self.signature).decode('ascii')
 
-def no_cache(fn):
-    def no_cache_wrapped(*args, **kwargs):
-        r = app.make_response(fn(*args, **kwargs))
-        if 'Cache-control' not in r.headers and \
-           request.method == 'GET':
-            r.headers['Cache-control'] = 'no-cache'
-        return r
+def serve_stale():
+    '''Whether routes that support it may answer with the last known
+    data while it is being refreshed, rather than wait for applianced
+    (stale-while-revalidate). Set KITE_STALE_WHILE_REVALIDATE to turn
+    this on'''
+    return app.config.get('KITE_STALE_WHILE_REVALIDATE', False)
 
-    no_cache_wrapped.__name__ = fn.__name__
-    return no_cache_wrapped
+def mark_stale():
+    '''Labels the response to the current request as stale'''
+    g.kite_response_stale = True
+
+def cache_policy(cache_control, etag=None):
+    '''Decorator giving GET responses of a route the Cache-Control header
+    cache_control, unless the route set its own.
+
+    If given, etag is called with the route's arguments before the route
+    runs, and returns the strong ETag its response will have, or None if
+    that cannot be told cheaply. Requests whose If-None-Match matches are
+    answered with 304 Not Modified without running the route.
+
+    Responses passed through mark_stale() get an X-Kite-Stale: 1 header
+    (RFC 9111 obsoletes the Warning header).
+    '''
+    def decorator(fn):
+        def cache_policy_wrapped(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return fn(*args, **kwargs)
+
+            tag = None if etag is None else etag(*args, **kwargs)
+            if tag is not None and request.if_none_match.contains(tag):
+                r = app.response_class(status=304)
+            else:
+                r = app.make_response(fn(*args, **kwargs))
+
+            if tag is not None and r.status_code in (200, 304):
+                r.set_etag(tag)
+            if 'Cache-Control' not in r.headers:
+                r.headers['Cache-Control'] = cache_control
+            if g.get('kite_response_stale', False):
+                r.headers['X-Kite-Stale'] = '1'
+            return r
+
+        cache_policy_wrapped.__name__ = fn.__name__
+        return cache_policy_wrapped
+    return decorator
+
+def no_cache(fn=None, etag=None):
+    '''Responses may be stored, but must be revalidated before every
+    use. Can be used as @no_cache or, with an etag function, as
+    @no_cache(etag=...)'''
+    if fn is None:
+        return cache_policy('no-cache', etag=etag)
+    return cache_policy('no-cache')(fn)
+
+def no_store(fn):
+    '''Responses change too often to be stored at all'''
+    return cache_policy('no-store')(fn)
@@ -0,0 +1,630 @@
+'''Stand-in for applianced that speaks the control socket protocol.
+
+The server listens on ``<root>/applianced-control`` and answers the
+requests kite-admin makes (system info, personas, applications,
+containers and run-in-app), backed by a generated appliance directory
+(manifests, apps, tokens and key.pem). It can be used from tests, or
+run standalone for load testing::
+
+    python -m test.fake_applianced /tmp/appliance --latency 0.001
+
+and then start kite-admin with KITE_APPLIANCE_DIR=/tmp/appliance.
+
+This module intentionally does not import kite.admin, since importing
+that package needs a running applianced.
+'''
+
+from socket import socket, AF_UNIX, SOCK_SEQPACKET, SOL_SOCKET, SCM_RIGHTS, CMSG_SPACE
+from base64 import b64decode
+from urllib.parse import unquote
+import threading
+import ipaddress
+import argparse
+import binascii
+import hashlib
+import random
+import array
+import struct
+import json
+import time
+import os
+
+KLM_IS_LAST = 0x0002
+KLM_RESPONSE = 0x8000
+
+ATTR_RESPONSE_CODE = 0x0000
+ATTR_PERSONA_ID = 0x0001
+ATTR_APP_URL = 0x0002
+ATTR_MANIFEST_URL = 0x0003
+ATTR_DISPLAY_NAME = 0x000D
+ATTR_PASSWORD = 0x000E
+ATTR_ADDRESS = 0x0010
+ATTR_CONTAINER_TYPE = 0x0011
+ATTR_SITE_ID = 0x0013
+ATTR_MANIFEST = 0x0014
+ATTR_SIGNED = 0x0015
+ATTR_TOKEN_ID = 0x0016
+ATTR_ARG = 0x0017
+ATTR_STDOUT = 0x0018
+ATTR_STDERR = 0x0019
+ATTR_STDIN = 0x001A
+ATTR_EXIT_CODE = 0x001C
+ATTR_PERSONA_FLAGS = 0x001D
+ATTR_SYSTEM_TYPE = 0x001E
+ATTR_SIGNATURE_URL = 0x001F
+ATTR_CREDENTIAL = 0x0020
+ATTR_GUEST = 0x0021
+
+CODE_SUCCESS = 0
+CODE_INTERNAL_ERROR = 6
+CODE_NOT_FOUND = 7
+CODE_NOT_ALLOWED = 8
+
+MAX_PACKET = 0x10000
+MAX_FDS = 8
+
+def encode_attr(ty, data):
+    aligned_len = 4 * ((len(data) + 3) // 4)
+    return struct.pack("!HH", ty, len(data) + 4) + data + (b'\0' * (aligned_len - len(data)))
+
+def encode_packet(ty, flags, attrs):
+    return struct.pack("!HH", ty, flags) + b''.join(encode_attr(aty, data) for aty, data in attrs)
+
+def decode_packet(pkt):
+    (ty, flags) = struct.unpack_from("!HH", pkt, 0)
+    attrs = []
+    off = 4
+    while off + 4 <= len(pkt):
+        (aty, alen) = struct.unpack_from("!HH", pkt, off)
+        if alen < 4:
+            raise ValueError("attribute too short")
+        attrs.append((aty, bytes(pkt[off + 4:off + alen])))
+        off += 4 * ((alen + 3) // 4)
+    return ty, flags, attrs
+
+def find(attrs, ty):
+    for aty, data in attrs:
+        if aty == ty:
+            return data
+    return None
+
+def find_all(attrs, ty):
+    return [data for aty, data in attrs if aty == ty]
+
+def code_attr(code):
+    return (ATTR_RESPONSE_CODE, struct.pack("!H", code))
+
+class FakePersona(object):
+    def __init__(self, persona_id, display_name, password=None, superuser=False):
+        self.persona_id = persona_id
+        self.display_name = display_name
+        self.password = password
+        self.superuser = superuser
+
+class FakeContainer(object):
+    def __init__(self, address, persona_id=None, app_url=None, site_id=None,
+                 logged_in=False, guest=False, tokens=None):
+        self.address = address
+        self.persona_id = persona_id
+        self.app_url = app_url
+        self.site_id = site_id
+        self.logged_in = logged_in
+        self.guest = guest
+        self.tokens = list(tokens or [])
+
+    @property
+    def is_app_instance(self):
+        return self.app_url is not None
+
+class FakeProcess(object):
+    '''What a scripted helper sees when it is run with run_in_app'''
+    def __init__(self, app_url, args, persona_id, stdin, stdout):
+        self.app_url = app_url
+        self.args = args
+        self.persona_id = persona_id
+        self.stdin = stdin
+        self.stdout = stdout
+
+    def read_input(self):
+        if self.stdin is None:
+            return b''
+        return self.stdin.read()
+
+    def write(self, data):
+        if self.stdout is not None:
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            self.stdout.write(data)
+            self.stdout.flush()
+
+class FakeApplianced(object):
+    '''An applianced stand-in serving a generated appliance directory.
+
+    :param root Directory to generate the appliance in
+    :param system_type System type reported by opcode 0x0500
+    :param latency Seconds to sleep before each reply, or a dict of
+                   opcode to seconds
+    :param failures Dict of opcode to the response code to return instead
+                    of handling the request
+    :param fail_probability Probability with which any request is answered
+                            with an internal error
+    '''
+
+    def __init__(self, root, system_type='x86_64-linux', latency=0,
+                 failures=None, fail_probability=0, seed=None):
+        self.root = root
+        self.system_type = system_type
+        self.latency = latency
+        self.failures = dict(failures or {})
+        self.fail_probability = fail_probability
+
+        self.personas = {}
+        self.containers = {}
+        self.apps = {}
+        self.helpers = {}
+        self.requests = []
+
+        # Requests being handled, and the most there have been at once
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._connections = set()
+        self._listener = None
+        self._thread = None
+
+        for d in ('manifests', 'tokens', 'closures'):
+            os.makedirs(os.path.join(root, d), exist_ok=True)
+        self._write_apps()
+        self._write_key()
+
+    @property
+    def sockpath(self):
+        return os.path.join(self.root, 'applianced-control')
+
+    def _write_key(self):
+        key_path = os.path.join(self.root, 'key.pem')
+        if os.path.exists(key_path):
+            return
+
+        try:
+            from OpenSSL import crypto
+        except ImportError:
+            return
+
+        key = crypto.PKey()
+        key.generate_key(crypto.TYPE_RSA, 2048)
+        with open(key_path, 'wb') as key_file:
+            key_file.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+
+    def _write_apps(self):
+        with open(os.path.join(self.root, 'apps'), 'wt') as apps_file:
+            for domain, (mf_name, _) in sorted(self.apps.items()):
+                apps_file.write('{} {}\n'.format(domain, mf_name))
+
+    # Appliance contents
+
+    def add_persona(self, display_name, password=None, superuser=False, persona_id=None):
+        if persona_id is None:
+            persona_id = os.urandom(32)
+        elif isinstance(persona_id, str):
+            persona_id = binascii.unhexlify(persona_id)
+
+        with self._lock:
+            self.personas[persona_id] = FakePersona(persona_id, display_name,
+                                                    password=password, superuser=superuser)
+        return binascii.hexlify(persona_id).decode('ascii')
+
+    def add_container(self, address, persona_id=None, app_url=None, site_id=None,
+                      logged_in=False, guest=False, tokens=None):
+        if isinstance(persona_id, str):
+            persona_id = binascii.unhexlify(persona_id)
+
+        container = FakeContainer(address, persona_id=persona_id, app_url=app_url,
+                                  site_id=site_id, logged_in=logged_in, guest=guest,
+                                  tokens=tokens)
+        with self._lock:
+            self.containers[ipaddress.ip_address(address).packed] = container
+        return container
+
+    def add_manifest(self, manifest):
+        data = json.dumps(manifest, sort_keys=True).encode('utf-8')
+        mf_name = hashlib.sha256(data).hexdigest()
+        with open(os.path.join(self.root, 'manifests', mf_name), 'wb') as mf_file:
+            mf_file.write(data)
+        return mf_name
+
+    def add_app(self, domain, name=None, version='1.0.0', permissions=None,
+                signed=True, helper=None, manifest=None):
+        '''Register an application, writing its manifest and a nix closure
+        holding permissions.json. Returns the manifest name.
+
+        helper, if given, is called with a FakeProcess for every
+        run_in_app in this application and returns the exit code.
+        '''
+
+        closure = os.path.join(self.root, 'closures', '{}-{}'.format(domain, version))
+        os.makedirs(closure, exist_ok=True)
+        if permissions is not None:
+            with open(os.path.join(closure, 'permissions.json'), 'wt') as perms:
+                json.dump(permissions, perms)
+
+        if manifest is None:
+            manifest = { 'name': name or domain,
+                         'domain': domain,
+                         'version': version,
+                         'app-url': 'https://{}/'.format(domain),
+                         'icon': 'https://{}/icon.svg'.format(domain),
+                         'nix-closure': { self.system_type: closure } }
+
+        mf_name = self.add_manifest(manifest)
+        with self._lock:
+            self.apps[domain] = (mf_name, signed)
+            if helper is not None:
+                self.helpers[domain] = helper
+            self._write_apps()
+        return mf_name
+
+    def add_token(self, token):
+        data = json.dumps(token).encode('ascii')
+        token_name = hashlib.sha256(data).hexdigest()
+        with open(os.path.join(self.root, 'tokens', token_name), 'wb') as token_file:
+            token_file.write(data)
+        return token_name
+
+    # Server lifecycle
+
+    def start(self):
+        if os.path.exists(self.sockpath):
+            os.unlink(self.sockpath)
+
+        self._listener = socket(AF_UNIX, SOCK_SEQPACKET, 0)
+        self._listener.bind(self.sockpath)
+        self._listener.listen(64)
+
+        self._thread = threading.Thread(target=self._accept_loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._listener is not None:
+            listener, self._listener = self._listener, None
+            try:
+                listener.shutdown(2)
+            except OSError:
+                pass
+            listener.close()
+        self.drop_connections()
+        if os.path.exists(self.sockpath):
+            os.unlink(self.sockpath)
+
+    def restart(self):
+        '''Simulate an applianced restart: all clients are disconnected'''
+        self.stop()
+        self.start()
+
+    def drop_connections(self):
+        with self._lock:
+            conns, self._connections = self._connections, set()
+        for conn in conns:
+            try:
+                conn.shutdown(2)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _accept_loop(self):
+        listener = self._listener
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+
+            with self._lock:
+                self._connections.add(conn)
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        try:
+            while True:
+                try:
+                    (pkt, ancdata, _, _) = conn.recvmsg(MAX_PACKET, CMSG_SPACE(MAX_FDS * 4))
+                except OSError:
+                    return
+                if len(pkt) == 0:
+                    return
+
+                fds = []
+                for (level, ty, data) in ancdata:
+                    if level == SOL_SOCKET and ty == SCM_RIGHTS:
+                        fds_array = array.array('i')
+                        fds_array.frombytes(data[:len(data) - (len(data) % fds_array.itemsize)])
+                        fds.extend(fds_array)
+
+                try:
+                    (req_ty, flags, attrs) = decode_packet(pkt)
+                except (ValueError, struct.error):
+                    for fd in fds:
+                        os.close(fd)
+                    continue
+
+                with self._lock:
+                    self.requests.append(req_ty)
+                    self.in_flight += 1
+                    self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+                try:
+                    replies = self._handle(req_ty, attrs, fds)
+                finally:
+                    with self._lock:
+                        self.in_flight -= 1
+                    for fd in fds:
+                        try:
+                            os.close(fd)
+                        except OSError:
+                            pass
+
+                self._delay(req_ty)
+                for (flags, rsp_attrs) in replies:
+                    conn.send(encode_packet(req_ty | KLM_RESPONSE, flags, rsp_attrs))
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self._connections.discard(conn)
+            conn.close()
+
+    def _delay(self, req_ty):
+        latency = self.latency
+        if isinstance(latency, dict):
+            latency = latency.get(req_ty, 0)
+        if latency:
+            time.sleep(latency)
+
+    def _handle(self, req_ty, attrs, fds):
+        if req_ty in self.failures:
+            return [ (0, [ code_attr(self.failures[req_ty]) ]) ]
+
+        if self.fail_probability and self._random.random() < self.fail_probability:
+            return [ (0, [ code_attr(CODE_INTERNAL_ERROR) ]) ]
+
+        handler = { 0x0100: self._persona,
+                    0x0101: self._create_persona,
+                    0x0200: self._app_info,
+                    0x0201: self._register_app,
+                    0x0400: self._container_info,
+                    0x0403: self._update_container,
+                    0x0405: self._run_in_app,
+                    0x0500: self._system_info }.get(req_ty)
+
+        if handler is None:
+            return [ (0, [ code_attr(CODE_INTERNAL_ERROR) ]) ]
+
+        try:
+            return handler(attrs, fds)
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            return [ (0, [ code_attr(CODE_INTERNAL_ERROR) ]) ]
+
+    # Opcodes
+
+    def _system_info(self, attrs, fds):
+        return [ (0, [ code_attr(CODE_SUCCESS),
+                       (ATTR_SYSTEM_TYPE, self.system_type.encode('ascii')) ]) ]
+
+    def _persona_attrs(self, persona):
+        flags = 0x1 if persona.superuser else 0
+        return [ (ATTR_PERSONA_ID, persona.persona_id),
+                 (ATTR_DISPLAY_NAME, persona.display_name.encode('ascii')),
+                 (ATTR_PERSONA_FLAGS, struct.pack("!ll", flags, 0)) ]
+
+    def _persona(self, attrs, fds):
+        persona_ids = find_all(attrs, ATTR_PERSONA_ID)
+        with self._lock:
+            if len(persona_ids) == 0:
+                ids = sorted(self.personas)
+                if len(ids) == 0:
+                    return [ (KLM_IS_LAST, [ code_attr(CODE_SUCCESS) ]) ]
+                return [ (KLM_IS_LAST if i == len(ids) - 1 else 0,
+                          [ code_attr(CODE_SUCCESS), (ATTR_PERSONA_ID, persona_id) ])
+                         for i, persona_id in enumerate(ids) ]
+
+            persona = self.personas.get(persona_ids[0])
+            if persona is None:
+                return [ (0, [ code_attr(CODE_NOT_FOUND) ]) ]
+            return [ (0, [ code_attr(CODE_SUCCESS) ] + self._persona_attrs(persona)) ]
+
+    def _create_persona(self, attrs, fds):
+        display_name = find(attrs, ATTR_DISPLAY_NAME)
+        password = find(attrs, ATTR_PASSWORD)
+        flags = find(attrs, ATTR_PERSONA_FLAGS)
+        if display_name is None or password is None:
+            return [ (0, [ code_attr(CODE_INTERNAL_ERROR) ]) ]
+
+        superuser = False
+        if flags is not None:
+            (set_flags, unset_flags) = struct.unpack("!ll", flags)
+            superuser = ((set_flags & ~unset_flags) & 0x1) != 0
+
+        persona_id = self.add_persona(display_name.decode('ascii'),
+                                      password=password.decode('ascii'),
+                                      superuser=superuser)
+        return [ (0, [ code_attr(CODE_SUCCESS),
+                       (ATTR_PERSONA_ID, binascii.unhexlify(persona_id)) ]) ]
+
+    def _app_info(self, attrs, fds):
+        app_url = find(attrs, ATTR_APP_URL)
+        with self._lock:
+            entry = self.apps.get(app_url.decode('ascii')) if app_url is not None else None
+        if entry is None:
+            return [ (0, [ code_attr(CODE_NOT_FOUND) ]) ]
+
+        (mf_name, signed) = entry
+        rsp = [ code_attr(CODE_SUCCESS), (ATTR_MANIFEST, mf_name.encode('ascii')) ]
+        if signed:
+            rsp.append((ATTR_SIGNED, b''))
+        return [ (0, rsp) ]
+
+    def _register_app(self, attrs, fds):
+        mf_url = find(attrs, ATTR_MANIFEST_URL).decode('ascii')
+        progress_ix = find(attrs, ATTR_STDOUT)
+
+        progress = None
+        if progress_ix is not None:
+            (ix,) = struct.unpack("!B", progress_ix)
+            progress = os.fdopen(os.dup(fds[ix]), 'wb', buffering=0)
+
+        try:
+            if not mf_url.startswith('data:application/json;base64,'):
+                if progress is not None:
+                    progress.write(b'error Only data: manifests are supported\n')
+                return [ (0, [ code_attr(CODE_INTERNAL_ERROR) ]) ]
+
+            manifest = json.loads(b64decode(unquote(mf_url.partition(',')[2])))
+            if progress is not None:
+                progress.write(b'0 2 Fetching closure\n')
+                progress.write(b'2 2 Done\n')
+
+            mf_name = self.add_manifest(manifest)
+            with self._lock:
+                self.apps[manifest['domain']] = (mf_name, find(attrs, ATTR_SIGNATURE_URL) != b'')
+                self._write_apps()
+        finally:
+            if progress is not None:
+                progress.close()
+
+        return [ (0, [ code_attr(CODE_SUCCESS) ]) ]
+
+    def _container_info(self, attrs, fds):
+        address = find(attrs, ATTR_ADDRESS)
+        with self._lock:
+            container = self.containers.get(address)
+            if container is None:
+                return [ (0, [ code_attr(CODE_NOT_FOUND) ]) ]
+
+            if container.is_app_instance:
+                rsp = [ code_attr(CODE_SUCCESS),
+                        (ATTR_CONTAINER_TYPE, struct.pack("!H", 2)),
+                        (ATTR_APP_URL, container.app_url.encode('ascii')) ]
+                if container.persona_id is not None:
+                    rsp.append((ATTR_PERSONA_ID, container.persona_id))
+                return [ (0, rsp) ]
+
+            rsp = [ code_attr(CODE_SUCCESS),
+                    (ATTR_CONTAINER_TYPE, struct.pack("!H", 1)),
+                    (ATTR_PERSONA_ID, container.persona_id) ]
+            if container.site_id is not None:
+                rsp.append((ATTR_SITE_ID, container.site_id.encode('ascii')))
+            if container.logged_in:
+                rsp.append((ATTR_SIGNED, b''))
+            if container.guest:
+                rsp.append((ATTR_GUEST, b''))
+            for token in container.tokens:
+                rsp.append((ATTR_TOKEN_ID, binascii.unhexlify(token)))
+            return [ (0, rsp) ]
+
+    def _update_container(self, attrs, fds):
+        address = find(attrs, ATTR_ADDRESS)
+        credential = find(attrs, ATTR_CREDENTIAL)
+        with self._lock:
+            container = self.containers.get(address)
+            if container is None:
+                return [ (0, [ code_attr(CODE_NOT_FOUND) ]) ]
+
+            if credential is not None:
+                persona = self.personas.get(container.persona_id)
+                if persona is None or \
+                   credential.decode('ascii') != 'pwd:{}'.format(persona.password):
+                    return [ (0, [ code_attr(CODE_NOT_ALLOWED) ]) ]
+                container.logged_in = True
+
+        return [ (0, [ code_attr(CODE_SUCCESS) ]) ]
+
+    def _run_in_app(self, attrs, fds):
+        address = find(attrs, ATTR_ADDRESS)
+        app_url = find(attrs, ATTR_APP_URL)
+        persona_id = find(attrs, ATTR_PERSONA_ID)
+
+        with self._lock:
+            if address is not None:
+                container = self.containers.get(address)
+                if container is None or not container.is_app_instance:
+                    return [ (0, [ code_attr(CODE_NOT_FOUND) ]) ]
+                app_url = container.app_url
+                persona_id = container.persona_id
+            elif app_url is not None:
+                app_url = app_url.decode('ascii')
+            helper = self.helpers.get(app_url)
+
+        if helper is None:
+            return [ (0, [ code_attr(CODE_NOT_FOUND) ]) ]
+
+        args = []
+        for arg in find_all(attrs, ATTR_ARG):
+            args.extend(arg.decode('ascii').split())
+
+        def open_fd(ty, mode):
+            ix = find(attrs, ty)
+            if ix is None:
+                return None
+            (ix,) = struct.unpack("!B", ix)
+            return os.fdopen(os.dup(fds[ix]), mode, buffering=0)
+
+        stdin = open_fd(ATTR_STDIN, 'rb')
+        stdout = open_fd(ATTR_STDOUT, 'wb')
+        try:
+            exit_code = helper(FakeProcess(app_url, args,
+                                           binascii.hexlify(persona_id).decode('ascii') if persona_id else None,
+                                           stdin, stdout))
+        finally:
+            for f in (stdin, stdout):
+                if f is not None:
+                    f.close()
+
+        return [ (0, [ code_attr(CODE_SUCCESS),
+                       (ATTR_EXIT_CODE, struct.pack("!i", exit_code or 0)) ]) ]
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a stand-in applianced')
+    parser.add_argument('root', help='Appliance directory to generate and serve')
+    parser.add_argument('--system-type', default='x86_64-linux')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds to wait before every reply')
+    parser.add_argument('--fail-probability', type=float, default=0,
+                        help='Probability of answering a request with an internal error')
+    parser.add_argument('--personas', type=int, default=10,
+                        help='Number of personas to generate')
+    parser.add_argument('--apps', type=int, default=10,
+                        help='Number of applications to generate')
+    args = parser.parse_args()
+
+    daemon = FakeApplianced(args.root, system_type=args.system_type,
+                            latency=args.latency,
+                            fail_probability=args.fail_probability)
+
+    admin = daemon.add_persona('admin', password='admin', superuser=True)
+    for i in range(args.personas):
+        daemon.add_persona('user{}'.format(i), password='user{}'.format(i))
+    for i in range(args.apps):
+        daemon.add_app('app{}.example.com'.format(i),
+                       permissions=[ { 'name': 'read' }, { 'regex': 'data/.*' } ])
+    daemon.add_container('10.0.0.2', persona_id=admin, logged_in=True)
+
+    daemon.start()
+    print('Serving {}; admin persona {} at 10.0.0.2'.format(daemon.sockpath, admin))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        daemon.stop()
+
+if __name__ == '__main__':
+    main()
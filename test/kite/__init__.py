@@ -0,0 +1,26 @@
+'''Importing kite.admin needs an applianced to talk to. Unless
+KITE_APPLIANCE_DIR points at one, the tests run against a stand-in,
+started here so that it is up before any test module imports kite.admin.
+'''
+
+import tempfile
+import shutil
+import atexit
+import os
+
+from ..fake_applianced import FakeApplianced
+
+applianced = None
+
+if 'KITE_APPLIANCE_DIR' not in os.environ:
+    _root = tempfile.mkdtemp(prefix='kite-appliance-')
+
+    applianced = FakeApplianced(_root)
+    applianced.start()
+
+    @atexit.register
+    def _stop_applianced():
+        applianced.stop()
+        shutil.rmtree(_root, ignore_errors=True)
+
+    os.environ['KITE_APPLIANCE_DIR'] = _root
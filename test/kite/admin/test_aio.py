@@ -0,0 +1,101 @@
+import threading
+import unittest
+import asyncio
+import json
+
+from .. import applianced
+
+from kite.admin.aio import AsyncKiteLocalApi
+from kite.admin.api import KiteLocalApi
+from kite.admin.cache import shared_persona_info
+
+@unittest.skipIf(applianced is None, "needs the stand-in applianced")
+class TestAsyncKiteLocalApi(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.api = AsyncKiteLocalApi()
+        await self.api.connect()
+
+    async def asyncTearDown(self):
+        self.api.close()
+        applianced.failures.clear()
+        applianced.latency = 0
+
+    async def test_system_type(self):
+        self.assertEqual(await self.api.get_system_type(), applianced.system_type)
+
+    async def test_personas(self):
+        ids = [ applianced.add_persona('async{}'.format(i)) for i in range(20) ]
+
+        self.assertLessEqual(set(ids), set(await self.api.list_personas()))
+
+        infos = await self.api.get_persona_infos(ids)
+        self.assertEqual([ info['display_name'] for info in infos ],
+                         [ 'async{}'.format(i) for i in range(20) ])
+
+    async def test_application_info(self):
+        applianced.add_app('async.example.com')
+
+        info = await self.api.get_application_info('async.example.com')
+        self.assertEqual(info['manifest'].name, 'async.example.com')
+        self.assertTrue(info['is_signed'])
+
+    async def test_concurrent(self):
+        # Requests from many tasks share the connection, and each gets
+        # its own reply
+        applianced.latency = 0.01
+        persona_id = applianced.add_persona('ivan')
+        applianced.add_app('concurrent.example.com')
+
+        results = await asyncio.gather(*([ self.api.get_system_type() for _ in range(10) ] +
+                                          [ self.api.get_application_info('concurrent.example.com'),
+                                            self.api.get_persona_info(persona_id) ]))
+
+        self.assertEqual(results[:10], [ applianced.system_type ] * 10)
+        self.assertEqual(results[10]['manifest'].name, 'concurrent.example.com')
+        self.assertEqual(results[11]['display_name'], 'ivan')
+
+    async def test_error_reply(self):
+        applianced.failures[0x0200] = 6
+
+        (info, system_type) = await asyncio.gather(self.api.get_application_info('error.example.com'),
+                                                   self.api.get_system_type(),
+                                                   return_exceptions=True)
+        self.assertIsInstance(info, ValueError)
+
+        # Only the failed request is affected
+        self.assertEqual(system_type, applianced.system_type)
+        self.assertEqual(await self.api.get_system_type(), applianced.system_type)
+
+    async def test_run_in_app(self):
+        def helper(proc):
+            proc.write(json.dumps({ 'args': proc.args,
+                                    'input': proc.read_input().decode() }))
+            return 4
+
+        applianced.add_app('async-helper.example.com', helper=helper)
+
+        proc = await self.api.run_in_app('async-helper.example.com', [ '/app/perms', '--check' ],
+                                         stdin=KiteLocalApi.PIPE, stdout=KiteLocalApi.PIPE)
+
+        # The process has a connection of its own
+        self.assertEqual(await self.api.get_system_type(), applianced.system_type)
+
+        (out, _) = await proc.communicate('hello')
+        self.assertEqual(json.loads(out.decode()),
+                         { 'args': [ '/app/perms', '--check' ], 'input': 'hello' })
+        self.assertEqual((proc.status, proc.returncode), ('success', 4))
+
+    async def test_create_user(self):
+        bumped = []
+        bump = shared_persona_info.bump
+        shared_persona_info.bump = lambda: bumped.append(threading.current_thread())
+        try:
+            persona_id = await self.api.create_user(displayname='kim', password='secret')
+        finally:
+            shared_persona_info.bump = bump
+
+        self.assertEqual((await self.api.get_persona_info(persona_id))['display_name'], 'kim')
+
+        # The shared cache is bumped without blocking the event loop
+        self.assertEqual(len(bumped), 1)
+        self.assertIsNot(bumped[0], threading.current_thread())
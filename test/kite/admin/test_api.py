@@ -0,0 +1,682 @@
+import unittest
+import binascii
+import datetime
+import json
+import socket
+import struct
+import time
+import os
+from unittest import mock
+
+from .. import applianced
+
+from kite.admin.api import KiteLocalApi, KiteLocalApiPool, KiteLocalProtocolError, \
+    KiteLocalReply, KiteLocalProtocol, AppManifest, local_api, _compile_schema, _encoded_attrs, \
+    get_application_catalog
+from kite.admin.api import KiteLocalAttrAddress, KiteLocalAttrAppUrl, KiteLocalAttrContainerType, \
+    KiteLocalAttrExitCode, KiteLocalAttrGuest, KiteLocalAttrPersonaFlags, KiteLocalAttrPersonaId, \
+    KiteLocalAttrResponseCode, KiteLocalAttrSigned, KiteLocalAttrSiteId, KiteLocalAttrStdout, \
+    KiteLocalAttrTokenId, KiteLocalAttrArg, IOV_MAX
+from kite.admin.app import app
+from kite.admin import metrics
+from kite.admin.permission import Permission, Token, lookup_perm_securities
+from kite.admin.helpers import helper_pool
+from kite.admin.cache import SharedCache, shared_persona_info
+
+from .test_cache import FakeRedis, Clock
+
+class TestAttrCodecs(unittest.TestCase):
+    PERSONA_ID = bytes(range(32))
+
+    # (attribute, expected payload, expected fields once decoded)
+    CASES = [
+        (KiteLocalAttrSigned(), b'', {}),
+        (KiteLocalAttrGuest(), b'', {}),
+        (KiteLocalAttrStdout(3), b'\x03', { 'ix': 3 }),
+        (KiteLocalAttrResponseCode(7), b'\x00\x07', { 'code': 7 }),
+        (KiteLocalAttrContainerType(2), b'\x00\x02', { 'ty': 2 }),
+        (KiteLocalAttrExitCode(-2), b'\xff\xff\xff\xfe', { 'exit_code': -2 }),
+        (KiteLocalAttrPersonaFlags(is_superuser=True, unset_flags=2),
+         b'\x00\x00\x00\x01\x00\x00\x00\x02', { 'set_flags': 1, 'unset_flags': 2 }),
+        (KiteLocalAttrAddress('10.0.0.2'), b'\x0a\x00\x00\x02',
+         { 'address': '10.0.0.2' }),
+        (KiteLocalAttrAddress('fd00::1'),
+         b'\xfd' + b'\x00' * 14 + b'\x01',
+         { 'address': 'fd00:0000:0000:0000:0000:0000:0000:0001' }),
+        (KiteLocalAttrAppUrl('kite+app://flywithkite.com/admin'),
+         b'kite+app://flywithkite.com/admin', { 'url': 'kite+app://flywithkite.com/admin' }),
+        (KiteLocalAttrSiteId('SHA256', 'abcd'), b'SHA256:abcd',
+         { 'hash_type': 'SHA256', 'hash_data': 'abcd', 'canonical': 'SHA256:abcd' }),
+        (KiteLocalAttrPersonaId(PERSONA_ID), PERSONA_ID,
+         { 'persona_id': PERSONA_ID }),
+        (KiteLocalAttrTokenId(PERSONA_ID.hex()), PERSONA_ID,
+         { 'token_id': PERSONA_ID }),
+    ]
+
+    def test_round_trip(self):
+        for (attr, payload, fields) in self.CASES:
+            with self.subTest(attr=type(attr).__name__):
+                packed = attr.pack()
+                self.assertEqual(packed[:4], struct.pack("!HH", attr.attr_ty, len(payload) + 4))
+                self.assertEqual(packed[4:4 + len(payload)], payload)
+
+                # Padded with zeros to a multiple of four
+                self.assertEqual(len(packed) % 4, 0)
+                self.assertEqual(packed[4 + len(payload):], b'\0' * (len(packed) - 4 - len(payload)))
+
+                reply = KiteLocalReply(struct.pack("!HH", 0x8000, 0) + packed)
+                decoded = reply.find(type(attr))
+                self.assertIsInstance(decoded, type(attr))
+                for (name, value) in fields.items():
+                    self.assertEqual(getattr(decoded, name), value)
+
+    def test_invalid(self):
+        with self.assertRaises(OverflowError):
+            KiteLocalAttrPersonaId._from_buffer(0x0001, b'short')
+        with self.assertRaises(ValueError):
+            KiteLocalAttrSiteId._from_buffer(0x0013, b'SHA256-abcd')
+        with self.assertRaises(TypeError):
+            _compile_schema(( ('a', 'ascii'), ('b', 'ascii') ))
+
+    def test_request(self):
+        attrs = [ KiteLocalAttrAppUrl('a'), KiteLocalAttrSigned(),
+                  KiteLocalAttrStdout(1) ]
+        req = KiteLocalProtocol('/nonexistent')._write_request(0x0405, 0, attrs)
+
+        self.assertEqual(bytes(req), struct.pack("!HH", 0x0405, 0) +
+                         b''.join(attr.pack() for attr in attrs))
+
+    def test_encoding_cache(self):
+        app_url = KiteLocalAttrAppUrl('cached.example.com')
+        self.assertIs(app_url.encoded(), KiteLocalAttrAppUrl('cached.example.com').encoded())
+
+        # Arguments differ from call to call, so they are not kept
+        before = len(_encoded_attrs)
+        self.assertEqual(KiteLocalAttrArg('--lookup').encoded(), KiteLocalAttrArg('--lookup').pack())
+        self.assertEqual(len(_encoded_attrs), before)
+
+def full_manifest_dict(json_data, web_response=True):
+    '''What AppManifest.to_dict returned before manifests were kept
+    compact'''
+    version = json_data.get('version', '0.0.0')
+    v = version.split('.')
+    if len(v) != 3 or not all(part.isdigit() for part in v):
+        version = "0.0.0"
+
+    ret = { 'name': json_data['name'],
+            'domain': json_data['domain'],
+            'app-url': json_data.get('app-url'),
+            'version': version,
+            'icon': json_data.get('icon') }
+    if not web_response:
+        ret['nix-closure'] = json_data['nix-closure']
+        ret['run-as-admin'] = json_data.get('run-as-admin', False)
+        ret['singleton'] = json_data.get('singleton', False)
+    return ret
+
+class TestAppManifest(unittest.TestCase):
+    MANIFESTS = [
+        { 'name': 'Photos', 'domain': 'photos.example.com', 'version': '1.2.3',
+          'app-url': 'https://photos.example.com/', 'icon': 'https://photos.example.com/icon.svg',
+          'nix-closure': { 'x86_64-linux': '/nix/store/photos', 'aarch64-linux': '/nix/store/photos-arm' },
+          'run-as-admin': True, 'singleton': True },
+        { 'name': 'Minimal', 'domain': 'minimal.example.com', 'nix-closure': {} },
+        { 'name': 'Odd', 'domain': 'odd.example.com', 'version': '1.x.0',
+          'nix-closure': { 'aarch64-linux': '/nix/store/odd-arm' } },
+        { 'name': 'Short', 'domain': 'short.example.com', 'version': '2.0',
+          'nix-closure': { 'x86_64-linux': '/nix/store/short' } },
+    ]
+
+    def test_same_as_full(self):
+        system_type = app.config['KITE_SYSTEM_TYPE']
+        for json_data in self.MANIFESTS:
+            with self.subTest(domain=json_data['domain']):
+                full = full_manifest_dict(json_data, web_response=False)
+
+                manifest = AppManifest(json_data)
+                self.assertEqual(manifest.web_dict, full_manifest_dict(json_data))
+                self.assertEqual(manifest.to_dict(), full_manifest_dict(json_data))
+                self.assertEqual(manifest.to_dict(web_response=False), full)
+                self.assertEqual(manifest.nix_closure, full['nix-closure'].get(system_type))
+                # Resolving the closure keeps the others
+                self.assertEqual(manifest.to_dict(web_response=False), full)
+                self.assertEqual(manifest.version_info,
+                                 tuple(int(part) for part in full['version'].split('.')))
+
+                compact = AppManifest(json_data, compact=True)
+                self.assertEqual(compact.web_dict, full_manifest_dict(json_data))
+                self.assertEqual(compact.to_dict(), full_manifest_dict(json_data))
+                self.assertEqual(compact.nix_closure, full['nix-closure'].get(system_type))
+                self.assertEqual(compact.version_info, manifest.version_info)
+
+    def test_shared_web_dict(self):
+        manifest = AppManifest(self.MANIFESTS[0])
+        self.assertIs(manifest.web_dict, manifest.web_dict)
+
+        # to_dict() may be modified by callers
+        d = manifest.to_dict()
+        d['name'] = 'Changed'
+        self.assertEqual(manifest.web_dict['name'], 'Photos')
+
+@unittest.skipIf(applianced is None, "needs the stand-in applianced")
+class TestKiteLocalApi(unittest.TestCase):
+    def setUp(self):
+        self.api = KiteLocalApi()
+
+    def tearDown(self):
+        self.api.close()
+        applianced.failures.clear()
+
+    def test_system_type(self):
+        self.assertEqual(self.api.get_system_type(), applianced.system_type)
+
+    def test_personas(self):
+        persona_id = self.api.create_user(displayname='alice', password='secret')
+
+        self.assertIn(persona_id, self.api.list_personas())
+        self.assertEqual(self.api.get_persona_info(persona_id),
+                         { 'display_name': 'alice', 'superuser': False })
+
+    def test_pipeline(self):
+        ids = [ applianced.add_persona('user{}'.format(i)) for i in range(40) ]
+
+        infos = self.api.get_persona_infos(ids)
+        self.assertEqual([ info['display_name'] for info in infos ],
+                         [ 'user{}'.format(i) for i in range(40) ])
+
+        # The connection is left ready for the next request
+        self.assertTrue(self.api.is_healthy)
+        self.assertEqual(self.api.get_system_type(), applianced.system_type)
+
+    def test_iter_personas_closed_early(self):
+        for i in range(5):
+            applianced.add_persona('early{}'.format(i))
+
+        personas = self.api.iter_personas()
+        next(personas)
+        personas.close()
+
+        # The rest of the list is not read, and the connection is left
+        # ready for the next request
+        self.assertTrue(self.api.is_healthy)
+        self.assertEqual(self.api.get_system_type(), applianced.system_type)
+
+    def test_personas_paging(self):
+        for i in range(7):
+            applianced.add_persona('page{}'.format(i))
+        all_ids = sorted(binascii.hexlify(persona_id).decode('ascii')
+                         for persona_id in applianced.personas)
+
+        client = app.test_client()
+        headers = { 'X-Kite-Admin-Source': 'local-network' }
+
+        # Without a limit, a page of the default size is returned
+        with mock.patch('kite.admin.routes.personas.PERSONAS_PAGE_SIZE', 4):
+            rsp = client.get('/personas', headers=headers)
+        self.assertEqual([ entry['persona_id'] for entry in rsp.get_json() ], all_ids[:4])
+        self.assertIn('cursor=' + all_ids[3], rsp.headers['Link'])
+
+        rsp = client.get('/personas?offset=2&limit=3', headers=headers)
+        self.assertEqual([ entry['persona_id'] for entry in rsp.get_json() ], all_ids[2:5])
+
+        # Following the Link headers visits every persona once
+        seen = []
+        url = '/personas?limit=3'
+        while url is not None:
+            rsp = client.get(url, headers=headers)
+            self.assertEqual(rsp.status_code, 200)
+            page = rsp.get_json()
+            self.assertLessEqual(len(page), 3)
+            seen.extend(entry['persona_id'] for entry in page)
+
+            link = rsp.headers.get('Link')
+            url = None
+            if link is not None:
+                self.assertTrue(link.endswith('; rel="next"'))
+                url = link[1:link.index('>')]
+                self.assertIn('cursor=' + seen[-1], url)
+        self.assertEqual(seen, all_ids)
+
+        rsp = client.get('/personas?cursor={}'.format(all_ids[0]), headers=headers)
+        self.assertEqual(rsp.get_json()[0]['persona']['display_name'],
+                         applianced.personas[binascii.unhexlify(all_ids[1])].display_name)
+
+    def test_personas_bad_cursor(self):
+        client = app.test_client()
+        headers = { 'X-Kite-Admin-Source': 'local-network' }
+
+        for query in ('cursor=' + '00' * 31 + '01', 'limit=0', 'offset=-1', 'limit=x'):
+            rsp = client.get('/personas?' + query, headers=headers)
+            self.assertEqual(rsp.status_code, 400, query)
+
+    def test_failure(self):
+        applianced.failures[0x0200] = 6
+
+        with self.assertRaises(ValueError):
+            self.api.get_application_info('missing.example.com')
+
+        self.assertTrue(self.api.is_healthy)
+
+    def test_large_reply(self):
+        tokens = [ '{:064x}'.format(i) for i in range(300) ]
+        applianced.add_container('10.1.0.3', persona_id=applianced.add_persona('heidi'),
+                                 tokens=tokens)
+
+        # Larger than the receive buffer the connection starts with
+        info = self.api.get_container_info('10.1.0.3')
+        self.assertEqual(info['tokens'], tokens)
+        self.assertTrue(self.api.is_healthy)
+
+    def test_malformed_reply(self):
+        (ours, theirs) = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.api.socket.close()
+        self.api.socket = ours
+        try:
+            theirs.send(b'\x85')
+            with self.assertRaises(KiteLocalProtocolError):
+                self.api.get_system_type()
+        finally:
+            theirs.close()
+
+        # The connection is not handed out again
+        self.assertIsNone(self.api.socket)
+        self.assertFalse(self.api.is_healthy)
+
+    def test_run_in_app(self):
+        def helper(proc):
+            proc.write(json.dumps({ 'args': proc.args,
+                                    'input': proc.read_input().decode() }))
+            return 3
+
+        applianced.add_app('helper.example.com', helper=helper)
+
+        proc = self.api.run_in_app('helper.example.com', [ '/app/perms', '--check' ],
+                                   stdin=KiteLocalApi.PIPE, stdout=KiteLocalApi.PIPE)
+        (out, _) = proc.communicate('hello')
+
+        self.assertEqual(json.loads(out.decode()),
+                         { 'args': [ '/app/perms', '--check' ], 'input': 'hello' })
+        self.assertEqual((proc.status, proc.returncode), ('success', 3))
+
+    def test_run_in_app_gathered(self):
+        def helper(proc):
+            proc.write(json.dumps({ 'args': proc.args,
+                                    'input': proc.read_input().decode() }))
+            return 0
+
+        applianced.add_app('gather.example.com', helper=helper)
+
+        # More arguments than sendmsg() takes buffers
+        args = [ '/app/perms' ] + [ 'arg{}'.format(i) for i in range(IOV_MAX + 10) ]
+        req = self.api._run_in_app_request('gather.example.com', args)[0]
+        self.assertLessEqual(len(req), IOV_MAX)
+        self.assertEqual(b''.join(req), bytes(self.api._write_request(
+            0x0405, 0, [ KiteLocalAttrAppUrl('gather.example.com') ] +
+            [ KiteLocalAttrArg(arg) for arg in args ])))
+
+        # A file-like stdout is passed as its own descriptor
+        (rfd, wfd) = os.pipe()
+        with os.fdopen(rfd, 'rb') as output:
+            with os.fdopen(wfd, 'wb') as stdout:
+                proc = self.api.run_in_app('gather.example.com', args,
+                                           stdin=KiteLocalApi.PIPE, stdout=stdout)
+            proc.communicate('x' * 1000)
+            result = json.loads(output.read().decode())
+
+        self.assertEqual(result, { 'args': args, 'input': 'x' * 1000 })
+        self.assertEqual(proc.status, 'success')
+
+    def test_metrics(self):
+        requests = metrics.applianced_requests.get('0x0500')
+        latencies = metrics.applianced_latency.get_count('0x0500')
+
+        self.api.get_system_type()
+
+        self.assertEqual(metrics.applianced_requests.get('0x0500'), requests + 1)
+        self.assertEqual(metrics.applianced_latency.get_count('0x0500'), latencies + 1)
+        self.assertIn('kite_admin_applianced_request_seconds_bucket{opcode="0x0500",le="+Inf"}',
+                      metrics.registry.render())
+
+    def test_metrics_endpoint(self):
+        superuser_id = applianced.add_persona('root', superuser=True)
+        user_id = applianced.add_persona('dave')
+
+        client = app.test_client()
+        headers = { 'X-Kite-Admin-Source': 'local-network' }
+
+        # The header alone is not enough
+        self.assertEqual(client.get('/metrics', headers=headers).status_code, 403)
+
+        # The session is given directly, since newer Flasks load the
+        # expiration back with a time zone
+        for (persona_id, status_code) in ((user_id, 403), (superuser_id, 200)):
+            session = { 'persona_id': persona_id,
+                        'expiration': datetime.datetime.now() + datetime.timedelta(minutes=5) }
+            with mock.patch('kite.admin.api.session', session):
+                rsp = client.get('/metrics', headers=headers)
+            self.assertEqual(rsp.status_code, status_code, persona_id)
+        self.assertIn(b'kite_admin_applianced_requests_total', rsp.data)
+
+    def test_persona_cache(self):
+        persona_id = applianced.add_persona('carol')
+        missing_id = '00' * 32
+
+        self.assertEqual(self.api.get_persona_info(persona_id)['display_name'], 'carol')
+        self.assertIsNone(self.api.get_persona_info(missing_id))
+
+        # Both answers, including the negative one, now come from the cache
+        applianced.failures[0x0100] = 6
+        self.assertEqual(self.api.get_persona_info(persona_id)['display_name'], 'carol')
+        self.assertIsNone(self.api.get_persona_info(missing_id))
+        self.assertEqual(self.api.get_persona_infos([ missing_id, persona_id ])[1]['display_name'],
+                         'carol')
+        del applianced.failures[0x0100]
+
+        # Creating a persona invalidates the cache
+        self.api.create_user(displayname='dave', password='secret')
+        applianced.add_persona('erin', persona_id=missing_id)
+        self.assertEqual(self.api.get_persona_info(missing_id)['display_name'], 'erin')
+
+    def test_persona_generation(self):
+        persona_id = applianced.add_persona('frank')
+
+        redis = FakeRedis()
+        clock = Clock()
+        with mock.patch.object(shared_persona_info, 'connection', redis.connection), \
+             mock.patch.object(shared_persona_info, 'clock', clock), \
+             mock.patch.object(shared_persona_info, '_generation', None), \
+             mock.patch.object(SharedCache, '_unavailable_until', 0):
+            self.assertEqual(self.api.get_persona_info(persona_id)['display_name'], 'frank')
+
+            # Renamed through another worker process, which bumps the
+            # shared generation but cannot clear this one's cache
+            applianced.personas[binascii.unhexlify(persona_id)].display_name = 'grace'
+            redis.incr('kite-admin:persona:generation')
+            self.assertEqual(self.api.get_persona_info(persona_id)['display_name'], 'frank')
+
+            clock.now = SharedCache.GENERATION_CHECK_INTERVAL
+            self.assertEqual(self.api.get_persona_info(persona_id)['display_name'], 'grace')
+
+    def test_login(self):
+        persona_id = applianced.add_persona('judy', password='secret')
+        container = applianced.add_container('10.1.0.4', persona_id=persona_id)
+
+        self.assertFalse(self.api.get_container_info('10.1.0.4')['logged_in'])
+
+        # Logged in through another worker process, which cannot
+        # invalidate this one's cache
+        container.logged_in = True
+
+        self.assertTrue(self.api.get_container_info('10.1.0.4')['logged_in'])
+
+        # Logged in containers are cached
+        applianced.failures[0x0400] = 6
+        self.assertTrue(self.api.get_container_info('10.1.0.4')['logged_in'])
+
+    def test_request_memo(self):
+        applianced.add_app('memo.example.com')
+        requests = metrics.applianced_requests.get('0x0200')
+
+        with app.test_request_context():
+            with local_api() as api:
+                info = api.get_application_info('memo.example.com')
+                info['is_signed'] = None
+            with local_api() as api:
+                self.assertIsNotNone(api.get_application_info('memo.example.com')['is_signed'])
+                self.assertIsNotNone(api.get_application_infos([ 'memo.example.com' ])[0])
+
+        self.assertEqual(metrics.applianced_requests.get('0x0200'), requests + 1)
+
+        # Nothing is remembered between requests
+        with app.test_request_context():
+            with local_api() as api:
+                api.get_application_info('memo.example.com')
+
+        self.assertEqual(metrics.applianced_requests.get('0x0200'), requests + 2)
+
+    def test_application_catalog(self):
+        catalog = self.api.application_catalog
+        applianced.add_app('catalog.example.com', version='1.0.0')
+
+        entry = catalog.get('catalog.example.com')
+        self.assertEqual(entry.payload['version'], '1.0.0')
+        self.assertIn(entry.payload, catalog.payloads)
+
+        # Entries are kept until the apps file changes
+        version = catalog.version
+        self.assertIs(catalog.get('catalog.example.com'), entry)
+        self.assertEqual(catalog.version, version)
+
+        applianced.add_app('catalog.example.com', version='1.1.0')
+        self.assertEqual(catalog.get('catalog.example.com').payload['version'], '1.1.0')
+        self.assertNotEqual(catalog.version, version)
+
+    def test_conditional_get(self):
+        applianced.add_app('etag.example.com')
+        client = app.test_client()
+        url = '/me/applications/etag.example.com/manifest/current'
+
+        rsp = client.get(url)
+        (etag, _) = rsp.get_etag()
+        self.assertEqual(rsp.status_code, 200)
+
+        # A current ETag is answered without asking applianced
+        requests = metrics.applianced_requests.get('0x0200')
+        rsp = client.get(url, headers={ 'If-None-Match': '"{}"'.format(etag) })
+        self.assertEqual(rsp.status_code, 304)
+        self.assertEqual(rsp.headers['Cache-Control'], 'no-cache')
+        self.assertEqual(metrics.applianced_requests.get('0x0200'), requests)
+
+        applianced.add_app('etag.example.com', version='2.0.0')
+        rsp = client.get(url, headers={ 'If-None-Match': '"{}"'.format(etag) })
+        self.assertEqual(rsp.status_code, 200)
+        self.assertEqual(rsp.get_json()['version'], '2.0.0')
+
+    def test_stale_applications(self):
+        client = app.test_client()
+        client.get('/me/applications')
+        # A reload left over from an earlier test could read the apps
+        # file before the new app is added, and be the one waited for
+        get_application_catalog().wait_for_reload(5)
+
+        app.config['KITE_STALE_WHILE_REVALIDATE'] = True
+        try:
+            applianced.add_app('stale.example.com')
+
+            # The applications list from before is served, marked stale,
+            # until it is reloaded in the background
+            rsp = client.get('/me/applications')
+            self.assertNotIn('stale.example.com', [ entry['domain'] for entry in rsp.get_json() ])
+            self.assertEqual(rsp.headers['X-Kite-Stale'], '1')
+
+            get_application_catalog().wait_for_reload(5)
+            rsp = client.get('/me/applications')
+        finally:
+            app.config['KITE_STALE_WHILE_REVALIDATE'] = False
+
+        self.assertIn('stale.example.com', [ entry['domain'] for entry in rsp.get_json() ])
+        self.assertNotIn('X-Kite-Stale', rsp.headers)
+        self.assertNotIn('Warning', rsp.headers)
+
+    def test_perm_security_cache(self):
+        lookups = []
+        def helper(proc):
+            lookups.append(proc.args)
+            proc.write(json.dumps({ 'needs_persona': True, 'dynamic': True, 'cache_ttl': 60 }))
+            return 0
+
+        applianced.add_app('dynamic.example.com', helper=helper,
+                           permissions=[ { 'regex': '.*', 'dynamic': True } ])
+        persona_id = applianced.add_persona('frank')
+
+        for _ in range(2):
+            with app.test_request_context():
+                with local_api() as api:
+                    security = Permission('kite+perm://dynamic.example.com/album').perm_security(api, persona_id)
+                    self.assertTrue(security.needs_persona)
+
+        self.assertEqual(len(lookups), 1)
+
+    def test_batched_dynamic_lookup(self):
+        runs = []
+        def helper(proc):
+            runs.append(proc.args)
+            if '--batch' not in proc.args:
+                return 1
+            names = proc.read_input().decode().split('\n')
+            proc.write(json.dumps({ name: { 'needs_persona': True, 'dynamic': True }
+                                    for name in names }))
+            return 0
+
+        applianced.add_app('batch.example.com', helper=helper,
+                           permissions=[ { 'regex': '.*', 'dynamic': True } ])
+        persona_id = applianced.add_persona('grace')
+
+        permissions = [ Permission('kite+perm://batch.example.com/album/{}'.format(i))
+                        for i in range(20) ]
+        securities = lookup_perm_securities(self.api, permissions, persona_id)
+
+        self.assertEqual(len(runs), 1)
+        self.assertTrue(all(security.needs_persona for security in securities))
+
+    def test_serving_helper(self):
+        starts = []
+        def helper(proc):
+            starts.append(proc.args)
+            if '--serve' not in proc.args:
+                return 1
+            for line in iter(proc.stdin.readline, b''):
+                request = json.loads(line.decode())
+                result = { name: { 'needs_persona': True, 'dynamic': True }
+                           for name in request['permissions'] }
+                proc.write(json.dumps({ 'id': request['id'], 'result': result }) + '\n')
+                if 'crash' in request['permissions'][0]:
+                    return 1
+            return 0
+
+        applianced.add_app('serve.example.com', helper=helper,
+                           permissions=[ { 'regex': '.*', 'dynamic': True } ])
+
+        app.config['KITE_PERMS_HELPER_SERVE'] = True
+        try:
+            for name in ('a', 'b', 'crash', 'c'):
+                security = Permission('kite+perm://serve.example.com/' + name).lookup_perm_security(self.api)
+                self.assertTrue(security.needs_persona)
+        finally:
+            app.config['KITE_PERMS_HELPER_SERVE'] = False
+            helper_pool.close()
+
+        # One helper served the first three lookups, and was started
+        # again after it exited
+        self.assertEqual(len(starts), 2)
+
+    def test_concurrent_describe(self):
+        def helper(proc):
+            time.sleep(0.3)
+            proc.write(json.dumps([ { 'short': line }
+                                    for line in proc.read_input().decode().split('\n') ]))
+            return 0
+
+        apps = [ 'fan{}.example.com'.format(i) for i in range(4) ]
+        for app_url in apps:
+            applianced.add_app(app_url, helper=helper)
+
+        token = Token(permissions=[ Permission('kite+perm://{}/view'.format(app_url))
+                                    for app_url in apps ])
+
+        with applianced._lock:
+            applianced.max_in_flight = applianced.in_flight
+        description = token.describe(self.api, None).to_json()
+
+        # The applications were described at the same time
+        self.assertGreater(applianced.max_in_flight, 1)
+
+        self.assertEqual([ section['domain'] for section in description['sections'] ], apps)
+
+    def test_verify_app_infos(self):
+        # Application info is looked up once per application, even though
+        # every application is verified on a connection of its own
+        def verify(apps):
+            for app_url in apps:
+                applianced.add_app(app_url, permissions=[ { 'regex': '.*' } ])
+            token = Token(permissions=[ Permission('kite+perm://{}/p{}'.format(app_url, i))
+                                        for app_url in apps for i in range(5) ])
+
+            requests = metrics.applianced_requests.get('0x0200')
+            with app.test_request_context():
+                with local_api() as api:
+                    result = token.verify_permissions(api, { 'persona_id': None, 'tokens': [] })
+            self.assertEqual(len(result.denied), 5 * len(apps))
+            return metrics.applianced_requests.get('0x0200') - requests
+
+        self.assertEqual(verify([ 'verify.example.com' ]), 1)
+        self.assertEqual(verify([ 'verify1.example.com', 'verify2.example.com' ]), 2)
+
+@unittest.skipIf(applianced is None, "needs the stand-in applianced")
+class TestKiteLocalApiPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = KiteLocalApiPool(max_size=2)
+
+    def tearDown(self):
+        self.pool.clear()
+
+    def test_reuse(self):
+        api = self.pool.acquire()
+        self.pool.release(api)
+
+        self.assertIs(self.pool.acquire(), api)
+        self.assertEqual(api.get_system_type(), applianced.system_type)
+
+    def test_idle_bound(self):
+        apis = [ self.pool.acquire() for _ in range(3) ]
+        self.assertEqual(len(set(apis)), 3)
+
+        for api in apis:
+            self.pool.release(api)
+
+        # Connections beyond max_size are closed rather than kept
+        self.assertEqual(len(self.pool._idle), 2)
+        self.assertIsNone(apis[2].socket)
+
+    def test_configured_size(self):
+        pool = KiteLocalApiPool()
+        app.config['KITE_LOCAL_API_POOL_SIZE'] = 1
+        try:
+            apis = [ pool.acquire() for _ in range(2) ]
+            for api in apis:
+                pool.release(api)
+            self.assertEqual(len(pool._idle), 1)
+        finally:
+            del app.config['KITE_LOCAL_API_POOL_SIZE']
+            pool.clear()
+
+    def test_discard(self):
+        api = self.pool.acquire()
+        self.pool.release(api, discard=True)
+
+        self.assertIsNone(api.socket)
+        self.assertIsNot(self.pool.acquire(), api)
+
+    def test_fork(self):
+        api = self.pool.acquire()
+        self.pool.release(api)
+
+        # As seen from a child process, the pool's connections belong to
+        # its parent
+        self.pool._pid = -1
+        child_api = self.pool.acquire()
+
+        self.assertIsNot(child_api, api)
+        self.assertIsNone(api.socket)
+        self.assertEqual(self.pool._pid, os.getpid())
+
+    def test_applianced_restart(self):
+        api = self.pool.acquire()
+        self.pool.release(api)
+
+        applianced.restart()
+
+        new_api = self.pool.acquire()
+        self.assertIsNot(new_api, api)
+        self.assertIsNone(api.socket)
+        self.assertEqual(new_api.get_system_type(), applianced.system_type)
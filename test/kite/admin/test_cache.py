@@ -0,0 +1,245 @@
+from contextlib import contextmanager
+from redis.exceptions import ConnectionError as RedisConnectionError
+import threading
+import unittest
+import time
+
+from kite.admin.cache import TTLCache, RevalidatingCache, SharedCache, MISSING, \
+    shared_persona_info
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+class TestTTLCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = TTLCache('test', 10, max_size=2, clock=self.clock)
+
+    def test_expiry(self):
+        self.cache.put('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+
+        self.clock.now = 10
+        self.assertIs(self.cache.get('a'), MISSING)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_copies(self):
+        value = { 'tokens': [ 'x' ] }
+        self.cache.put('a', value)
+        value['tokens'].append('y')
+
+        cached = self.cache.get('a')
+        self.assertEqual(cached, { 'tokens': [ 'x' ] })
+        cached['persona'] = None
+        self.assertEqual(self.cache.get('a'), { 'tokens': [ 'x' ] })
+
+    def test_eviction(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.cache.get('a')
+        self.cache.put('c', 3)
+
+        self.assertIs(self.cache.get('b'), MISSING)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.get('c'), 3)
+
+    def test_valid(self):
+        self.cache.put('a', 1)
+        self.assertIs(self.cache.get('a', valid=lambda value: value == 2), MISSING)
+        self.assertIs(self.cache.get('a'), MISSING)
+
+    def test_uncopied(self):
+        cache = TTLCache('test', float('inf'), copy_values=False, clock=self.clock)
+        value = { 'a': 1 }
+        cache.put('a', value)
+
+        self.clock.now = 1e12
+        self.assertIs(cache.get('a'), value)
+
+class TestRevalidatingCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.values = { 'a': 1 }
+        self.fetched = threading.Event()
+        self.cache = RevalidatingCache('test', self.fetch, fresh_ttl=1, max_stale=10,
+                                       clock=self.clock)
+
+    def fetch(self, key):
+        self.fetched.set()
+        return self.values[key]
+
+    def test_stale_while_revalidate(self):
+        self.assertEqual(self.cache.get('a'), (1, False))
+
+        self.values['a'] = 2
+        self.assertEqual(self.cache.get('a'), (1, False))
+
+        # The stale value is served while a new one is fetched
+        self.fetched.clear()
+        self.clock.now = 5
+        self.assertEqual(self.cache.get('a'), (1, True))
+        self.assertTrue(self.fetched.wait(5))
+        for _ in range(100):
+            if self.cache.get('a') == (2, False):
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.cache.get('a'), (2, False))
+
+        # Too old to serve at all
+        self.values['a'] = 3
+        self.clock.now = 20
+        self.assertEqual(self.cache.get('a'), (3, False))
+
+class FakeRedis(object):
+    '''The part of the Redis client SharedCache uses'''
+
+    def __init__(self):
+        self.data = {}
+        self.expiries = {}
+        self.down = False
+        self.round_trips = 0
+
+    @contextmanager
+    def connection(self):
+        if self.down:
+            raise RedisConnectionError("Redis is down")
+        yield self
+
+    def get(self, key):
+        self.round_trips += 1
+        return self.data.get(key)
+
+    def mget(self, keys):
+        self.round_trips += 1
+        return [ self.data.get(key) for key in keys ]
+
+    def incr(self, key):
+        self.round_trips += 1
+        self.data[key] = str(int(self.data.get(key, 0)) + 1).encode('ascii')
+        return int(self.data[key])
+
+    def smembers(self, key):
+        self.round_trips += 1
+        return set(self.data.get(key, set()))
+
+    def srem(self, key, *members):
+        self.round_trips += 1
+        self.data.get(key, set()).difference_update(members)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+class FakePipeline(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def set(self, key, data, ex=None):
+        self.commands.append((key, data, ex))
+
+    def sadd(self, key, member):
+        self.commands.append((key, member, 'sadd'))
+
+    def execute(self):
+        self.redis.round_trips += 1
+        for (key, data, ex) in self.commands:
+            if ex == 'sadd':
+                self.redis.data.setdefault(key, set()).add(str(data).encode('ascii'))
+            else:
+                self.redis.data[key] = data.encode('utf-8')
+                self.redis.expiries[key] = ex
+
+class TestSharedCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.redis = FakeRedis()
+        SharedCache._unavailable_until = 0
+
+    def tearDown(self):
+        SharedCache._unavailable_until = 0
+
+    def cache(self, **kwargs):
+        return SharedCache('test', 10, connection=self.redis.connection, clock=self.clock, **kwargs)
+
+    def test_get_put(self):
+        cache = self.cache()
+        cache.put_many([ ('a', { 'x': 1 }, None), ('b', None, 60), ('c', 3, 0) ])
+
+        self.assertEqual(cache.get_many([ 'a', 'b', 'c' ]), [ { 'x': 1 }, None, MISSING ])
+        self.assertEqual(self.redis.expiries, { 'kite-admin:test:0:a': 10,
+                                                'kite-admin:test:0:b': 60 })
+
+    def test_encoding(self):
+        cache = shared_persona_info
+        (connection, clock) = (cache.connection, cache.clock)
+        (cache.connection, cache.clock) = (self.redis.connection, self.clock)
+        try:
+            cache.put('p', { 'display_name': 'alice', 'superuser': True })
+            cache.put('q', None)
+
+            self.assertEqual(self.redis.data['kite-admin:persona:0:p'], b'["alice",true]')
+            self.assertEqual(cache.get_many([ 'p', 'q', 'r' ]),
+                             [ { 'display_name': 'alice', 'superuser': True }, None, MISSING ])
+        finally:
+            (cache.connection, cache.clock) = (connection, clock)
+
+    def test_generation(self):
+        cache = self.cache()
+        other = self.cache()
+        cache.put('a', 1)
+        self.assertEqual(other.get('a'), 1)
+
+        # The process that bumps sees the new generation at once, others
+        # once they next check for it
+        cache.bump()
+        self.assertIs(cache.get('a'), MISSING)
+        self.assertEqual(other.get('a'), 1)
+
+        self.clock.now = SharedCache.GENERATION_CHECK_INTERVAL
+        self.assertIs(other.get('a'), MISSING)
+        other.put('a', 2)
+        self.assertEqual(cache.get('a'), 2)
+
+    def test_process_generation(self):
+        cache = self.cache()
+        other = self.cache()
+        self.assertEqual(cache.generation(), 0)
+
+        # Checked at most every GENERATION_CHECK_INTERVAL, without a
+        # round trip in between
+        other.bump()
+        round_trips = self.redis.round_trips
+        self.assertEqual(cache.generation(), 0)
+        self.assertEqual(self.redis.round_trips, round_trips)
+
+        self.clock.now = SharedCache.GENERATION_CHECK_INTERVAL
+        self.assertIs(cache.cached_generation(), MISSING)
+        self.assertEqual(cache.generation(), 1)
+        self.assertEqual(cache.cached_generation(), 1)
+
+        self.redis.down = True
+        self.clock.now += SharedCache.GENERATION_CHECK_INTERVAL
+        self.assertIsNone(cache.generation())
+
+    def test_unavailable(self):
+        cache = self.cache()
+        cache.put('a', 1)
+
+        self.redis.down = True
+        self.assertIs(cache.get('a'), MISSING)
+        cache.put('b', 2)
+        cache.bump()
+
+        # Redis is not tried again until the backoff is over
+        self.redis.down = False
+        round_trips = self.redis.round_trips
+        self.assertIs(cache.get('a'), MISSING)
+        self.assertEqual(self.redis.round_trips, round_trips)
+
+        self.clock.now = SharedCache.UNAVAILABLE_BACKOFF
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIs(cache.get('b'), MISSING)
@@ -0,0 +1,68 @@
+import threading
+import tempfile
+import unittest
+import shutil
+import os
+
+from kite.admin.catalog import ApplicationCatalog
+
+class Manifest(object):
+    def __init__(self, name):
+        self.web_dict = { 'name': name }
+
+class TestApplicationCatalog(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'apps')
+        self.reads = []
+        self.read_allowed = threading.Event()
+        self.read_allowed.set()
+        self.catalog = ApplicationCatalog(self.path, self.read_manifest)
+
+    def tearDown(self):
+        self.read_allowed.set()
+        shutil.rmtree(self.dir)
+
+    def read_manifest(self, mf_name):
+        self.read_allowed.wait(5)
+        self.reads.append(mf_name)
+        return Manifest(mf_name)
+
+    def write_apps(self, *apps):
+        # A new file, as applianced writes it, so its identity changes
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wt') as apps_file:
+            for (app_id, mf_name) in apps:
+                apps_file.write('{} {}\n'.format(app_id, mf_name))
+        os.rename(tmp_path, self.path)
+
+    def test_reload(self):
+        self.write_apps(('a.example.com', 'mf-a'), ('b.example.com', 'mf-b'))
+        self.assertEqual(self.catalog.payloads, [ { 'name': 'mf-a' }, { 'name': 'mf-b' } ])
+
+        # Only the changed application's manifest is read again
+        self.write_apps(('a.example.com', 'mf-a'), ('b.example.com', 'mf-b2'))
+        self.assertEqual(self.catalog.payloads, [ { 'name': 'mf-a' }, { 'name': 'mf-b2' } ])
+        self.assertEqual(self.reads, [ 'mf-a', 'mf-b', 'mf-b2' ])
+
+    def test_stale(self):
+        self.write_apps(('a.example.com', 'mf-a'))
+
+        # Nothing was loaded yet, so there is nothing stale to serve
+        (version, payloads, stale) = self.catalog.snapshot(allow_stale=True)
+        self.assertEqual((payloads, stale), ([ { 'name': 'mf-a' } ], False))
+
+        self.read_allowed.clear()
+        self.write_apps(('a.example.com', 'mf-a2'))
+
+        # The old catalog is served while the new one is read, once
+        for _ in range(2):
+            self.assertEqual(self.catalog.snapshot(allow_stale=True),
+                             (version, [ { 'name': 'mf-a' } ], True))
+        self.assertEqual(len([ thread for thread in threading.enumerate()
+                               if thread.name == 'catalog-reload' ]), 1)
+
+        self.read_allowed.set()
+        self.catalog.wait_for_reload(5)
+        self.assertEqual(self.catalog.snapshot(allow_stale=True)[1:], ([ { 'name': 'mf-a2' } ], False))
+        self.assertEqual(self.reads, [ 'mf-a', 'mf-a2' ])
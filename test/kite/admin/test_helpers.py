@@ -0,0 +1,322 @@
+import threading
+import unittest
+import json
+import time
+import os
+
+from .. import applianced
+
+from kite.admin.app import app
+from kite.admin.helpers import HelperPool, HelperProcess, HelperUnavailable, HelperError
+
+class FakeHelper(object):
+    '''Stands in for a HelperProcess, answering every request with its op'''
+
+    started = []
+
+    def __init__(self, app_url, persona_id=None, clock=time.monotonic):
+        self.app_url = app_url
+        self.clock = clock
+        self.last_used = clock()
+        self.answered = 0
+        self.closed = False
+        self.in_use = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+        # Starting a helper takes a while
+        time.sleep(0.05)
+        FakeHelper.started.append(self)
+
+    @property
+    def alive(self):
+        return not self.closed
+
+    @property
+    def busy(self):
+        return self.in_use.is_set()
+
+    def request(self, op, timeout, **params):
+        self.in_use.set()
+        try:
+            self.release.wait(timeout)
+            if self.closed:
+                raise AssertionError("closed while in use")
+            self.answered += 1
+            return op
+        finally:
+            self.last_used = self.clock()
+            self.in_use.clear()
+
+    def close(self):
+        self.closed = True
+
+class TestHelperPool(unittest.TestCase):
+    def setUp(self):
+        FakeHelper.started = []
+        self.pool = HelperPool(factory=FakeHelper)
+
+    def tearDown(self):
+        self.pool.close()
+        app.config.pop('KITE_PERMS_HELPER_IDLE', None)
+
+    def test_start_once(self):
+        results = []
+        def lookup():
+            results.append(self.pool.request('app.example.com', None, 'lookup'))
+
+        threads = [ threading.Thread(target=lookup) for _ in range(4) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Requests that missed together still share a single helper
+        self.assertEqual(results, [ 'lookup' ] * 4)
+        self.assertEqual(len(FakeHelper.started), 1)
+        self.assertFalse(FakeHelper.started[0].closed)
+
+    def test_reaper(self):
+        app.config['KITE_PERMS_HELPER_IDLE'] = 0.1
+        self.pool.request('idle.example.com', None, 'lookup')
+        (helper,) = FakeHelper.started
+
+        # Stopped without any further request
+        deadline = time.monotonic() + 2
+        while not helper.closed and time.monotonic() < deadline:
+            time.sleep(0.02)
+        self.assertTrue(helper.closed)
+        self.assertEqual(self.pool._helpers, {})
+
+        # A new helper starts the reaper again
+        self.pool.request('idle.example.com', None, 'lookup')
+        self.assertEqual(len(FakeHelper.started), 2)
+        self.assertIsNotNone(self.pool._reaper)
+
+    def test_busy_not_evicted(self):
+        app.config['KITE_PERMS_HELPER_IDLE'] = 0.1
+        self.pool.request('busy.example.com', None, 'lookup')
+        (helper,) = FakeHelper.started
+
+        helper.release.clear()
+        thread = threading.Thread(target=self.pool.request,
+                                  args=('busy.example.com', None, 'check'))
+        thread.start()
+        helper.in_use.wait(1)
+
+        # Idle for longer than the timeout, but answering a request
+        helper.last_used -= 1
+        time.sleep(0.3)
+        self.assertFalse(helper.closed)
+
+        helper.release.set()
+        thread.join()
+        self.assertEqual(helper.answered, 2)
+
+def serve(answer):
+    '''A scripted `/app/perms --serve`, answering each request with
+    answer(proc, request), which writes the reply itself, and exiting
+    with 1 when answer returns False'''
+    def helper(proc):
+        if '--serve' not in proc.args:
+            return 1
+        for line in iter(proc.stdin.readline, b''):
+            if answer(proc, json.loads(line.decode())) is False:
+                return 1
+        return 0
+    return helper
+
+def reply(proc, request, **response):
+    response['id'] = request['id']
+    proc.write(json.dumps(response) + '\n')
+
+@unittest.skipIf(applianced is None, "needs the stand-in applianced")
+class TestHelperProcess(unittest.TestCase):
+    def setUp(self):
+        self.starts = []
+        self.offset = 0
+        self.pool = HelperPool(clock=self.clock)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def clock(self):
+        return time.monotonic() + self.offset
+
+    def add_app(self, domain, answer):
+        helper = serve(answer)
+        def start(proc):
+            self.starts.append(proc.args)
+            return helper(proc)
+        applianced.add_app(domain, helper=start)
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 2
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.02)
+        return condition()
+
+    def test_framing(self):
+        def answer(proc, request):
+            if request['op'] == 'split':
+                # An answer to an earlier request, then this one in pieces
+                proc.write(json.dumps({ 'id': request['id'] - 1, 'result': 'old' }) + '\n')
+                line = json.dumps({ 'id': request['id'], 'result': request['permissions'] })
+                proc.write(line[:5])
+                time.sleep(0.05)
+                proc.write(line[5:] + '\n')
+            elif request['op'] == 'fail':
+                reply(proc, request, error='no such permission')
+            else:
+                reply(proc, request, result=request['op'])
+
+        self.add_app('framing.example.com', answer)
+        helper = HelperProcess('framing.example.com')
+        try:
+            self.assertEqual(helper.request('lookup', 1), 'lookup')
+            self.assertEqual(helper.request('split', 1, permissions=[ '/a' ]), [ '/a' ])
+            with self.assertRaises(HelperError):
+                helper.request('fail', 1)
+
+            # Still usable after an error
+            self.assertEqual(helper.request('check', 1), 'check')
+            self.assertEqual(helper.answered, 4)
+            self.assertTrue(helper.alive)
+        finally:
+            helper.close()
+        self.assertEqual(len(self.starts), 1)
+
+    def test_large_request(self):
+        def answer(proc, request):
+            reply(proc, request, result=sum(len(name) for name in request['permissions']))
+        script = serve(answer)
+
+        def start(proc):
+            # Not reading stdin for a while, so that the pipe fills up
+            time.sleep(0.2)
+            return script(proc)
+        applianced.add_app('large.example.com', helper=start)
+
+        helper = HelperProcess('large.example.com')
+        try:
+            permissions = [ '/album/{:06d}'.format(i) + 'x' * 100 for i in range(1000) ]
+            self.assertEqual(helper.request('lookup', 5, permissions=permissions),
+                             sum(len(name) for name in permissions))
+            self.assertEqual(helper.request('lookup', 5, permissions=[ '/a' ]), 2)
+            self.assertTrue(helper.alive)
+        finally:
+            helper.close()
+
+    def test_timeout(self):
+        def answer(proc, request):
+            if request['op'] != 'slow':
+                reply(proc, request, result=request['op'])
+
+        self.add_app('slow.example.com', answer)
+        helper = HelperProcess('slow.example.com')
+        try:
+            with self.assertRaises(HelperUnavailable):
+                helper.request('slow', 0.2)
+            self.assertFalse(helper.alive)
+
+            with self.assertRaises(HelperUnavailable):
+                helper.request('lookup', 1)
+        finally:
+            helper.close()
+
+    def test_exit(self):
+        def answer(proc, request):
+            if request['op'] == 'quit':
+                return False
+            reply(proc, request, result=request['op'])
+            if request['op'] == 'last':
+                return False
+
+        self.add_app('exit.example.com', answer)
+
+        # Noticed while waiting for an answer
+        helper = HelperProcess('exit.example.com')
+        try:
+            with self.assertRaises(HelperUnavailable):
+                helper.request('quit', 5)
+        finally:
+            helper.close()
+
+        # Noticed while idle
+        helper = HelperProcess('exit.example.com')
+        try:
+            self.assertEqual(helper.request('last', 5), 'last')
+            self.assertTrue(self.wait_for(lambda: not helper.alive))
+        finally:
+            helper.close()
+
+    def test_restart_after_crash(self):
+        def answer(proc, request):
+            reply(proc, request, result=request['op'])
+            if request['op'] == 'crash':
+                return False
+
+        self.add_app('crash.example.com', answer)
+        self.assertEqual(self.pool.request('crash.example.com', None, 'crash'), 'crash')
+        self.assertEqual(len(self.starts), 1)
+
+        # Whether or not the exit was seen yet, the request is answered
+        # by a new helper
+        self.assertEqual(self.pool.request('crash.example.com', None, 'lookup'), 'lookup')
+        self.assertEqual(len(self.starts), 2)
+        self.assertEqual(self.pool.request('crash.example.com', None, 'check'), 'check')
+        self.assertEqual(len(self.starts), 2)
+
+    def test_failed_backoff(self):
+        self.add_app('broken.example.com', lambda proc, request: False)
+
+        with self.assertRaises(HelperUnavailable):
+            self.pool.request('broken.example.com', None, 'lookup')
+        # Never answered, so not started again straight away
+        self.assertEqual(len(self.starts), 1)
+
+        self.offset += HelperPool.FAILED_BACKOFF / 2
+        with self.assertRaises(HelperUnavailable):
+            self.pool.request('broken.example.com', None, 'lookup')
+        self.assertEqual(len(self.starts), 1)
+
+        self.offset += HelperPool.FAILED_BACKOFF
+        with self.assertRaises(HelperUnavailable):
+            self.pool.request('broken.example.com', None, 'lookup')
+        self.assertEqual(len(self.starts), 2)
+
+    def test_fork(self):
+        self.add_app('fork.example.com', lambda proc, request: reply(proc, request, result='ok'))
+        self.pool.request('fork.example.com', None, 'lookup')
+        (helper,) = self.pool._helpers.values()
+        (stdin, stdout) = (helper.proc.stdin, helper.proc.stdout)
+
+        # As seen from a child process, the helpers belong to its parent
+        self.pool._pid = -1
+        self.pool._check_fork()
+
+        self.assertEqual(self.pool._helpers, {})
+        self.assertEqual(self.pool._start_locks, {})
+        self.assertIsNone(helper.proc)
+        self.assertIsNone(helper.api.socket)
+        for fd in (stdin, stdout):
+            with self.assertRaises(OSError):
+                os.fstat(fd)
+
+        self.assertEqual(self.pool.request('fork.example.com', None, 'lookup'), 'ok')
+        self.assertEqual(len(self.starts), 2)
+
+    def test_evict_drops_start_lock(self):
+        self.add_app('evict.example.com', lambda proc, request: reply(proc, request, result='ok'))
+
+        self.pool.request('evict.example.com', None, 'lookup')
+        self.assertIn(('evict.example.com', None), self.pool._start_locks)
+
+        self.offset += self.pool.idle_timeout + 1
+        self.pool._evict_idle()
+        self.assertEqual(self.pool._helpers, {})
+        self.assertEqual(self.pool._start_locks, {})
+
+        # Started again on the next request
+        self.assertEqual(self.pool.request('evict.example.com', None, 'lookup'), 'ok')
+        self.assertEqual(len(self.starts), 2)
@@ -0,0 +1,67 @@
+import unittest
+
+from kite.admin.metrics import Registry, WorkerMetrics
+
+from .test_cache import FakeRedis, Clock
+
+class TestWorkerMetrics(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.redis = FakeRedis()
+
+    def worker(self, pid):
+        registry = Registry()
+        requests = registry.counter('requests_total', 'Requests', labels=('opcode',))
+        latency = registry.histogram('request_seconds', 'Latency', labels=('opcode',),
+                                     buckets=(0.1, 1))
+        worker = WorkerMetrics(registry, connection=self.redis.connection, clock=self.clock,
+                               getpid=lambda: pid)
+        return (worker, requests, latency)
+
+    def test_sum(self):
+        (first, first_requests, first_latency) = self.worker(100)
+        (second, second_requests, second_latency) = self.worker(200)
+
+        first_requests.inc('0x0100', amount=2)
+        first_latency.observe(0.05, '0x0100')
+        second_requests.inc('0x0100')
+        second_requests.inc('0x0200')
+        second_latency.observe(0.5, '0x0100')
+        second.publish()
+
+        # Whichever worker answers renders the same totals
+        for worker in (first, second):
+            rendered = worker.render()
+            self.assertIn('requests_total{opcode="0x0100"} 3\n', rendered)
+            self.assertIn('requests_total{opcode="0x0200"} 1\n', rendered)
+            self.assertIn('request_seconds_bucket{opcode="0x0100",le="0.1"} 1\n', rendered)
+            self.assertIn('request_seconds_bucket{opcode="0x0100",le="1"} 2\n', rendered)
+            self.assertIn('request_seconds_count{opcode="0x0100"} 2\n', rendered)
+
+    def test_publish_interval(self):
+        (worker, requests, _) = self.worker(100)
+        self.assertTrue(worker.publish())
+
+        requests.inc('0x0100')
+        self.assertFalse(worker.publish())
+
+        self.clock.now = 5
+        self.assertTrue(worker.publish())
+
+    def test_expired_worker(self):
+        (first, first_requests, _) = self.worker(100)
+        (second, second_requests, _) = self.worker(200)
+        first_requests.inc('0x0100')
+        first.publish()
+        second_requests.inc('0x0100')
+
+        del self.redis.data['kite-admin:metrics:100']
+        self.assertIn('requests_total{opcode="0x0100"} 1\n', second.render())
+        self.assertEqual(self.redis.data['kite-admin:metrics:workers'], { b'200' })
+
+    def test_redis_down(self):
+        (worker, requests, _) = self.worker(100)
+        requests.inc('0x0100')
+
+        self.redis.down = True
+        self.assertIn('requests_total{opcode="0x0100"} 1\n', worker.render())
@@ -1,6 +1,6 @@
 import unittest
 
-from kite.admin.permission import Permission
+from kite.admin.permission import Permission, PermissionIndex, find_perm
 
 class TestPermission(unittest.TestCase):
     def test_parse(self):
@@ -37,3 +37,75 @@ class TestPermission(unittest.TestCase):
         self.assertEqual(p.permission, 'nested/permission')
 
         self.assertEqual(p.application, 'kite+app://flywithkite.com/admin')
+
+    def test_interned(self):
+        p = Permission('kite+perm://flywithkite.com/admin/view/transfer')
+        self.assertIs(p, Permission('admin/view/transfer', app_url='flywithkite.com'))
+        self.assertIs(p, Permission('/admin/view/transfer', relative_to='flywithkite.com'))
+
+        base = Permission('kite+perm://flywithkite.com/admin/view')
+        self.assertIs(p.base_permission, base)
+        self.assertEqual(p.transferred, { base, p })
+        self.assertFalse(p.is_base)
+        self.assertTrue(base.is_base)
+
+class TestPermissionIndex(unittest.TestCase):
+    def assertFindsLikeList(self, perms, names):
+        index = PermissionIndex(perms)
+        for name in names:
+            self.assertEqual(index.find(name), find_perm(perms, name))
+
+    def test_first_match(self):
+        perms = [ { 'regex': 'photos/.*' },
+                  { 'name': 'photos/view' },
+                  { 'name': 'albums' },
+                  { 'regex': 'alb(um)+s' },
+                  { 'regex': '.*', 'dynamic': True } ]
+        self.assertFindsLikeList(perms, [ 'photos/view', 'albums', 'albumums', 'other', '' ])
+        self.assertEqual(PermissionIndex(perms).find('photos/view')[1], 0)
+        self.assertEqual(PermissionIndex(perms[:4]).find('other'), (None, None))
+
+    def test_uncombinable(self):
+        perms = [ { 'regex': '(a)\\1' }, { 'regex': '(?i)b' }, { 'name': 'c' } ]
+        self.assertFindsLikeList(perms, [ 'aa', 'B', 'c', 'd' ])
+
+    def assertMatchedSeparately(self, regex, names):
+        # The other entries are still combined, and keep their meaning
+        perms = [ { 'regex': 'x+' }, { 'regex': regex }, { 'regex': 'c' }, { 'regex': '.*z' } ]
+        index = PermissionIndex(perms)
+        self.assertEqual(index._separate, [ 1 ])
+        self.assertIsNotNone(index._regex)
+        self.assertFindsLikeList(perms, names + [ 'x', 'c', 'C', 'Z', 'az', 'd' ])
+
+    def test_inline_flag(self):
+        self.assertMatchedSeparately('(?i)b', [ 'b', 'B' ])
+
+    def test_backreference(self):
+        self.assertMatchedSeparately('(a)\\1', [ 'aa', 'a', 'a\\1' ])
+
+    def test_conditional(self):
+        self.assertMatchedSeparately('(<)?a(?(1)>)', [ 'a', '<a>', '<a', 'a>' ])
+
+    def test_scoped_flag(self):
+        perms = [ { 'regex': '(?i:b)' }, { 'regex': 'c' } ]
+        index = PermissionIndex(perms)
+        self.assertEqual(index._separate, [])
+        self.assertFindsLikeList(perms, [ 'b', 'B', 'c', 'C' ])
+
+    def test_order_with_separate(self):
+        # A separate entry before the combined one that matches wins
+        perms = [ { 'regex': 'x' }, { 'regex': '(?i)a.*' }, { 'regex': 'ab' }, { 'regex': '(?s)a.' } ]
+        self.assertFindsLikeList(perms, [ 'ab', 'AB', 'a\n', 'x' ])
+        self.assertEqual(PermissionIndex(perms).find('ab')[1], 1)
+
+    def test_name_and_regex(self):
+        # Entries may have both, and match by either
+        perms = [ { 'name': 'albums', 'regex': 'photos/.*' },
+                  { 'regex': 'albums|photos/view' },
+                  { 'name': 'photos/edit' },
+                  { 'name': 'other', 'regex': '(a)\\1' } ]
+        self.assertFindsLikeList(perms, [ 'albums', 'photos/view', 'photos/edit',
+                                          'other', 'aa', 'none' ])
+        self.assertFindsLikeList(perms[1:], [ 'albums', 'photos/view', 'photos/edit',
+                                              'other', 'aa', 'none' ])
+        self.assertEqual(PermissionIndex(perms).find('photos/edit')[1], 0)